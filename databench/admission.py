@@ -0,0 +1,100 @@
+"""Admission control for new analysis instances."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from . import metrics
+from .watchdog import watchdog
+from collections import deque
+import datetime
+import logging
+import tornado.concurrent
+import tornado.gen
+
+log = logging.getLogger(__name__)
+
+# reject all new instances while the IOLoop lag is above this (in seconds)
+MAX_LOOP_LAG = None
+
+
+class Admission(object):
+    """Limit the number of concurrent instances of an analysis.
+
+    The limits are read from the ``info`` of the analysis (usually set in
+    ``index.yaml``):
+
+    * ``max_instances``: maximum number of concurrent instances
+      (default ``None``, unlimited)
+    * ``admission_queue``: number of connections that may wait for a free
+      instance (default ``0``)
+    * ``admission_timeout``: maximum time in seconds to wait in the queue
+      (default ``10``)
+    * ``retry_after``: time in seconds that rejected frontends are asked to
+      wait before retrying (default ``5``)
+
+    Independently of these limits, all new instances are rejected while the
+    IOLoop lag measured by the :mod:`~databench.watchdog` is above
+    ``MAX_LOOP_LAG``.
+
+    :param str name: Name of the analysis.
+    :param dict info: Info of the analysis.
+    """
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.instances = 0
+        self.waiting = deque()
+
+    @property
+    def retry_after(self):
+        return self.info.get('retry_after', 5)
+
+    def reject(self, reason):
+        log.warning('Rejected new instance of {}: {}.'.format(
+            self.name, reason))
+        metrics.admission_rejected.inc(analysis=self.name, reason=reason)
+        return reason
+
+    @tornado.gen.coroutine
+    def acquire(self):
+        """Acquire a slot for a new instance.
+
+        :returns: ``None`` if admitted or the reason for the rejection.
+        :rtype: tornado.concurrent.Future
+        """
+        if MAX_LOOP_LAG is not None and watchdog.lag > MAX_LOOP_LAG:
+            raise tornado.gen.Return(self.reject('loop_lag'))
+
+        max_instances = self.info.get('max_instances')
+        if max_instances is None or self.instances < max_instances:
+            self.instances += 1
+            metrics.analysis_instances.set(self.instances, analysis=self.name)
+            raise tornado.gen.Return(None)
+
+        if len(self.waiting) >= self.info.get('admission_queue', 0):
+            raise tornado.gen.Return(self.reject('max_instances'))
+
+        slot = tornado.concurrent.Future()
+        self.waiting.append(slot)
+        try:
+            yield tornado.gen.with_timeout(
+                datetime.timedelta(
+                    seconds=self.info.get('admission_timeout', 10)),
+                slot)
+        except tornado.gen.TimeoutError:
+            self.waiting.remove(slot)
+            raise tornado.gen.Return(self.reject('queue_timeout'))
+
+        # the slot was handed over by release()
+        raise tornado.gen.Return(None)
+
+    def release(self):
+        """Release the slot of an instance that ended."""
+        while self.waiting:
+            slot = self.waiting.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+
+        self.instances -= 1
+        metrics.analysis_instances.set(self.instances, analysis=self.name)
@@ -3,6 +3,7 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import utils
+from . import workers
 from .datastore import Datastore
 import inspect
 import logging
@@ -179,8 +180,9 @@ class Analysis(object):
 
     @staticmethod
     def __create_id():
-        return ''.join(random.choice(string.ascii_letters + string.digits)
-                       for _ in range(8))
+        return workers.tag(''.join(
+            random.choice(string.ascii_letters + string.digits)
+            for _ in range(8)))
 
     def set_emit_fn(self, emit_fn):
         self.emit_to_frontend = emit_fn
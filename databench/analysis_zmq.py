@@ -1,14 +1,766 @@
+from collections import deque
+from future.utils import with_metaclass
+import abc
+import atexit
+import errno
 import json
 import logging
+import os
+import signal
 import subprocess
+import sys
+import time
+import tornado.autoreload
+import tornado.concurrent
 import tornado.gen
+import tornado.ioloop
+import tornado.iostream
 import zmq
 import zmq.eventloop.zmqstream
 
+from . import encoding
+from . import metrics
 from .analysis import Analysis
+from .profiling import profiler
+from .supervisor import supervisor
 
 log = logging.getLogger(__name__)
 
+# messages a kernel can send for an analysis instance before it needs new
+# credits that are granted once messages were written to the frontend
+KERNEL_CREDITS = 64
+
+# messages queued for a kernel that is not connected or does not read its
+# messages before further messages are dropped
+MAX_PENDING = 1000
+
+# seconds until messages are sent again to a kernel whose queue was full
+RETRY_INTERVAL = 0.01
+
+
+class KernelRouter(object):
+    """ROUTER socket that kernels connect to with a DEALER socket.
+
+    Kernels use their initial kernel id as their identity. Messages to a
+    kernel are addressed by this identity and messages from all kernels
+    arrive on this socket. Messages to a registered kernel that is not
+    connected, e.g. while it starts or restarts, are queued and sent in order
+    once the kernel sent a message. Messages are sent without blocking. When
+    the queue of a kernel is full, messages are queued as well and sent again
+    every ``RETRY_INTERVAL`` seconds. A restarted kernel takes over the
+    identity of its predecessor.
+
+    :param str address: ``tcp://<host>`` to bind to a random port or a
+        full address like ``ipc:///tmp/databench.ipc``.
+    :param zmq.Context context: Defaults to the process-wide context.
+    :param int hwm: High-water mark or ``None`` for the ZMQ default.
+    """
+
+    def __init__(self, address='tcp://127.0.0.1', context=None, hwm=None):
+        context = context if context is not None else zmq.Context.instance()
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        if hwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, hwm)
+            self.socket.setsockopt(zmq.RCVHWM, hwm)
+        if address.startswith('tcp://') and address.count(':') == 1:
+            port = self.socket.bind_to_random_port(address, min_port=6000)
+            address = '{}:{}'.format(address, port)
+        else:
+            self.socket.bind(address)
+        self.address = address
+        log.debug('kernel router bound to {}'.format(address))
+
+        self.kernels = {}
+        # queued messages by identity
+        self.pending = {}
+        self.retrying = set()
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.stream = zmq.eventloop.zmqstream.ZMQStream(
+            self.socket,
+            self.ioloop,
+        )
+        self.stream.on_recv(self.zmq_listener, copy=False)
+
+    def register(self, identity, kernel):
+        self.kernels[identity] = kernel
+
+    def unregister(self, identity):
+        self.kernels.pop(identity, None)
+        self.pending.pop(identity, None)
+
+    def send(self, identity, *frames):
+        """Send to a kernel.
+
+        Messages to a registered kernel that is not connected or whose
+        queue is full are queued.
+
+        :raises zmq.ZMQError: When no kernel with this identity is connected
+            or registered.
+        """
+        if self.socket.closed:
+            # e.g. kernels of a closed app that are still supervised
+            log.debug('router closed, dropping message to kernel {}'
+                      ''.format(identity))
+            return
+        multipart = [identity] + list(frames)
+        if identity in self.pending:
+            self.queue(identity, multipart)
+            return
+        try:
+            self.socket.send_multipart(multipart, zmq.NOBLOCK)
+        except zmq.ZMQError as e:
+            if identity not in self.kernels:
+                raise
+            if e.errno == zmq.EAGAIN:
+                metrics.kernel_messages_queued.inc(reason='full')
+                self.retry(identity)
+            elif e.errno == zmq.EHOSTUNREACH:
+                metrics.kernel_messages_queued.inc(reason='unreachable')
+            else:
+                raise
+            self.queue(identity, multipart)
+
+    def queue(self, identity, multipart):
+        pending = self.pending.setdefault(identity, deque())
+        if len(pending) >= MAX_PENDING:
+            log.warning('Dropping a message to kernel {}. {} messages are '
+                        'waiting for it.'.format(identity, len(pending)))
+            return
+        pending.append(multipart)
+
+    def retry(self, identity):
+        """Send the queued messages of a kernel again later."""
+        if identity in self.retrying:
+            return
+        self.retrying.add(identity)
+
+        def flush():
+            self.retrying.discard(identity)
+            self.flush(identity)
+        self.ioloop.call_later(RETRY_INTERVAL, flush)
+
+    def flush(self, identity):
+        """Send the queued messages of a kernel while it receives them."""
+        pending = self.pending.get(identity)
+        while pending and not self.socket.closed:
+            try:
+                self.socket.send_multipart(pending[0], zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EAGAIN:
+                    self.retry(identity)
+                elif e.errno != zmq.EHOSTUNREACH:
+                    raise
+                return
+            pending.popleft()
+        self.pending.pop(identity, None)
+
+    def zmq_listener(self, multipart):
+        identity = multipart[0].bytes
+        kernel = self.kernels.get(identity)
+        if kernel is None:
+            log.debug('message from unknown kernel {}'.format(identity))
+            return
+        # the kernel is connected
+        self.flush(identity)
+        kernel.zmq_listener(multipart[1:])
+
+    def close(self):
+        self.stream.close()
+
+
+class ForkedProcess(object):
+    """A kernel process forked by a :class:`Zygote`.
+
+    The process id is known once the zygote replied. A process that is
+    terminated before that is terminated as soon as it is known.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.terminated = False
+        self.failed = False
+
+    def started(self, pid):
+        self.pid = pid
+        self.failed = pid is None
+        if self.terminated:
+            self.terminate()
+
+    def poll(self):
+        """``None`` while the process is running and ``-1`` afterwards.
+
+        The exit code is collected by the zygote and is not known here.
+        """
+        if self.pid is None:
+            return -1 if self.failed else None
+        try:
+            os.kill(self.pid, 0)
+        except OSError as e:
+            return -1 if e.errno == errno.ESRCH else None
+        return None
+
+    def terminate(self):
+        self.terminated = True
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+class Zygote(object):
+    """Process that forks new kernels of an analysis.
+
+    The zygote is a Python kernel started with ``--zygote``. It imports the
+    analysis and its dependencies once and then forks a new kernel for every
+    request it receives on its stdin. Forked kernels share the memory pages
+    of the zygote until they modify them.
+
+    :param list executable: Command to start a kernel.
+    :ivar bool ready: Whether the zygote finished importing the analysis.
+    """
+
+    def __init__(self, executable):
+        self.ready = False
+        self.pending = deque()
+
+        # the zygote replies with the process ids of forked kernels
+        replies_r, replies_w = os.pipe()
+        kwargs = {'pass_fds': (replies_w,)} if sys.version_info >= (3,) \
+            else {}
+        log.debug('launching zygote: {}'.format(executable))
+        self.process = subprocess.Popen(
+            executable + ['--zygote={}'.format(replies_w)],
+            stdin=subprocess.PIPE, shell=False, **kwargs)
+        os.close(replies_w)
+        self.replies = tornado.iostream.PipeIOStream(replies_r)
+        self.read_replies()
+
+        tornado.autoreload.add_reload_hook(self.close)
+        atexit.register(self.close)
+
+    @tornado.gen.coroutine
+    def read_replies(self):
+        try:
+            while True:
+                line = yield self.replies.read_until(b'\n')
+                if line == b'ready\n':
+                    log.debug('zygote ready')
+                    self.ready = True
+                    continue
+                self.pending.popleft().started(int(line))
+        except tornado.iostream.StreamClosedError:
+            pass
+
+        if self.process is not None:
+            log.warning('Zygote exited with {}.'.format(self.process.poll()))
+        self.ready = False
+        while self.pending:
+            self.pending.popleft().started(None)
+
+    def spawn(self, kernel_id, port_subscribe):
+        """Fork a new kernel.
+
+        :param str kernel_id: Analysis id the kernel starts with.
+        :param int port_subscribe: Port the kernel publishes to or ``None``
+            for kernels that connect to a :class:`KernelRouter`.
+        :rtype: ForkedProcess
+        """
+        process = ForkedProcess()
+        self.process.stdin.write(json.dumps({
+            'analysis_id': kernel_id,
+            'zmq_publish': port_subscribe,
+        }).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+        self.pending.append(process)
+        return process
+
+    def close(self):
+        """Stop the zygote. Forked kernels keep running."""
+        if self.process is None:
+            return
+        log.debug('stopping zygote')
+        process, self.process = self.process, None
+        self.ready = False
+        try:
+            # the zygote exits at the end of its stdin
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.replies.close()
+
+
+class KernelChannel(with_metaclass(abc.ABCMeta, object)):
+    """Messages to and from one analysis instance in a kernel.
+
+    Subclasses implement :meth:`publish` to send messages to the kernel.
+    Messages sent before the handshake completed are buffered and sent in
+    order once the kernel is ready.
+
+    Kernels that announce flow control in their handshake start with
+    ``KERNEL_CREDITS`` credits and use one for every message they send to
+    the frontend. A credit is granted back once the message was written to
+    the websocket (see :meth:`on_frame`), so a kernel cannot send faster
+    than the frontend receives.
+
+    :param str analysis_id: Analysis id.
+    :ivar tornado.concurrent.Future ready: Resolves when the kernel completed
+        the handshake for this analysis id.
+    :ivar tornado.concurrent.Future stopped: Resolves when the kernel
+        acknowledged ``disconnected`` for this analysis id.
+    :ivar bool acks_disconnect: Whether the kernel acknowledges
+        ``disconnected``. Announced in the handshake.
+    :ivar list encodings: Names of the encodings of forwarded messages that
+        the kernel can decode. Announced in the handshake.
+    :ivar bool flow_control: Whether the kernel waits for credits.
+        Announced in the handshake.
+    :ivar frozenset actions: Names of the action handlers of the analysis.
+        Announced in the handshake.
+    :ivar float last_active: Time of the last message to or from the
+        kernel for this analysis id.
+    """
+
+    def __init__(self, analysis_id):
+        self.id_ = analysis_id
+        self.listener = None
+        self.buffer = []
+        self.ready = tornado.concurrent.Future()
+        self.stopped = tornado.concurrent.Future()
+        self.acks_disconnect = False
+        self.encodings = [encoding.JSONEncoding.name]
+        self.actions = frozenset()
+        self.flow_control = False
+        self.granted = 0
+        self.last_active = time.time()
+
+    def send(self, data):
+        self.last_active = time.time()
+        if not self.ready.done():
+            self.buffer.append(data)
+            return
+        self.publish(self.id_, data)
+
+    @abc.abstractmethod
+    def publish(self, analysis_id, data):
+        """Send a message to the kernel.
+
+        :param str analysis_id: Analysis id the message is for.
+        :param data: The message or an :class:`.encoding.EncodedFrame`.
+        """
+
+    def on_handshake(self, msg):
+        self.acks_disconnect = msg.get('disconnect_ack', False)
+        self.encodings = msg.get('encodings', self.encodings)
+        self.actions = frozenset(msg.get('actions', ()))
+        # kernels send arrays as buffers if they can be decoded here
+        ack = {'__zmq_ack': None, 'buffers': encoding.np is not None}
+        self.flow_control = msg.get('credits', False)
+        if self.flow_control:
+            ack['credits'] = KERNEL_CREDITS
+        if msg.get('heartbeat'):
+            # kernels exit when they do not receive pings
+            ack['heartbeat'] = supervisor.orphan_timeout
+        self.publish(self.id_, ack)
+        if self.ready.done():
+            return
+        self.ready.set_result(self)
+        buffer, self.buffer = self.buffer, []
+        for data in buffer:
+            self.publish(self.id_, data)
+
+    def on_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(self)
+
+    def on_frame(self, written):
+        """Grant a credit once a message from the kernel was written.
+
+        :param written: The future returned by the emit to the frontend or
+            ``None`` if the message was not queued.
+        """
+        if not self.flow_control:
+            return
+        if written is None:
+            self.grant()
+            return
+        tornado.concurrent.future_add_done_callback(
+            written, lambda _: self.grant())
+
+    def grant(self):
+        # grant credits in batches
+        self.granted += 1
+        if self.granted < max(1, KERNEL_CREDITS // 4):
+            return
+        granted, self.granted = self.granted, 0
+        self.publish(self.id_, {'__credits': granted})
+
+
+class Kernel(KernelChannel):
+    """A language kernel process.
+
+    Starts the kernel process and listens for its messages. The kernel is
+    supervised by the :data:`~databench.supervisor.supervisor`.
+
+    :param list executable: Command to start the kernel.
+    :param zmq_publish: A :class:`KernelRouter` or a ZMQ stream to publish
+        messages to kernels for kernels that use PUB and SUB sockets.
+    :param str kernel_id: Analysis id the kernel starts with.
+    :param Zygote zygote: Optional zygote to fork the kernel from.
+    """
+
+    def __init__(self, executable, zmq_publish, kernel_id, zygote=None):
+        super(Kernel, self).__init__(kernel_id)
+        self.zmq_publish = zmq_publish
+        self.pool = None
+        self.multiplexer = None
+        self.identity = kernel_id.encode('utf-8')
+        self.heartbeat = False
+        self.last_pong = None
+
+        port_subscribe = None
+        if isinstance(zmq_publish, KernelRouter):
+            zmq_publish.register(self.identity, self)
+        else:
+            # zmq subscription to listen for messages from the kernel
+            self.zmq_sub = zmq.Context.instance().socket(zmq.SUB)
+            self.zmq_sub.setsockopt(zmq.SUBSCRIBE, b'')
+            port_subscribe = self.zmq_sub.bind_to_random_port(
+                'tcp://127.0.0.1',
+                min_port=3000, max_port=9000,
+            )
+            log.debug('main listening on port: {}'.format(port_subscribe))
+
+            self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(
+                self.zmq_sub,
+                tornado.ioloop.IOLoop.current(),
+            )
+            self.zmq_stream_sub.on_recv(self.zmq_listener, copy=False)
+
+        # launch the language kernel process
+        self.process = None
+        if zygote is not None and zygote.ready:
+            log.debug('forking kernel {}'.format(kernel_id))
+            try:
+                self.process = zygote.spawn(kernel_id, port_subscribe)
+            except (IOError, OSError):
+                log.warning('Could not fork kernel from zygote.')
+        if self.process is None:
+            e_params = executable + ['--analysis-id={}'.format(kernel_id)]
+            if port_subscribe is not None:
+                e_params.append('--zmq-publish={}'.format(port_subscribe))
+            log.debug('launching: {}'.format(e_params))
+            self.process = subprocess.Popen(e_params, shell=False)
+        metrics.kernels.inc()
+        supervisor.watch(self)
+
+    def channels(self):
+        """The analysis instances in this kernel."""
+        return [self]
+
+    def assign(self, analysis_id):
+        """Bind the kernel to a new analysis id.
+
+        The kernel subscribes to messages for the new id and completes a new
+        handshake. Only ready kernels can be assigned.
+        """
+        log.debug('assigning kernel {} to {}'.format(self.id_, analysis_id))
+        previous_id, self.id_ = self.id_, analysis_id
+        self.ready = tornado.concurrent.Future()
+        self.publish(previous_id, {'__assign': analysis_id})
+
+    def ping(self, seq):
+        self.publish(self.id_, {'__ping': seq})
+
+    def publish(self, analysis_id, data):
+        if isinstance(data, encoding.EncodedFrame) and \
+           data.encoding.name not in self.encodings:
+            data = data.decode()
+        if isinstance(data, encoding.EncodedFrame):
+            # forwarded from the frontend in a separate frame so that
+            # kernels do not read control messages from it
+            frames = ['{}|'.format(analysis_id).encode('utf-8'), data.data]
+        else:
+            frames = ['{}|{}'.format(analysis_id,
+                                     json.dumps(data)).encode('utf-8')]
+        if not isinstance(self.zmq_publish, KernelRouter):
+            self.zmq_publish.send_multipart(frames)
+            return
+        if self.process is None:
+            # terminated kernels are not registered with the router anymore
+            log.debug('kernel {} terminated, dropping message'
+                      ''.format(self.id_))
+            return
+        self.zmq_publish.send(self.identity, *frames)
+
+    @staticmethod
+    def decode(frames):
+        """Decode a message from a kernel.
+
+        The first frame is JSON. Messages for the frontend that are encoded by
+        the kernel have a ``__frame`` header with the signal and the encoded
+        message in the second frame, which is not decoded here. Otherwise,
+        further frames are buffers of arrays that are referenced in the JSON
+        (see :func:`.encoding.pack_buffers`).
+
+        :param list frames: `zmq.Frame` s of the message.
+        """
+        msg = json.loads(frames[0].bytes.decode('utf-8'))
+        if '__frame' in msg:
+            msg['__frame'] = encoding.EncodedFrame(
+                frames[1].bytes,
+                encoding.ENCODINGS.get(msg.get('encoding'),
+                                       encoding.JSONEncoding),
+                msg['__frame'],
+            )
+        elif len(frames) > 1:
+            msg = encoding.unpack_buffers(msg, [f.buffer for f in frames[1:]])
+        return msg
+
+    def zmq_listener(self, frames):
+        self.handle(self, self.decode(frames))
+
+    def handle(self, target, msg):
+        """Process a message for this kernel or one of its sessions."""
+        # zmq handshake (ignore handshakes for a previous analysis id)
+        if '__zmq_handshake' in msg:
+            if msg.get('analysis_id', target.id_) == target.id_:
+                self.heartbeat = msg.get('heartbeat', False)
+                target.on_handshake(msg)
+            return
+
+        if '__pong' in msg:
+            self.last_pong = time.time()
+            return
+
+        target.last_active = time.time()
+
+        if '__disconnected' in msg:
+            target.on_stopped()
+            return
+
+        if target.listener is not None:
+            target.listener(msg)
+
+    def terminate(self):
+        # In autoreload, this needs to be processed synchronously.
+        if self.process is None:
+            return
+        log.debug('terminating kernel process {}'.format(self.id_))
+        try:
+            self.process.terminate()
+        except OSError:
+            pass
+        supervisor.unwatch(self)
+        self.process = None
+        metrics.kernels.dec()
+        if isinstance(self.zmq_publish, KernelRouter):
+            self.zmq_publish.unregister(self.identity)
+        else:
+            self.zmq_stream_sub.close()
+        self.listener = None
+        if self.pool is not None:
+            self.pool.discard(self)
+        if self.multiplexer is not None:
+            self.multiplexer.discard(self)
+
+    def reap(self):
+        """End the analysis instance in this kernel."""
+        self.terminate()
+
+
+class KernelSession(KernelChannel):
+    """An analysis instance in a :class:`MultiplexKernel`.
+
+    Provides the interface of :class:`Kernel` to :class:`AnalysisZMQ`.
+
+    :param MultiplexKernel kernel: The kernel hosting the instance.
+    :param str analysis_id: Analysis id.
+    """
+
+    def __init__(self, kernel, analysis_id):
+        super(KernelSession, self).__init__(analysis_id)
+        self.kernel = kernel
+
+    def publish(self, analysis_id, data):
+        self.kernel.publish(analysis_id, data)
+
+    def terminate(self):
+        self.listener = None
+        self.kernel.remove(self)
+
+    def reap(self):
+        """End this analysis instance and keep the kernel running."""
+        self.send({'signal': 'disconnected', 'load': '__nomessagetoken__'})
+        self.terminate()
+
+
+class MultiplexKernel(Kernel):
+    """A kernel process hosting many analysis instances.
+
+    The kernel is started with ``--multiplex``. Analysis instances are added
+    with :meth:`add` and the kernel removes them when they receive
+    ``disconnected``. Messages are routed by their analysis id.
+
+    :param list executable: Command to start the kernel.
+    :param zmq_publish: See :class:`Kernel`.
+    :param str kernel_id: Id of the kernel.
+    """
+
+    def __init__(self, executable, zmq_publish, kernel_id):
+        self.sessions = {}
+        super(MultiplexKernel, self).__init__(
+            executable + ['--multiplex'], zmq_publish, kernel_id)
+
+    def add(self, analysis_id):
+        """Create an analysis instance in this kernel.
+
+        :rtype: KernelSession
+        """
+        session = KernelSession(self, analysis_id)
+        self.sessions[analysis_id] = session
+        self.send({'__add': analysis_id})
+        return session
+
+    def remove(self, session):
+        if self.sessions.get(session.id_) is session:
+            del self.sessions[session.id_]
+
+    def channels(self):
+        return list(self.sessions.values())
+
+    def zmq_listener(self, frames):
+        msg = self.decode(frames)
+        self.handle(self.sessions.get(msg.get('analysis_id'), self), msg)
+
+
+class Multiplexer(object):
+    """Multiplexing kernels of an analysis.
+
+    New analysis instances are added to the kernel with the fewest
+    instances. Kernels that end are replaced.
+
+    :param str name: Name of the analysis.
+    :param list executable: Command to start a kernel.
+    :param zmq_publish: See :class:`Kernel`.
+    :param int size: Number of kernel processes.
+    """
+
+    def __init__(self, name, executable, zmq_publish, size=1):
+        self.name = name
+        self.executable = executable
+        self.zmq_publish = zmq_publish
+        self.counter = 0
+        self.closed = False
+        self.kernels = [self.start_kernel() for _ in range(size)]
+
+        tornado.autoreload.add_reload_hook(self.close)
+        atexit.register(self.close)
+
+    def start_kernel(self):
+        self.counter += 1
+        kernel = MultiplexKernel(self.executable, self.zmq_publish,
+                                 '_mux-{}-{}'.format(self.name, self.counter))
+        kernel.multiplexer = self
+        return kernel
+
+    def discard(self, kernel):
+        """Replace a terminated kernel."""
+        if self.closed or kernel not in self.kernels:
+            return
+        self.kernels[self.kernels.index(kernel)] = self.start_kernel()
+
+    def add(self, analysis_id):
+        """Create an analysis instance in one of the kernels.
+
+        :rtype: KernelSession
+        """
+        kernels = [k for k in self.kernels if k.ready.done()] or self.kernels
+        kernel = min(kernels, key=lambda k: len(k.sessions))
+        log.debug('adding {} to kernel {}'.format(analysis_id, kernel.id_))
+        return kernel.add(analysis_id)
+
+    def close(self):
+        """Terminate all kernels."""
+        self.closed = True
+        for kernel in self.kernels:
+            kernel.terminate()
+
+
+class KernelPool(object):
+    """Pre-started kernels of an analysis.
+
+    Keeps ``min_idle`` kernels started and handshaken. A new connection is
+    bound to an idle kernel with :meth:`Kernel.assign` and the pool is
+    refilled in the background. The kernel is not returned to the pool
+    when the connection ends.
+
+    :param str name: Name of the analysis.
+    :param list executable: Command to start a kernel.
+    :param zmq_publish: See :class:`Kernel`.
+    :param int min_idle: Number of idle kernels to keep.
+    :param int max_size: Maximum number of kernels started by this pool
+        that are running at the same time (idle or bound) or ``None``.
+    :param Zygote zygote: Optional zygote to fork kernels from.
+    """
+
+    def __init__(self, name, executable, zmq_publish, min_idle=1,
+                 max_size=None, zygote=None):
+        self.name = name
+        self.executable = executable
+        self.zmq_publish = zmq_publish
+        self.min_idle = min_idle
+        self.max_size = max_size
+        self.zygote = zygote
+
+        self.idle = deque()
+        self.size = 0
+        self.counter = 0
+        self.closed = False
+
+        tornado.autoreload.add_reload_hook(self.close)
+        atexit.register(self.close)
+
+    def fill(self):
+        """Start kernels until there are ``min_idle`` idle kernels."""
+        while not self.closed and len(self.idle) < self.min_idle and \
+                (self.max_size is None or self.size < self.max_size):
+            self.counter += 1
+            kernel = Kernel(self.executable, self.zmq_publish,
+                            '_pool-{}-{}'.format(self.name, self.counter),
+                            self.zygote)
+            kernel.pool = self
+            self.size += 1
+            self.idle.append(kernel)
+        metrics.kernels_idle.set(len(self.idle), analysis=self.name)
+
+    def acquire(self):
+        """Take an idle kernel.
+
+        Only kernels that completed their handshake are taken.
+
+        :returns: A kernel or ``None`` if no idle kernel is ready.
+        :rtype: Kernel
+        """
+        kernel = next((k for k in self.idle if k.ready.done()), None)
+        if kernel is not None:
+            self.idle.remove(kernel)
+        tornado.ioloop.IOLoop.current().add_callback(self.fill)
+        return kernel
+
+    def discard(self, kernel):
+        """Remove a terminated kernel."""
+        self.size -= 1
+        if kernel in self.idle:
+            self.idle.remove(kernel)
+        if not self.closed:
+            tornado.ioloop.IOLoop.current().add_callback(self.fill)
+
+    def close(self):
+        """Terminate all idle kernels."""
+        self.closed = True
+        for kernel in list(self.idle):
+            kernel.terminate()
+        metrics.kernels_idle.set(0, analysis=self.name)
+
 
 class AnalysisZMQ(Analysis):
     def __init__(self):
@@ -16,81 +768,120 @@ class AnalysisZMQ(Analysis):
 
     def init_databench(self, id_):
         super(AnalysisZMQ, self).init_databench(id_)
-        self.zmq_handshake = False
+        self.kernel = None
+        self.frame_encoding = None
+        self.connect_args = None
+        self.startup = []
+        self.restarts = 0
         return self
 
-    def on_connect(self, executable, zmq_publish):
-        self.zmq_publish = zmq_publish
+    @property
+    def zmq_handshake(self):
+        return self.kernel is not None and self.kernel.ready.done()
 
-        # determine a port_subscribe
-        context = zmq.Context()
-        socket = context.socket(zmq.PUB)
-        port_subscribe = socket.bind_to_random_port(
-            'tcp://127.0.0.1',
-            min_port=3000, max_port=9000,
-        )
-        socket.close()
-        context.destroy()
-        log.debug('determined: port_subscribe={}'.format(port_subscribe))
-
-        # zmq subscription to listen for messages from backend
-        log.debug('main listening on port: {}'.format(port_subscribe))
-        self.zmq_sub_ctx = zmq.Context()
-        self.zmq_sub = self.zmq_sub_ctx.socket(zmq.SUB)
-        self.zmq_sub.setsockopt(zmq.SUBSCRIBE, b'')
-        self.zmq_sub.bind('tcp://127.0.0.1:{}'.format(port_subscribe))
-
-        self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(
-            self.zmq_sub,
-            tornado.ioloop.IOLoop.current(),
-        )
-        self.zmq_stream_sub.on_recv(self.zmq_listener)
+    def on_connect(self, executable, zmq_publish, pool=None, zygote=None,
+                   multiplexer=None):
+        """Start a kernel or take one from the pool.
 
-        # launch the language kernel process
-        e_params = executable + [
-            '--analysis-id={}'.format(self.id_),
-            '--zmq-publish={}'.format(port_subscribe),
-        ]
-        log.debug('launching: {}'.format(e_params))
-        self.kernel_process = subprocess.Popen(e_params, shell=False)
+        :param list executable: Command to start a kernel.
+        :param zmq_publish: See :class:`Kernel`.
+        :param KernelPool pool: Optional pool of idle kernels.
+        :param Zygote zygote: Optional zygote to fork a new kernel from.
+        :param Multiplexer multiplexer: Optional multiplexing kernels to add
+            this analysis instance to instead of starting a kernel.
+        """
+        self.connect_args = (executable, zmq_publish, pool, zygote,
+                             multiplexer)
+        if multiplexer is not None:
+            kernel = multiplexer.add(self.id_)
+        else:
+            kernel = pool.acquire() if pool is not None else None
+            if kernel is None:
+                kernel = Kernel(executable, zmq_publish, self.id_, zygote)
+            else:
+                kernel.assign(self.id_)
+        kernel.listener = self.zmq_listener
+        self.kernel = kernel
+        if self.frame_encoding is not None:
+            self.kernel.send({'__frames': self.frame_encoding.name})
         log.debug('finished on_connect for {}'.format(self.id_))
 
-    def on_disconnected(self):
-        # In autoreload, this callback needs to be processed synchronously.
-        log.debug('terminating kernel process {}'.format(self.id_))
-        if self.kernel_process is not None:
-            try:
-                self.kernel_process.terminate()
-            except subprocess.OSError:
-                pass
-        self.zmq_stream_sub.close()
-        self.zmq_sub.close()
-        self.zmq_sub_ctx.destroy()
-        self.zmq_handshake = False
+    def set_frame_encoding(self, encoding):
+        """Let the kernel encode messages for the frontend.
 
-    def zmq_send(self, data):
-        self.zmq_publish.send('{}|{}'.format(
-            self.id_,
-            json.dumps(data),
-        ).encode('utf-8'))
+        :param encoding: Encoding negotiated by the frontend, e.g.
+            :class:`~databench.encoding.JSONEncoding`.
+        """
+        self.frame_encoding = encoding
+        if self.kernel is not None:
+            self.kernel.send({'__frames': encoding.name})
 
-    def zmq_listener(self, multipart):
-        # log.debug('main received multipart: {}'.format(multipart))
-        msg = json.loads((b''.join(multipart)).decode('utf-8'))
+    def on_disconnected(self):
+        if self.kernel is not None:
+            self.kernel.terminate()
+            self.kernel = None
 
-        # zmq handshake
-        if '__zmq_handshake' in msg:
-            self.zmq_handshake = True
-            self.zmq_send({'__zmq_ack': None})
+    def on_kernel_event(self, event):
+        """Report a kernel lifecycle event to the frontend.
+
+        The kernel of this analysis instance ended. It is restarted with the
+        actions that initialized the instance if
+        :attr:`~databench.supervisor.KernelSupervisor.max_restarts` allows
+        it. The state of the instance in the kernel is lost.
+        """
+        self.emit('__kernel', event)
+        self.kernel = None
+        if event['status'] == 'idle' or self.connect_args is None or \
+           self.restarts >= supervisor.max_restarts:
             return
 
+        self.restarts += 1
+        log.info('Restarting kernel of {}.'.format(self.id_))
+        metrics.kernel_events.inc(event='restarted')
+        self.on_connect(*self.connect_args)
+        for data in self.startup:
+            self.kernel.send(data)
+        self.emit('__kernel', {'status': 'restarted',
+                               'restarts': self.restarts})
+
+    def zmq_send(self, data):
+        # actions that initialize the instance are repeated after restarts
+        if isinstance(data, dict) and \
+           data.get('signal') in ('connect', 'args', 'connected'):
+            self.startup.append(data)
+        self.kernel.send(data)
+
+    def zmq_listener(self, msg):
         # check message is for this analysis
         if 'analysis_id' not in msg or \
            msg['analysis_id'] != self.id_:
             return
 
+        # the kernel ended
+        if '__kernel' in msg:
+            self.on_kernel_event(msg['__kernel'])
+            return
+
+        # profiling results from the kernel
+        if '__profile' in msg:
+            profiler.add(profiler.decode(msg['__profile']))
+            return
+
+        # encoded by the kernel: forward without decoding
+        if '__frame' in msg:
+            frame = msg['__frame']
+            if frame.signal in ('log', 'warn', 'error'):
+                # logged in this process too
+                written = self.emit(frame.signal, frame.decode().get('load'))
+            else:
+                written = self.emit(frame.signal, frame)
         # execute callback
-        if 'frame' in msg and \
-           'signal' in msg['frame'] and \
-           'load' in msg['frame']:
-            self.emit(msg['frame']['signal'], msg['frame']['load'])
+        elif 'frame' in msg and \
+                'signal' in msg['frame'] and \
+                'load' in msg['frame']:
+            written = self.emit(msg['frame']['signal'], msg['frame']['load'])
+        else:
+            return
+
+        if self.kernel is not None:
+            self.kernel.on_frame(written)
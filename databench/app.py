@@ -3,18 +3,28 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import __version__ as DATABENCH_VERSION
-from .meta import Meta
+from .analysis_zmq import KernelRouter
+from . import assets
+from .assets import StaticHandler
+from .meta import LazyMeta, Meta
 from .meta_zmq import MetaZMQ
-from .readme import Readme
-from .template import Loader
+from . import profiling
+from .metrics import MetricsHandler
+from .readme import Readme, render_readmes
+from .supervisor import supervisor
+from .template import Loader, page_cache
+import atexit
+import functools
 import glob
 import importlib
 import io
 import logging
 import os
 import random
+import shutil
 import subprocess
 import sys
+import tempfile
 import tornado.autoreload
 import tornado.web
 import yaml
@@ -25,9 +35,18 @@ try:
 except ImportError:
     glob2 = None
 
+try:
+    from importlib.util import find_spec
+except ImportError:
+    # Python 2
+    from pkgutil import find_loader as find_spec
+
 zmq.eventloop.ioloop.install()
 log = logging.getLogger(__name__)
 
+STATIC_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           'static')
+
 
 class App(object):
     """Databench app. Creates a Tornado app.
@@ -36,10 +55,14 @@ class App(object):
     :param int zmq_port: Force to use the given ZMQ port for publishing.
     :param list cli_args: Command line arguments.
     :param bool debug: Switch on debugging.
+    :param str zmq_transport: ``tcp`` or ``ipc`` for the connection of
+        Python kernels.
+    :param int zmq_hwm: High-water mark of the ZMQ sockets between the
+        server and kernels or ``None`` for the ZMQ default.
     """
 
     def __init__(self, analyses_path=None, zmq_port=None, cli_args=None,
-                 debug=False):
+                 debug=False, zmq_transport='tcp', zmq_hwm=None):
         self.cli_args = cli_args
         self.debug = debug
 
@@ -58,31 +81,43 @@ class App(object):
         self.routes = [
             (r'/(?:index.html)?', IndexHandler,
              {'info': self.info, 'metas': self.metas}),
+            (r'/metrics', MetricsHandler),
         ]
 
-        self.init_zmq(zmq_port)
+        if profiling.profiler.sample_rate:
+            self.routes += profiling.routes
+
+        self.init_zmq(zmq_port, zmq_transport, zmq_hwm)
         self.analyses_info()
         self.meta_analyses()
         self.register_metas()
         self.routes += self.static_routes(self.analyses_path,
                                           self.info['static'])
 
-    def init_zmq(self, zmq_port=None):
-        # check whether we have to determine zmq_port ourselves first
+    def init_zmq(self, zmq_port=None, zmq_transport='tcp', zmq_hwm=None):
+        # Python kernels connect to a ROUTER socket
+        if zmq_transport == 'ipc':
+            ipc_dir = tempfile.mkdtemp(prefix='databench-')
+            atexit.register(shutil.rmtree, ipc_dir, True)
+            address = 'ipc://{}'.format(os.path.join(ipc_dir, 'kernels'))
+        elif zmq_transport == 'tcp':
+            address = 'tcp://127.0.0.1'
+        else:
+            raise ValueError('unknown zmq transport {}'.format(zmq_transport))
+        self.zmq_hwm = zmq_hwm
+        self.kernel_router = KernelRouter(address, hwm=zmq_hwm)
+
+        # other kernels subscribe to a PUB socket
+        self.zmq_pub = zmq.Context.instance().socket(zmq.PUB)
+        if zmq_hwm is not None:
+            self.zmq_pub.setsockopt(zmq.SNDHWM, zmq_hwm)
         if zmq_port is None:
-            context = zmq.Context()
-            socket = context.socket(zmq.PUB)
-            zmq_port = socket.bind_to_random_port(
+            zmq_port = self.zmq_pub.bind_to_random_port(
                 'tcp://127.0.0.1', min_port=6000,
             )
-            socket.close()
-            context.destroy()
-            log.debug('determined: zmq_port={}'.format(zmq_port))
+        else:
+            self.zmq_pub.bind('tcp://127.0.0.1:{}'.format(zmq_port))
         self.zmq_port = zmq_port
-
-        self.zmq_pub_ctx = zmq.Context()
-        self.zmq_pub = self.zmq_pub_ctx.socket(zmq.PUB)
-        self.zmq_pub.bind('tcp://127.0.0.1:{}'.format(zmq_port))
         log.debug('main publishing to port {}'.format(zmq_port))
 
         self.zmq_pub_stream = zmq.eventloop.zmqstream.ZMQStream(
@@ -118,22 +153,27 @@ class App(object):
             for item in group.items():
                 yield item
 
-    @classmethod
-    def static_routes(cls, analyses_path, static=None):
-        _static_path = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)), 'static')
+    @staticmethod
+    def static_settings():
+        """Settings for Databench's own static files.
 
-        routes = [
-            (r'/(favicon\.ico)', tornado.web.StaticFileHandler,
-             {'path': 'static/favicon.ico'}),
+        Tornado serves ``/_static/`` and ``/favicon.ico`` from
+        ``static_path`` and templates can create fingerprinted urls with
+        ``static_url()``.
+        """
+        return {
+            'static_path': STATIC_PATH,
+            'static_url_prefix': '/_static/',
+            'static_handler_class': StaticHandler,
+        }
 
-            (r'/_static/(.*)', tornado.web.StaticFileHandler,
-             {'path': _static_path}),
-        ]
+    @classmethod
+    def static_routes(cls, analyses_path, static=None):
+        routes = []
 
         # watch Databench's own static files
-        tornado.autoreload.watch(os.path.join(_static_path, 'databench.js'))
-        tornado.autoreload.watch(os.path.join(_static_path, 'databench.css'))
+        tornado.autoreload.watch(os.path.join(STATIC_PATH, 'databench.js'))
+        tornado.autoreload.watch(os.path.join(STATIC_PATH, 'databench.css'))
 
         # extra static files
         for extra_url, extra_path in cls.static_parser(static):
@@ -150,8 +190,7 @@ class App(object):
             # empty capture group
             static_regex = r'/{}'.format(extra_url)
             routes.append(
-                (static_regex, tornado.web.StaticFileHandler,
-                 {'path': static_path})
+                (static_regex, StaticHandler, {'path': static_path})
             )
 
         return routes
@@ -210,32 +249,39 @@ class App(object):
                 log.warning('directory {} not found'.format(path))
                 continue
 
-            meta = None
-            analysis_kernel = analysis_info.get('kernel', None)
-            if analysis_kernel is None:
-                meta = self.meta_analysis_nokernel(name, path)
-            elif analysis_kernel == 'py':
-                meta = self.meta_analysis_py(name, path)
-            elif analysis_kernel == 'pyspark':
-                meta = self.meta_analysis_pyspark(name, path)
-            elif analysis_kernel == 'go':
-                meta = self.meta_analysis_go(name, path)
-
-            if meta is None:
+            factory = {
+                None: self.meta_analysis_nokernel,
+                'py': self.meta_analysis_py,
+                'pyspark': self.meta_analysis_pyspark,
+                'go': self.meta_analysis_go,
+            }.get(analysis_info.get('kernel', None))
+            if factory is None:
                 continue
-            meta.info.update({'version': self.info['version'],
-                              'home_link': '/'})
-            meta.info.update(analysis_info)
-            self.metas.append(meta)
+            if factory == self.meta_analysis_nokernel:
+                if not self.find_analysis(name):
+                    log.warning('could not find analysis {}'.format(name))
+                    continue
 
-    def meta_analysis_nokernel(self, name, path):
+            info = {'version': self.info['version'], 'home_link': '/'}
+            info.update(analysis_info)
+            self.metas.append(LazyMeta(
+                name, path, info, functools.partial(factory, name, path)))
+
+    def find_analysis(self, name):
+        """Check that the module of an analysis exists without importing it.
+
+        :param str name: Name of the analysis.
+        :rtype: bool
+        """
+        module = '{}.{}.analysis'.format(self.analyses.__name__, name)
         try:
-            analysis_file = importlib.import_module('.' + name + '.analysis',
-                                                    self.analyses.__name__)
+            return find_spec(module) is not None
         except ImportError:
-            log.warning('could not import analysis {}'.format(name),
-                        exc_info=True)
-            return
+            return False
+
+    def meta_analysis_nokernel(self, name, path):
+        analysis_file = importlib.import_module('.' + name + '.analysis',
+                                                self.analyses.__name__)
         items = [getattr(analysis_file, item)
                  for item in dir(analysis_file)
                  if not item.startswith('__')]
@@ -253,26 +299,38 @@ class App(object):
             self.cli_args,
         )
 
+    def kernel_args(self):
+        """Command line arguments for Python kernels."""
+        args = ['--zmq-router={}'.format(self.kernel_router.address)]
+        if self.zmq_hwm is not None:
+            args.append('--zmq-hwm={}'.format(self.zmq_hwm))
+        return args + profiling.profiler.cli_args() + supervisor.cli_args()
+
     def meta_analysis_py(self, name, path):
         log.debug('creating MetaZMQ for {}'.format(name))
+        cmd = ['python', os.path.join(path, 'analysis.py')]
         return MetaZMQ(
             name,
-            ['python', os.path.join(path, 'analysis.py'),
-             '--zmq-subscribe={}'.format(self.zmq_port)],
-            self.zmq_pub_stream,
+            cmd + self.kernel_args(),
+            self.kernel_router,
             path,
             self.extra_routes(name, path),
+            supports_pool=True,
+            supports_zygote=True,
+            supports_frames=True,
         )
 
     def meta_analysis_pyspark(self, name, path):
         log.debug('creating MetaZMQ for {}'.format(name))
+        cmd = ['pyspark', '{}/analysis.py'.format(path)]
         return MetaZMQ(
             name,
-            ['pyspark', '{}/analysis.py'.format(path),
-             '--zmq-subscribe={}'.format(self.zmq_port)],
-            self.zmq_pub_stream,
+            cmd + self.kernel_args(),
+            self.kernel_router,
             path,
             self.extra_routes(name, path),
+            supports_pool=True,
+            supports_frames=True,
         )
 
     def meta_analysis_go(self, name, path):
@@ -312,10 +370,8 @@ class App(object):
         for meta in self.metas:
             log.debug('Registering meta information {}'.format(meta.name))
 
-            # grab routes
-            self.routes += [(r'/{}/{}'.format(meta.name, route),
-                             handler, data)
-                            for route, handler, data in meta.routes]
+            # routes are created on the first request
+            self.routes.append(meta.route())
 
         # process files to watch for autoreload
         if aggregated['watch']:
@@ -343,7 +399,11 @@ class App(object):
         self.build_cmds = aggregated['build']
 
     def build(self):
-        """Run the build command specified in index.yaml."""
+        """Run the build command specified in index.yaml.
+
+        Afterwards, compressed variants of static files are created and
+        the readmes are rendered into their cache.
+        """
         for cmd in self.build_cmds:
             log.info('building command: {}'.format(cmd))
             full_cmd = 'cd {}; {}'.format(self.analyses_path, cmd)
@@ -351,6 +411,20 @@ class App(object):
             subprocess.call(full_cmd, shell=True)
             log.info('build done')
 
+        assets.compress(self.static_paths())
+        analysis_paths = [meta.analysis_path for meta in self.metas]
+        render_readmes([self.analyses_path] + analysis_paths)
+
+    def static_paths(self):
+        """Files and directories with static files."""
+        paths = [STATIC_PATH]
+        for meta in self.metas:
+            paths += [os.path.join(meta.analysis_path, fn)
+                      for fn in ('analysis.js', 'analysis.css', 'static')]
+        paths += [data['path'] for _, _, data in self.static_routes(
+            self.analyses_path, self.info['static'])]
+        return [p for p in paths if os.path.exists(p)]
+
     def tornado_app(self, template_path=None, **kwargs):
         if template_path is None:
             template_path = os.path.join(
@@ -361,12 +435,17 @@ class App(object):
         if self.debug:
             self.build()
 
-        return tornado.web.Application(
+        settings = self.static_settings()
+        settings.update(kwargs)
+        application = tornado.web.Application(
             self.routes,
             debug=self.debug,
             template_loader=Loader([self.analyses_path, template_path]),
-            **kwargs
+            **settings
         )
+        for meta in self.metas:
+            meta.settings = application.settings
+        return application
 
 
 class IndexHandler(tornado.web.RequestHandler):
@@ -385,11 +464,15 @@ class IndexHandler(tornado.web.RequestHandler):
 
     def get(self):
         """Render the List-of-Analyses overview page."""
-        return self.render(
-            'index.html',
-            databench_version=DATABENCH_VERSION,
-            meta_infos=self.meta_infos(),
-            **self.info
+        # the info of analyses changes when they are materialized
+        key = ('index.html', self.info['version'],
+               tuple((meta.name, meta.info['version'], meta.materialized)
+                     for meta in self.metas))
+        return page_cache.render(
+            self, key, 'index.html',
+            lambda: dict(databench_version=DATABENCH_VERSION,
+                         meta_infos=self.meta_infos(),
+                         **self.info),
         )
 
     def head(self):
@@ -425,6 +508,8 @@ class SingleApp(object):
             info=info,
         )
         self.routes = App.static_routes(path, static) + [
+            (r'/metrics', MetricsHandler),
+        ] + (profiling.routes if profiling.profiler.sample_rate else []) + [
             (r'/{}'.format(route), handler, data)
             for route, handler, data in self.meta.routes]
 
@@ -435,9 +520,11 @@ class SingleApp(object):
                 'templates',
             )
 
+        settings = App.static_settings()
+        settings.update(kwargs)
         return tornado.web.Application(
             self.routes,
             debug=self.debug,
             template_loader=Loader([template_path]),
-            **kwargs
+            **settings
         )
@@ -0,0 +1,156 @@
+"""Precompressed and fingerprinted static assets.
+
+:func:`compress` writes gzip (and brotli, if the ``brotli`` package is
+installed) variants next to static files. It runs as part of
+:meth:`databench.App.build`. :class:`StaticHandler` serves these variants
+to clients that accept them.
+
+Fingerprinted urls are created with Tornado's ``static_url()`` in templates,
+e.g. ``{{ static_url('databench.css') }}``, which appends a hash of the
+content of the file. Responses to fingerprinted urls are cached by browsers
+as ``immutable``.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from io import BytesIO
+import gzip
+import logging
+import os
+import tornado.web
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+COMPRESS_EXTENSIONS = ('.css', '.html', '.js', '.json', '.map', '.svg',
+                       '.txt')
+# smaller files are not compressed
+MIN_SIZE = 256
+
+
+def compress_file(path):
+    """Write compressed variants of a file next to it.
+
+    Variants that are newer than the file are not rewritten.
+
+    :param str path: Path of the file.
+    :returns: Paths of the written variants.
+    :rtype: list
+    """
+    variants = [('.gz', gzip_bytes)]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress))
+
+    mtime = os.path.getmtime(path)
+    data = None
+    written = []
+    for suffix, compress_fn in variants:
+        variant = path + suffix
+        if os.path.exists(variant) and os.path.getmtime(variant) >= mtime:
+            continue
+
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        try:
+            with open(variant, 'wb') as f:
+                f.write(compress_fn(data))
+        except (IOError, OSError):
+            log.warning('Could not write {}.'.format(variant))
+            continue
+        written.append(variant)
+    return written
+
+
+def gzip_bytes(data):
+    # no file name and mtime in the header to keep the output reproducible
+    buf = BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=buf, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def compress(paths):
+    """Compress static files.
+
+    :param list paths: Files and directories. Directories are processed
+        recursively.
+    :returns: Paths of the written variants.
+    :rtype: list
+    """
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            files += [os.path.join(root, fn) for fn in filenames]
+
+    written = []
+    for fn in files:
+        if not fn.endswith(COMPRESS_EXTENSIONS) or \
+           os.path.getsize(fn) < MIN_SIZE:
+            continue
+        written += compress_file(fn)
+    if written:
+        log.info('Compressed {} static files.'.format(len(written)))
+    return written
+
+
+class StaticHandler(tornado.web.StaticFileHandler):
+    """Static file handler serving precompressed variants.
+
+    Serves ``<file>.br`` or ``<file>.gz`` instead of ``<file>`` when the
+    client accepts the encoding and the variant is not older than the file.
+    Responses to versioned urls (with a ``v`` argument) are ``immutable``.
+    """
+    ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+    def initialize(self, path, default_filename=None):
+        super(StaticHandler, self).initialize(path, default_filename)
+        self.content_encoding = None
+        self.original_path = None
+
+    def accepted_encodings(self):
+        header = self.request.headers.get('Accept-Encoding', '')
+        return set(e.split(';')[0].strip() for e in header.split(','))
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(StaticHandler, self).validate_absolute_path(
+            root, absolute_path)
+        if absolute_path is None:
+            return None
+
+        self.original_path = absolute_path
+        accepted = self.accepted_encodings()
+        for encoding, suffix in self.ENCODINGS:
+            variant = absolute_path + suffix
+            if encoding in accepted and os.path.isfile(variant) and \
+               os.path.getmtime(variant) >= os.path.getmtime(absolute_path):
+                self.content_encoding = encoding
+                return variant
+        return absolute_path
+
+    def get_content_type(self):
+        if self.content_encoding is None:
+            return super(StaticHandler, self).get_content_type()
+
+        # the content type of the original file
+        variant, self.absolute_path = self.absolute_path, self.original_path
+        try:
+            return super(StaticHandler, self).get_content_type()
+        finally:
+            self.absolute_path = variant
+
+    def set_extra_headers(self, path):
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.content_encoding is not None:
+            self.set_header('Content-Encoding', self.content_encoding)
+        if 'v' in self.request.arguments:
+            self.set_header('Cache-Control', 'max-age={}, public, immutable'
+                            ''.format(self.CACHE_MAX_AGE))
@@ -11,6 +11,7 @@ import os
 import ssl
 import sys
 import tornado
+import tornado.httpserver
 
 
 def main(**kwargs):
@@ -40,6 +41,103 @@ def main(**kwargs):
     parser.add_argument('--coverage', default=False,
                         help=argparse.SUPPRESS)
 
+    profile_args = parser.add_argument_group('Profiling')
+    profile_args.add_argument('--profile-sample-rate', dest='profile_rate',
+                              type=float, default=0.0,
+                              help=('fraction of action invocations to '
+                                    'profile (default 0, disabled)'))
+    profile_args.add_argument('--profile-mode', dest='profile_mode',
+                              default='cprofile',
+                              choices=('cprofile', 'sample'),
+                              help='cProfile or stack sampling')
+
+    parser.add_argument('--block-threshold', dest='block_threshold',
+                        type=float, default=None,
+                        help=('report handlers that block the event loop '
+                              'longer than this many ms (default disabled)'))
+
+    parser.add_argument('--max-loop-lag', dest='max_loop_lag',
+                        type=float, default=0.0,
+                        help=('reject new connections while the event loop '
+                              'lags more than this many ms (default 0, '
+                              'disabled; requires --block-threshold)'))
+
+    scheduler_args = parser.add_argument_group('Scheduling')
+    scheduler_args.add_argument('--max-concurrent-actions',
+                                dest='max_concurrent', type=int, default=None,
+                                help=('actions running concurrently across '
+                                      'all connections (default unlimited)'))
+    scheduler_args.add_argument('--max-actions-per-connection',
+                                dest='per_connection', type=int, default=1,
+                                help=('actions running concurrently per '
+                                      'connection (default 1, 0 for '
+                                      'unlimited)'))
+    scheduler_args.add_argument('--max-message-rate', dest='rate',
+                                type=float, default=None,
+                                help=('average messages per second per '
+                                      'connection (default unlimited)'))
+
+    scaling_args = parser.add_argument_group('Scaling')
+    scaling_args.add_argument('--workers', dest='workers', type=int,
+                              default=1,
+                              help=('number of worker processes sharing the '
+                                    'listening sockets (default 1, 0 for one '
+                                    'per CPU)'))
+    scaling_args.add_argument('--worker-port-base', dest='worker_port_base',
+                              type=int, default=None,
+                              help=('worker N also listens on this port + N '
+                                    'for routing'))
+    scaling_args.add_argument('--node-id', dest='node_id', default=None,
+                              help='id of this node encoded in analysis ids')
+    scaling_args.add_argument('--router', dest='router', nargs='+',
+                              metavar='NAME=URL', default=None,
+                              help=('run as router forwarding to the given '
+                                    'backends'))
+    scaling_args.add_argument('--router-allowed-origin',
+                              dest='router_allowed_origins', nargs='+',
+                              metavar='HOST', default=None,
+                              help=('hosts of other origins that may open '
+                                    'websockets through the router'))
+    scaling_args.add_argument('--zmq-transport', dest='zmq_transport',
+                              choices=('tcp', 'ipc'), default='tcp',
+                              help=('transport between the server and Python '
+                                    'kernels (default tcp)'))
+    scaling_args.add_argument('--zmq-hwm', dest='zmq_hwm', type=int,
+                              default=None,
+                              help=('high-water mark of the ZMQ sockets '
+                                    'between the server and kernels'))
+
+    kernel_args = parser.add_argument_group('Kernels')
+    kernel_args.add_argument('--kernel-check-interval',
+                             dest='kernel_interval', type=float, default=5.0,
+                             help=('seconds between checks and heartbeats '
+                                   'of kernels (default 5)'))
+    kernel_args.add_argument('--kernel-heartbeat-timeout',
+                             dest='kernel_heartbeat_timeout', type=float,
+                             default=0.0,
+                             help=('terminate kernels that did not answer '
+                                   'heartbeats for this many seconds '
+                                   '(default 0, disabled)'))
+    kernel_args.add_argument('--kernel-idle-timeout',
+                             dest='kernel_idle_timeout', type=float,
+                             default=0.0,
+                             help=('end analysis instances in kernels '
+                                   'without messages for this many seconds '
+                                   '(default 0, disabled)'))
+    kernel_args.add_argument('--kernel-max-rss', dest='kernel_max_rss',
+                             type=int, default=0,
+                             help=('terminate kernels using more than this '
+                                   'many MB of memory (default 0, disabled)'))
+    kernel_args.add_argument('--kernel-rlimit-as', dest='kernel_rlimit_as',
+                             type=int, default=0,
+                             help=('address space limit of Python kernels '
+                                   'in MB (default 0, unlimited)'))
+    kernel_args.add_argument('--kernel-restarts', dest='kernel_restarts',
+                             type=int, default=0,
+                             help=('restart the kernel of an analysis '
+                                   'instance this many times after it ended '
+                                   '(default 0)'))
+
     ssl_args = parser.add_argument_group('SSL')
     ssl_args.add_argument('--ssl-certfile', dest='ssl_certfile',
                           help='SSL certificate file')
@@ -60,6 +158,8 @@ def main(**kwargs):
 
     # this is included here so that is included in coverage
     from .app import App, SingleApp
+    from .profiling import profiler
+    from .supervisor import supervisor
 
     # log
     logging.basicConfig(level=getattr(logging, args.loglevel))
@@ -77,8 +177,45 @@ def main(**kwargs):
     if analyses_args:
         logging.debug('Arguments passed to analyses: {}'.format(analyses_args))
 
+    if args.profile_rate:
+        logging.info('Profiling {:.1%} of actions with {}. Results at '
+                     '/_profile.'.format(args.profile_rate, args.profile_mode))
+        profiler.configure(args.profile_rate, args.profile_mode)
+
+    supervisor.configure(
+        interval=args.kernel_interval,
+        heartbeat_timeout=args.kernel_heartbeat_timeout,
+        idle_timeout=args.kernel_idle_timeout,
+        max_rss=args.kernel_max_rss * 1024 * 1024,
+        rlimit_as=args.kernel_rlimit_as * 1024 * 1024,
+        max_restarts=args.kernel_restarts,
+    )
+
+    if args.router:
+        from .router import Router
+        router = Router(Router.parse(args.router),
+                        args.router_allowed_origins)
+        logging.info('Routing to {}.'.format(
+            ', '.join('{}={}'.format(n, u)
+                      for n, u in router.backends.items())))
+        router.tornado_app().listen(args.port, args.host)
+        tornado.ioloop.IOLoop.current().start()
+        return
+
+    from . import workers
+    workers.set_node_id(args.node_id)
+
+    sockets = None
+    if args.workers != 1 and not args.build:
+        if args.watch:
+            logging.info('Disabled watching files with multiple workers.')
+            args.watch = False
+        ports = [args.port] + ([args.ssl_port] if args.ssl_port else [])
+        sockets = workers.start(args.workers, ports, args.host)
+
     if not kwargs:
-        app = App(args.analyses, cli_args=analyses_args, debug=args.watch)
+        app = App(args.analyses, cli_args=analyses_args, debug=args.watch,
+                  zmq_transport=args.zmq_transport, zmq_hwm=args.zmq_hwm)
     else:
         app = SingleApp(cli_args=analyses_args, debug=args.watch, **kwargs)
 
@@ -93,7 +230,14 @@ def main(**kwargs):
 
     # HTTP server
     tornado_app = app.tornado_app()
-    tornado_app.listen(args.port, args.host)
+    if sockets is None:
+        tornado_app.listen(args.port, args.host)
+    else:
+        server = tornado.httpserver.HTTPServer(tornado_app)
+        server.add_sockets(sockets[0])
+        if args.worker_port_base is not None:
+            tornado_app.listen(args.worker_port_base + workers.worker_id,
+                               args.host)
 
     # HTTPS server
     if args.ssl_port:
@@ -110,7 +254,26 @@ def main(**kwargs):
 
         logging.info('Open https://{}:{} in a web browser.'
                      ''.format(args.host, args.ssl_port))
-        tornado_app.listen(args.ssl_port, ssl_options=ssl_ctx)
+        if sockets is None:
+            tornado_app.listen(args.ssl_port, ssl_options=ssl_ctx)
+        else:
+            server = tornado.httpserver.HTTPServer(tornado_app,
+                                                   ssl_options=ssl_ctx)
+            server.add_sockets(sockets[1])
+
+    if args.block_threshold:
+        from .watchdog import watchdog
+        watchdog.threshold = args.block_threshold / 1000.0
+        watchdog.start()
+
+    from .scheduler import scheduler
+    scheduler.configure(max_concurrent=args.max_concurrent,
+                        per_connection=args.per_connection or None,
+                        rate=args.rate)
+
+    if args.max_loop_lag:
+        from . import admission
+        admission.MAX_LOOP_LAG = args.max_loop_lag / 1000.0
 
     try:
         tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,210 @@
+"""Registries of open frontend connections and of resumable sessions."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+import logging
+import time
+import tornado.autoreload
+import tornado.ioloop
+
+PING_INTERVAL = 15000
+IDLE_TIMEOUT = 3 * PING_INTERVAL
+WHEEL_SLOTS = 15
+log = logging.getLogger(__name__)
+
+
+class ConnectionRegistry(object):
+    """Registry of all open websocket connections of this process.
+
+    A single timer wheel sends heartbeats and detects idle connections for
+    all registered connections: every connection is assigned to one of
+    ``slots`` slots and every tick processes the connections of one slot.
+    That way, every connection is pinged once per ``ping_interval``
+    without a timer per connection.
+
+    A single autoreload hook closes all registered connections.
+
+    :param int ping_interval: Interval between pings in milliseconds.
+    :param int idle_timeout:
+        Close connections that have not sent a message or pong for this
+        many milliseconds. ``None`` disables idle detection.
+    :param int slots: Number of slots in the timer wheel.
+    """
+
+    def __init__(self, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 slots=WHEEL_SLOTS):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = [set() for _ in range(slots)]
+        self.connections = {}  # handler -> slot
+        self.next_slot = 0
+        self.current_slot = 0
+
+        self.ioloop = None
+        self.periodic_callback = None
+        self.reload_hook = False
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(list(self.connections))
+
+    def register(self, handler):
+        """Register a connection.
+
+        :param databench.meta.FrontendHandler handler: Connection handler.
+        """
+        if handler in self.connections:
+            return
+
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.wheel)
+        self.wheel[slot].add(handler)
+        self.connections[handler] = slot
+        handler.last_active = time.time()
+
+        if not self.reload_hook:
+            tornado.autoreload.add_reload_hook(self.close_all)
+            self.reload_hook = True
+        self.start()
+
+    def unregister(self, handler):
+        """Remove a connection from the registry."""
+        slot = self.connections.pop(handler, None)
+        if slot is not None:
+            self.wheel[slot].discard(handler)
+        if not self.connections:
+            self.stop()
+
+    def start(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        if self.periodic_callback is not None and self.ioloop is ioloop:
+            return
+
+        self.stop()
+        self.ioloop = ioloop
+        self.periodic_callback = tornado.ioloop.PeriodicCallback(
+            self.tick, self.ping_interval / len(self.wheel))
+        self.periodic_callback.start()
+
+    def stop(self):
+        if self.periodic_callback is not None:
+            self.periodic_callback.stop()
+        self.periodic_callback = None
+        self.ioloop = None
+
+    def tick(self):
+        """Process the connections in the next slot of the timer wheel."""
+        self.current_slot = (self.current_slot + 1) % len(self.wheel)
+        now = time.time()
+        for handler in list(self.wheel[self.current_slot]):
+            if handler.ws_connection is None:
+                self.unregister(handler)
+                continue
+
+            idle = (now - handler.last_active) * 1000.0
+            if self.idle_timeout is not None and idle > self.idle_timeout:
+                log.info('Closing idle connection {}.'.format(
+                    handler.analysis_id()))
+                self.unregister(handler)
+                handler.close()
+                continue
+
+            handler.ping(b'ping')
+
+    def close_all(self):
+        """Run the close handlers of all connections.
+
+        Registered as an autoreload hook. The close handlers need to be
+        processed synchronously in that case.
+        """
+        for handler in self:
+            handler.reloading = True
+            handler.on_close()
+
+    def list(self):
+        """List information about all live connections.
+
+        :rtype: list
+        """
+        now = time.time()
+        return [{
+            'analysis': handler.meta.name,
+            'analysis_id': handler.analysis_id(),
+            'remote_ip': handler.request.remote_ip,
+            'opened': handler.opened,
+            'idle': now - handler.last_active,
+        } for handler in self]
+
+
+class SessionTable(object):
+    """Analysis instances of closed connections that can be resumed.
+
+    When a connection closes, its analysis instance is detached and kept
+    for a grace period. A new connection that requests the same analysis id
+    within that period resumes the instance instead of creating a new one.
+    Sessions that are not resumed expire and their expire callback is run
+    (usually the ``disconnected`` action).
+    """
+
+    def __init__(self):
+        # analysis id -> (analysis, owner, expire_fn, timeout)
+        self.sessions = {}
+        self.reload_hook = False
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, analysis_id):
+        return analysis_id in self.sessions
+
+    def detach(self, analysis, owner, grace, expire_fn):
+        """Keep a detached analysis instance.
+
+        :param databench.Analysis analysis: Analysis instance.
+        :param str owner: Name of the analysis the instance belongs to.
+        :param float grace: Grace period in seconds.
+        :param expire_fn: Called without arguments when the session expires.
+        """
+        log.debug('Detaching analysis {} for {}s.'.format(analysis.id_, grace))
+        timeout = tornado.ioloop.IOLoop.current().call_later(
+            grace, self.expire, analysis.id_)
+        self.sessions[analysis.id_] = (analysis, owner, expire_fn, timeout)
+
+        if not self.reload_hook:
+            tornado.autoreload.add_reload_hook(self.expire_all)
+            self.reload_hook = True
+
+    def resume(self, analysis_id, owner):
+        """Take a detached analysis instance.
+
+        :param str analysis_id: Requested analysis id.
+        :param str owner: Name of the analysis the instance belongs to.
+        :returns: The analysis instance or ``None`` if there is no session.
+        """
+        if analysis_id not in self.sessions or \
+           self.sessions[analysis_id][1] != owner:
+            return None
+
+        analysis, _, _, timeout = self.sessions.pop(analysis_id)
+        tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+        log.debug('Resuming analysis {}.'.format(analysis_id))
+        return analysis
+
+    def expire(self, analysis_id):
+        if analysis_id not in self.sessions:
+            return None
+
+        log.debug('Session of analysis {} expired.'.format(analysis_id))
+        _, _, expire_fn, _ = self.sessions.pop(analysis_id)
+        return expire_fn()
+
+    def expire_all(self):
+        """Expire all sessions. Registered as an autoreload hook."""
+        for analysis_id in list(self.sessions):
+            self.expire(analysis_id)
+
+
+registry = ConnectionRegistry()
+sessions = SessionTable()
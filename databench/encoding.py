@@ -0,0 +1,229 @@
+"""Message encodings for the websocket protocol.
+
+The frontend lists the encodings it understands in its ``__connect``
+message and the backend picks the first one that it supports. JSON is
+always available and is the fallback. Binary encodings are only
+available when their optional Python package is installed.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from .utils import json_encoder_default
+import json
+import logging
+import re
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# msgpack extension type for one dimensional numeric arrays
+TYPED_ARRAY_EXT = 1
+# order defines the type code sent as the first byte of the extension payload
+TYPED_ARRAYS = ['int8', 'uint8', 'int16', 'uint16',
+                'int32', 'uint32', 'float32', 'float64']
+# smaller arrays are sent inline in the JSON frame of kernel messages
+BUFFER_MIN_SIZE = 1024
+# a JSON message that starts with a signal name without escapes
+JSON_SIGNAL = re.compile(r'^\s*\{\s*"signal"\s*:\s*"([^"\\]*)"\s*[,}]')
+
+
+class JSONEncoding(object):
+    """Encode and decode messages as JSON text frames."""
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data, default=json_encoder_default).encode('utf-8')
+
+    @staticmethod
+    def decode(message):
+        if isinstance(message, bytes):
+            message = message.decode('utf-8')
+        return json.loads(message)
+
+    @staticmethod
+    def join(frames):
+        """Join encoded messages into an encoded array of messages."""
+        return b'[' + b','.join(frames) + b']'
+
+    @staticmethod
+    def peek_signal(message):
+        """The signal of a message without decoding its load.
+
+        :returns: The signal name or ``None`` if the message does not start
+            with a signal.
+        """
+        if isinstance(message, bytes):
+            message = message[:256].decode('utf-8', 'ignore')
+        match = JSON_SIGNAL.match(message)
+        return match.group(1) if match is not None else None
+
+
+class MsgPackEncoding(object):
+    """Encode and decode messages as MessagePack binary frames.
+
+    One dimensional numeric `numpy.ndarray` s are packed as a msgpack
+    extension (type ``1``) containing a type code byte followed by the
+    little-endian array buffer. The frontend unpacks them into typed arrays.
+    """
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def default(obj):
+        if np is not None and isinstance(obj, np.ndarray) and \
+           obj.ndim == 1 and obj.dtype.name in TYPED_ARRAYS:
+            type_code = TYPED_ARRAYS.index(obj.dtype.name)
+            buf = obj.astype(obj.dtype.newbyteorder('<'), copy=False)
+            return msgpack.ExtType(
+                TYPED_ARRAY_EXT,
+                bytes(bytearray([type_code])) + buf.tobytes(),
+            )
+
+        native = json_encoder_default(obj)
+        if native is obj:
+            raise TypeError('cannot serialize {}'.format(type(obj)))
+        return native
+
+    @classmethod
+    def encode(cls, data):
+        return msgpack.packb(data, default=cls.default, use_bin_type=True)
+
+    @staticmethod
+    def decode(message):
+        return msgpack.unpackb(message, raw=False)
+
+    @staticmethod
+    def join(frames):
+        """Join encoded messages into an encoded array of messages."""
+        return msgpack.Packer().pack_array_header(len(frames)) + \
+            b''.join(frames)
+
+    @staticmethod
+    def peek_signal(message):
+        """The signal of a message without decoding its load.
+
+        :returns: The signal name or ``None`` if the message is not a map
+            that starts with a signal.
+        """
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(message)
+        try:
+            unpacker.read_map_header()
+            if unpacker.unpack() != 'signal':
+                return None
+            signal = unpacker.unpack()
+        except (msgpack.OutOfData, msgpack.UnpackException, ValueError):
+            return None
+        return signal if isinstance(signal, type('')) else None
+
+
+ENCODINGS = {JSONEncoding.name: JSONEncoding}
+if msgpack is not None:
+    ENCODINGS[MsgPackEncoding.name] = MsgPackEncoding
+
+
+class EncodedFrame(object):
+    """A message ``{'signal': ..., 'load': ...}`` that is already encoded.
+
+    Kernels encode messages for the frontend and frontends encode messages
+    for kernels. The main process forwards them without decoding and
+    encoding them again.
+
+    :param bytes data: The encoded message.
+    :param encoding: The encoding of ``data``, e.g. :class:`JSONEncoding`.
+    :param str signal: The signal of the message.
+    """
+
+    def __init__(self, data, encoding, signal):
+        self.data = data
+        self.encoding = encoding
+        self.signal = signal
+
+    def decode(self):
+        return self.encoding.decode(self.data)
+
+    def encode(self, encoding):
+        """The message in the given encoding.
+
+        Only re-encodes the message if ``encoding`` is different.
+
+        :rtype: bytes
+        """
+        if encoding is self.encoding:
+            return self.data
+        return encoding.encode(self.decode())
+
+
+def pack_buffers(data, buffers, min_size=BUFFER_MIN_SIZE):
+    """Replace numeric arrays with references to separate buffers.
+
+    Used by kernels to send `numpy.ndarray` s to the main process as
+    separate ZMQ frames. Every array with at least ``min_size`` bytes is
+    appended to ``buffers`` and replaced by
+    ``{'__buffer': index, 'dtype': ..., 'shape': ...}``.
+
+    :param data: Message to process.
+    :param list buffers: Buffers are appended to this list.
+    :param int min_size: Smallest array in bytes to send as a buffer.
+    :returns: The message with references.
+    """
+    if np is not None and isinstance(data, np.ndarray):
+        if data.dtype.kind not in 'biuf' or data.nbytes < min_size:
+            return data
+        data = np.ascontiguousarray(data)
+        buffers.append(data)
+        return {'__buffer': len(buffers) - 1,
+                'dtype': data.dtype.str,
+                'shape': list(data.shape)}
+    if isinstance(data, dict):
+        return {k: pack_buffers(v, buffers, min_size)
+                for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [pack_buffers(v, buffers, min_size) for v in data]
+    return data
+
+
+def unpack_buffers(data, buffers):
+    """Replace references created by :func:`pack_buffers` with arrays.
+
+    The arrays are read-only views on the buffers without a copy.
+
+    :param data: Message to process.
+    :param list buffers: Objects supporting the buffer protocol.
+    :returns: The message with `numpy.ndarray` s.
+    """
+    if isinstance(data, dict):
+        if '__buffer' in data:
+            array = np.frombuffer(buffers[data['__buffer']],
+                                  dtype=np.dtype(str(data['dtype'])))
+            return array.reshape(data['shape'])
+        return {k: unpack_buffers(v, buffers) for k, v in data.items()}
+    if isinstance(data, list):
+        return [unpack_buffers(v, buffers) for v in data]
+    return data
+
+
+def negotiate(requested):
+    """Choose an encoding.
+
+    :param list requested:
+        Encoding names in the order of preference of the frontend.
+    :returns: The first supported encoding or JSON.
+    """
+    for name in requested or []:
+        if name in ENCODINGS:
+            return ENCODINGS[name]
+
+    log.debug('no requested encoding supported: {}'.format(requested))
+    return JSONEncoding
@@ -3,16 +3,28 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import __version__ as DATABENCH_VERSION
+from . import encoding
+from . import metrics
+from . import watchdog
+from . import workers
+from .admission import Admission
 from .analysis import ActionHandler
+from .assets import StaticHandler
+from .connections import registry, sessions
+from .profiling import profiler
+from .scheduler import scheduler
 from .readme import Readme
-from .utils import json_encoder_default
+from .template import page_cache
 from collections import defaultdict
 import functools
 import glob
-import json
 import logging
 import os
+import time
+import tornado.concurrent
 import tornado.gen
+import tornado.ioloop
+import tornado.routing
 import tornado.web
 import tornado.websocket
 
@@ -21,7 +33,6 @@ try:
 except ImportError:
     from urlparse import parse_qs  # Python 2
 
-PING_INTERVAL = 15000
 log = logging.getLogger(__name__)
 
 
@@ -34,6 +45,23 @@ class Meta(object):
     :param str analysis_path: Path of the analysis class.
     :param list extra_routes: [(route, handler, data), ...]
     :param list cli_args: Arguments from the command line.
+
+    The ``info`` entry ``emit_batch`` controls how emits are batched into
+    websocket frames for frontends that support it: ``0`` (default) batches
+    all emits of one IOLoop iteration, a positive number is a batching
+    window in milliseconds and ``None`` disables batching.
+
+    The ``info`` entry ``session_grace`` is the time in seconds that an
+    analysis instance is kept after its connection closed so that a
+    reconnecting frontend can resume it. The default ``0`` disconnects
+    analyses immediately.
+
+    The number of concurrent instances can be limited with the ``info``
+    entries described in :class:`~databench.admission.Admission`.
+
+    :ivar bool forwards_frames: Whether actions from frontends are passed to
+        :meth:`run_process` as :class:`~databench.encoding.EncodedFrame` s
+        instead of decoded messages.
     """
 
     def __init__(self, name, analysis_class, analysis_path, extra_routes=None,
@@ -43,11 +71,6 @@ class Meta(object):
         self.analysis_path = analysis_path
         self.cli_args = cli_args if cli_args is not None else []
 
-        # detect whether a thumbnail image is present
-        thumbnail = False
-        thumbnails = glob.glob(os.path.join(self.analysis_path, 'thumbnail.*'))
-        if len(thumbnails) >= 1:
-            thumbnail = os.path.basename(thumbnails[0])
         # analysis readme
         readme = Readme(self.analysis_path)
         self.info = {
@@ -55,23 +78,29 @@ class Meta(object):
             'readme': readme.html,
             'description': readme.text.strip(),
             'show_in_index': True,
-            'thumbnail': thumbnail,
+            'thumbnail': self.find_thumbnail(self.analysis_path),
             'home_link': False,
             'version': '0.0.0',
+            'emit_batch': 0,
+            'session_grace': 0,
         }
         if info is not None:
             self.info.update(info)
+        self.admission = Admission(self.name, self.info)
+        self.forwards_frames = False
 
         self.fill_action_handlers(analysis_class)
+        # actions that are used as metric labels
+        self.actions = set(analysis_class._action_handlers) - {'*'}
 
         self.routes = [
-            (r'static/(.+)', tornado.web.StaticFileHandler,
+            (r'static/(.+)', StaticHandler,
              {'path': os.path.join(self.analysis_path, 'static')}),
 
-            (r'(analysis\.(?:js|css)).*', tornado.web.StaticFileHandler,
+            (r'(analysis\.(?:js|css)).*', StaticHandler,
              {'path': self.analysis_path}),
 
-            (r'(thumbnail\.(?:png|jpg|jpeg)).*', tornado.web.StaticFileHandler,
+            (r'(thumbnail\.(?:png|jpg|jpeg)).*', StaticHandler,
              {'path': self.analysis_path}),
 
             (r'ws', FrontendHandler,
@@ -85,6 +114,42 @@ class Meta(object):
               'info': self.info, 'path': self.analysis_path}),
         ] + (extra_routes if extra_routes is not None else [])
 
+    def start(self):
+        """Called once the Meta is created and its info is complete."""
+        pass
+
+    def set_encoding(self, analysis, encoding):
+        """Called with the encoding negotiated by the frontend of an analysis.
+
+        Called when an analysis instance is created or resumed.
+        """
+        pass
+
+    @staticmethod
+    def find_thumbnail(analysis_path):
+        """Detect whether a thumbnail image is present.
+
+        :returns: File name of the thumbnail or ``False``.
+        """
+        thumbnails = glob.glob(os.path.join(analysis_path, 'thumbnail.*'))
+        if not thumbnails:
+            return False
+        return os.path.basename(thumbnails[0])
+
+    def action_label(self, action_name, analysis=None):
+        """Label of an action in metrics.
+
+        Frontends can send any signal. Signals without an action handler
+        are counted as ``other`` to bound the number of metric labels.
+
+        :param str action_name: Name of the action.
+        :param analysis: Analysis instance receiving the action.
+        :rtype: str
+        """
+        if action_name in self.actions:
+            return action_name
+        return 'other'
+
     @staticmethod
     def fill_action_handlers(analysis_class):
         analysis_class._action_handlers = defaultdict(list)
@@ -112,6 +177,9 @@ class Meta(object):
         It also handles the start and stop signals in the case that message
         is a `dict` with a key ``__process_id``.
 
+        A sampled fraction of invocations is profiled when profiling is
+        enabled (see :mod:`databench.profiling`).
+
         :param str action_name: Name of the action to trigger.
         :param message: Message.
         :param callback:
@@ -123,6 +191,22 @@ class Meta(object):
         if analysis is None:
             return
 
+        profile = profiler.start(type(analysis).__name__, action_name)
+        try:
+            yield Meta.run_handlers(analysis, action_name, message, profile)
+        finally:
+            profiler.stop(profile)
+
+    @staticmethod
+    @tornado.gen.coroutine
+    def run_handlers(analysis, action_name, message='__nomessagetoken__',
+                     profile=None):
+        """Calls all handlers for an action. See :meth:`run_process`.
+
+        :param profile: Profile of this invocation from
+            :meth:`~databench.profiling.Profiler.start`.
+        """
+
         # detect process_id
         process_id = None
         if isinstance(message, dict) and '__process_id' in message:
@@ -133,11 +217,9 @@ class Meta(object):
             yield analysis.emit('__process',
                                 {'id': process_id, 'status': 'start'})
 
-        fns = [
-            functools.partial(handler, analysis)
-            for handler in (analysis._action_handlers.get(action_name, []) +
-                            analysis._action_handlers.get('*', []))
-        ]
+        handlers = list(analysis._action_handlers.get(action_name, []))
+        handlers += analysis._action_handlers.get('*', [])
+        fns = [functools.partial(handler, analysis) for handler in handlers]
         if fns:
             args, kwargs = [], {}
 
@@ -155,7 +237,10 @@ class Meta(object):
             for fn in fns:
                 log.debug('calling {}'.format(fn))
                 try:
-                    yield tornado.gen.maybe_future(fn(*args, **kwargs))
+                    with watchdog.action(analysis, action_name), \
+                            profiler.call(profile):
+                        result = fn(*args, **kwargs)
+                    yield tornado.gen.maybe_future(result)
                 except Exception as e:
                     yield analysis.emit('error', 'an Exception occured')
                     raise e
@@ -168,63 +253,261 @@ class Meta(object):
                                 {'id': process_id, 'status': 'end'})
 
 
+class LazyMeta(tornado.routing.Router):
+    """Placeholder for a :class:`Meta` that is created on its first request.
+
+    Until then, ``info`` only contains the entries from ``index.yaml``, the
+    readme and defaults, so that the index page does not import the
+    analysis. The readme is read when ``info`` is first accessed. The title
+    of the Meta is only known once it was created. The first request to
+    ``/<name>/`` creates the Meta, which imports the analysis, and routes
+    this and all later requests to its routes. When creating the Meta
+    fails, the error is logged and the request fails with status 500. The
+    next request tries again.
+
+    :param str name: Name of the analysis.
+    :param str analysis_path: Path of the analysis.
+    :param dict info: Info from ``index.yaml``. It overrides the info of
+        the Meta.
+    :param factory: Function returning the :class:`Meta` or ``None``.
+    """
+
+    def __init__(self, name, analysis_path, info, factory):
+        self.name = name
+        self.analysis_path = analysis_path
+        self.overrides = info
+        self.factory = factory
+        self._info = {
+            'title': name,
+            'show_in_index': True,
+            'thumbnail': Meta.find_thumbnail(analysis_path),
+        }
+        self._info.update(info)
+
+        self.meta = None
+        self.application = None
+        self.settings = {}
+
+    def materialize(self):
+        """Create the Meta if it was not created yet.
+
+        :rtype: Meta
+        """
+        if self.meta is None:
+            log.debug('creating Meta for {}'.format(self.name))
+            meta = self.factory()
+            if meta is None:
+                return None
+            meta.info.update(self.overrides)
+            meta.start()
+            self.meta = meta
+            self._info = meta.info
+        return self.meta
+
+    @property
+    def info(self):
+        if 'description' not in self._info:
+            self._info['description'] = \
+                Readme(self.analysis_path).text.strip()
+        return self._info
+
+    @property
+    def materialized(self):
+        return self.meta is not None
+
+    def route(self):
+        return (r'/{}/.*'.format(self.name), self)
+
+    def find_handler(self, request, **kwargs):
+        if self.application is None:
+            try:
+                meta = self.materialize()
+            except Exception:
+                log.error('Could not create analysis {}.'.format(self.name),
+                          exc_info=True)
+                return self.error_application(500).find_handler(request)
+            if meta is None:
+                return self.error_application(404).find_handler(request)
+
+            self.application = tornado.web.Application(
+                [(r'/{}/{}'.format(self.name, route), handler, data)
+                 for route, handler, data in meta.routes],
+                **dict(self.settings, autoreload=False)
+            )
+        return self.application.find_handler(request, **kwargs)
+
+    def error_application(self, status_code):
+        return tornado.web.Application(
+            [(r'.*', tornado.web.ErrorHandler, {'status_code': status_code})],
+            **dict(self.settings, autoreload=False)
+        )
+
+
 class FrontendHandler(tornado.websocket.WebSocketHandler):
 
     def initialize(self, meta):
         self.meta = meta
         self.analysis = None
-        self.ping_callback = tornado.ioloop.PeriodicCallback(self.do_ping,
-                                                             PING_INTERVAL)
-        self.ping_callback.start()
-        tornado.autoreload.add_reload_hook(self.on_close)
-
-    def do_ping(self):
-        if self.ws_connection is None:
-            self.ping_callback.stop()
-            return
-        self.ping(b'ping')
+        self.encoding = encoding.JSONEncoding
+        self.emit_batch = None
+        self.emit_queue = []
+        self.emit_flushed = None
+        self.opened = None
+        self.last_active = None
+        self.reloading = False
+        self.admitting = False
+
+    def analysis_id(self):
+        return self.analysis.id_ if self.analysis is not None else None
 
     def open(self):
         log.debug('WebSocket connection opened.')
+        self.opened = time.time()
+        registry.register(self)
+
+    def on_pong(self, data):
+        self.last_active = time.time()
 
     @tornado.gen.coroutine
     def on_close(self):
         log.debug('WebSocket connection closed.')
-        yield self.meta.run_process(self.analysis, 'disconnected')
+        registry.unregister(self)
+        scheduler.forget(self)
+        analysis, self.analysis = self.analysis, None
+        if analysis is None:
+            return
+
+        grace = self.meta.info.get('session_grace')
+        if grace and not self.reloading:
+            analysis.set_emit_fn(self.emit_detached)
+            sessions.detach(analysis, self.meta.name, grace, functools.partial(
+                self.disconnect, analysis))
+            return
+
+        yield self.disconnect(analysis)
+
+    @tornado.gen.coroutine
+    def disconnect(self, analysis):
+        """End an analysis instance."""
+        try:
+            yield self.run_process(analysis, 'disconnected')
+        finally:
+            self.meta.admission.release()
+
+    @tornado.gen.coroutine
+    def run_process(self, analysis, action_name,
+                    message='__nomessagetoken__'):
+        """Run an action with the Meta of this connection and measure it."""
+        start = time.time()
+        try:
+            with watchdog.action(analysis, action_name):
+                future = self.meta.run_process(analysis, action_name, message)
+            yield future
+        finally:
+            metrics.run_process_seconds.observe(
+                time.time() - start, analysis=self.meta.name,
+                action=self.meta.action_label(action_name, analysis))
+
+    @staticmethod
+    def emit_detached(signal, message='__nomessagetoken__'):
+        log.debug('Dropping emit of {} while detached.'.format(signal))
 
     @tornado.gen.coroutine
     def on_message(self, message):
         if message is None:
             log.debug('empty message received.')
             return
+        self.last_active = time.time()
+
+        # forward actions without decoding them
+        if self.analysis is not None and self.meta.forwards_frames:
+            frame_encoding = self.encoding \
+                if isinstance(message, bytes) else encoding.JSONEncoding
+            signal = frame_encoding.peek_signal(message)
+            if signal is not None and not signal.startswith('__'):
+                if not isinstance(message, bytes):
+                    message = message.encode('utf-8')
+                self.submit(signal, [encoding.EncodedFrame(
+                    message, frame_encoding, signal)])
+                return
 
-        msg = json.loads(message)
+        if isinstance(message, bytes):
+            msg = self.encoding.decode(message)
+        else:
+            msg = encoding.JSONEncoding.decode(message)
         if '__connect' in msg:
-            if self.analysis is not None:
+            metrics.messages_in.inc(analysis=self.meta.name,
+                                    action='__connect')
+            if self.analysis is not None or self.admitting:
                 log.error('Connection already has an analysis. Abort.')
                 return
 
             requested_id = msg['__connect']
-            log.debug('Instantiate analysis with id {}'.format(requested_id))
-            self.analysis = self.meta.analysis_class()
-            self.analysis.init_databench(requested_id)
+            resumed = sessions.resume(requested_id, self.meta.name)
+            if resumed is not None:
+                self.analysis = resumed
+                log.info('Analysis {} resumed.'.format(self.analysis.id_))
+            else:
+                self.admitting = True
+                rejected = yield self.meta.admission.acquire()
+                self.admitting = False
+                if rejected is not None:
+                    self.write_frame({'signal': '__busy', 'load': {
+                        'reason': rejected,
+                        'retry_after': self.meta.admission.retry_after,
+                    }})
+                    self.close(1013, 'busy')
+                    return
+                if self.ws_connection is None:
+                    # closed while waiting for admission
+                    self.meta.admission.release()
+                    return
+
+                if not workers.owns(requested_id):
+                    log.info('Analysis {} belongs to another node or '
+                             'worker. Creating a new instance.'
+                             ''.format(requested_id))
+                    requested_id = None
+
+                log.debug('Instantiate analysis with id {}'
+                          ''.format(requested_id))
+                self.analysis = self.meta.analysis_class()
+                self.analysis.init_databench(requested_id)
+                log.info('Analysis {} instanciated.'
+                         ''.format(self.analysis.id_))
             self.analysis.set_emit_fn(self.emit)
-            log.info('Analysis {} instanciated.'.format(self.analysis.id_))
+            watchdog.metas[self.analysis] = self.meta
+
+            # the connect response is always JSON, later frames are not
+            negotiated = encoding.negotiate(msg.get('__encodings'))
+            log.debug('Using {} encoding.'.format(negotiated.name))
             yield self.emit('__connect', {
                 'analysis_id': self.analysis.id_,
                 'databench_backend_version': DATABENCH_VERSION,
                 'analyses_version': self.meta.info['version'],
+                'encoding': negotiated.name,
+                'resumed': resumed is not None,
             })
+            self.encoding = negotiated
+            self.meta.set_encoding(self.analysis, negotiated)
+            if msg.get('__batch'):
+                self.emit_batch = self.meta.info.get('emit_batch')
+
+            if resumed is not None:
+                # resend the instance state that changed while detached
+                self.analysis.data.trigger_all_callbacks()
+                log.info('Reconnected to analysis.')
+                return
 
-            yield self.meta.run_process(self.analysis, 'connect')
+            yield self.run_process(self.analysis, 'connect')
 
             args = {'cli_args': self.meta.cli_args, 'request_args': {}}
             if '__request_args' in msg and msg['__request_args']:
                 args['request_args'] = parse_qs(
                     msg['__request_args'].lstrip('?'))
-            yield self.meta.run_process(self.analysis, 'args', args)
+            yield self.run_process(self.analysis, 'args', args)
 
-            yield self.meta.run_process(self.analysis, 'connected')
+            yield self.run_process(self.analysis, 'connected')
             log.info('Connected to analysis.')
             return
 
@@ -236,21 +519,93 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
             log.info('message not processed: {}'.format(message))
             return
 
-        if 'load' not in msg:
-            yield self.meta.run_process(self.analysis,
-                                        msg['signal'])
-        else:
-            yield self.meta.run_process(self.analysis,
-                                        msg['signal'], msg['load'])
+        self.submit(msg['signal'], [msg['load']] if 'load' in msg else [])
+
+    def submit(self, signal, args):
+        """Schedule an action of the analysis of this connection."""
+        metrics.messages_in.inc(
+            analysis=self.meta.name,
+            action=self.meta.action_label(signal, self.analysis))
+        _, rejected = scheduler.submit(self, self.run_process, self.analysis,
+                                       signal, *args)
+        if rejected is not None:
+            log.warning('Dropped {} for analysis {}: {}.'.format(
+                signal, self.analysis.id_, rejected))
+            metrics.messages_dropped.inc(analysis=self.meta.name,
+                                         reason=rejected)
+            self.emit('warn', 'message {} dropped: {}'.format(
+                signal, rejected))
 
     def emit(self, signal, message='__nomessagetoken__'):
-        data = {'signal': signal}
-        if message != '__nomessagetoken__':
-            data['load'] = message
+        if isinstance(message, encoding.EncodedFrame):
+            # encoded by a kernel
+            data = message
+        else:
+            data = {'signal': signal}
+            # arrays cannot be compared to the token
+            if not isinstance(message, type('__nomessagetoken__')) or \
+               message != '__nomessagetoken__':
+                data['load'] = message
+
+        if self.emit_batch is None:
+            return self.write_frame(data)
+
+        # queue and flush all emits of this IOLoop iteration or time window
+        self.emit_queue.append(data)
+        if self.emit_flushed is None:
+            self.emit_flushed = tornado.concurrent.Future()
+            ioloop = tornado.ioloop.IOLoop.current()
+            if self.emit_batch:
+                ioloop.call_later(self.emit_batch / 1000.0, self.flush_emits)
+            else:
+                ioloop.add_callback(self.flush_emits)
+        return self.emit_flushed
+
+    def flush_emits(self):
+        """Send all queued emits in a single frame.
+
+        A single queued emit is sent as a plain message and multiple ones as
+        an array of messages.
+        """
+        queue, self.emit_queue = self.emit_queue, []
+        flushed, self.emit_flushed = self.emit_flushed, None
+
+        written = self.write_frame(queue[0] if len(queue) == 1 else queue)
+        if written is None:
+            flushed.set_result(None)
+        else:
+            tornado.concurrent.chain_future(written, flushed)
+
+    def encode_frame(self, data):
+        if isinstance(data, encoding.EncodedFrame):
+            return data.encode(self.encoding)
+        return self.encoding.encode(data)
+
+    def write_frame(self, data):
+        """Encode and send a message or a list of messages.
+
+        Messages that are :class:`~databench.encoding.EncodedFrame` s in the
+        encoding of this connection are sent as they are.
+        """
+        start = time.time()
+        if isinstance(data, list):
+            frame = self.encoding.join([self.encode_frame(d) for d in data])
+        else:
+            frame = self.encode_frame(data)
+        metrics.emit_serialization_seconds.observe(
+            time.time() - start, analysis=self.meta.name)
+
+        signals = [d.signal if isinstance(d, encoding.EncodedFrame)
+                   else d['signal']
+                   for d in (data if isinstance(data, list) else [data])]
+        for signal in signals:
+            metrics.messages_out.inc(analysis=self.meta.name, signal=signal)
+        metrics.message_bytes.observe(
+            len(frame), analysis=self.meta.name,
+            signal=signals[0] if len(signals) == 1 else '__batch')
 
         try:
-            return self.write_message(
-                json.dumps(data, default=json_encoder_default).encode('utf-8'))
+            return self.write_message(frame, binary=self.encoding.binary)
         except tornado.websocket.WebSocketClosedError:
             pass
 
@@ -264,9 +619,12 @@ class RenderTemplate(tornado.web.RequestHandler):
     def get(self, template_name=None):
         if template_name is None:
             template_name = self.template_name
-        self.render(os.path.join(self.path, template_name),
-                    databench_version=DATABENCH_VERSION,
-                    **self.info)
+        page_cache.render(
+            self,
+            (self.path, template_name, self.info['version']),
+            os.path.join(self.path, template_name),
+            lambda: dict(databench_version=DATABENCH_VERSION, **self.info),
+        )
 
     def head(self):
         pass
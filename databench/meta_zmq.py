@@ -1,11 +1,17 @@
+import datetime
 import logging
+import os
 import tornado.gen
 
-from .analysis_zmq import AnalysisZMQ
+from .analysis_zmq import AnalysisZMQ, KernelPool, Multiplexer, Zygote
+from .encoding import EncodedFrame
 from .meta import Meta
 
 log = logging.getLogger(__name__)
 
+# seconds to wait for a kernel to acknowledge disconnected
+DISCONNECT_TIMEOUT = 5.0
+
 
 class MetaZMQ(Meta):
     """A Meta class that pipes all messages to ZMQ and back.
@@ -13,34 +19,112 @@ class MetaZMQ(Meta):
     The entire ZMQ interface of Databench is defined here and in
     :class`AnalysisZMQ`.
 
+    Kernels that can be assigned a new analysis id (``supports_pool``) are
+    pre-started in a :class:`~databench.analysis_zmq.KernelPool` when
+    ``kernel_pool_min_idle`` is set in ``index.yaml`` or host many analysis
+    instances in ``kernel_multiplex`` processes
+    (:class:`~databench.analysis_zmq.Multiplexer`). Kernels that can be
+    forked (``supports_zygote``) are forked from a
+    :class:`~databench.analysis_zmq.Zygote` when ``kernel_zygote`` is set.
+
+    Messages between frontends and kernels that understand encoded frames
+    (``supports_frames``) are forwarded without decoding them: kernels
+    encode their messages in the encoding negotiated by the frontend.
     """
 
     def __init__(self, name, executable, zmq_publish,
-                 analysis_path, extra_routes, cmd_args=None):
+                 analysis_path, extra_routes, cmd_args=None,
+                 supports_pool=False, supports_zygote=False,
+                 supports_frames=False):
         super(MetaZMQ, self).__init__(name, AnalysisZMQ,
                                       analysis_path, extra_routes, cmd_args)
 
         self.executable = executable
         self.zmq_publish = zmq_publish
+        self.supports_pool = supports_pool
+        self.supports_zygote = supports_zygote
+        self.forwards_frames = supports_frames
+        self.kernel_pool = None
+        self.multiplexer = None
+        self.zygote = None
+
+    def start(self):
+        if self.supports_zygote and self.info.get('kernel_zygote') and \
+           hasattr(os, 'fork'):
+            log.info('Starting zygote for {}.'.format(self.name))
+            self.zygote = Zygote(self.executable)
+
+        if not self.supports_pool:
+            return
+
+        multiplex = self.info.get('kernel_multiplex', 0)
+        if multiplex:
+            log.info('Starting {} multiplexing kernels for {}.'
+                     ''.format(multiplex, self.name))
+            self.multiplexer = Multiplexer(self.name, self.executable,
+                                           self.zmq_publish, multiplex)
+            return
+
+        min_idle = self.info.get('kernel_pool_min_idle', 0)
+        if not min_idle:
+            return
+
+        log.info('Starting {} kernels for {}.'.format(min_idle, self.name))
+        self.kernel_pool = KernelPool(
+            self.name, self.executable, self.zmq_publish,
+            min_idle=min_idle,
+            max_size=self.info.get('kernel_pool_max_size'),
+            zygote=self.zygote,
+        )
+        self.kernel_pool.fill()
+
+    def action_label(self, action_name, analysis=None):
+        # action handlers are announced by kernels in their handshake
+        kernel = getattr(analysis, 'kernel', None)
+        if kernel is not None:
+            self.actions.update(kernel.actions)
+        return super(MetaZMQ, self).action_label(action_name, analysis)
+
+    def set_encoding(self, analysis, encoding):
+        if self.forwards_frames:
+            analysis.set_frame_encoding(encoding)
 
     @tornado.gen.coroutine
     def run_process(self, analysis, action_name, message='__nomessagetoken__'):
         """Executes an process in the analysis with the given message.
 
         It also handles the start and stop signals in case a process_id
-        is given.
+        is given. Actions are buffered until the kernel completed its
+        handshake. After ``disconnected``, the kernel is terminated once it
+        acknowledged the action or after ``DISCONNECT_TIMEOUT`` seconds.
         """
 
         if action_name == 'connect':
-            analysis.on_connect(self.executable, self.zmq_publish)
+            analysis.on_connect(self.executable, self.zmq_publish,
+                                self.kernel_pool, self.zygote,
+                                self.multiplexer)
 
-        while not analysis.zmq_handshake:
-            yield tornado.gen.sleep(0.1)
+        kernel = analysis.kernel
+        if kernel is None:
+            log.debug('kernel of {} already terminated'.format(analysis.id_))
+            return
 
         log.debug('sending action {}'.format(action_name))
-        analysis.zmq_send({'signal': action_name, 'load': message})
+        if isinstance(message, EncodedFrame):
+            analysis.zmq_send(message)
+        else:
+            analysis.zmq_send({'signal': action_name, 'load': message})
 
         if action_name == 'disconnected':
-            # Give kernel time to process disconnected message.
-            yield tornado.gen.sleep(0.1)
+            if kernel.ready.done() and kernel.acks_disconnect:
+                try:
+                    yield tornado.gen.with_timeout(
+                        datetime.timedelta(seconds=DISCONNECT_TIMEOUT),
+                        kernel.stopped)
+                except tornado.gen.TimeoutError:
+                    log.warning('Kernel of {} did not acknowledge '
+                                'disconnected.'.format(analysis.id_))
+            elif kernel.ready.done():
+                # Give kernel time to process disconnected message.
+                yield tornado.gen.sleep(0.1)
             analysis.on_disconnected()
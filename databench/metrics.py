@@ -0,0 +1,300 @@
+"""Server metrics in the Prometheus text exposition format.
+
+A minimal implementation of counters, gauges and histograms with labels
+that does not require any additional dependency. All metrics of the
+Databench server are defined at the bottom of this module and are served
+by :class:`MetricsHandler`.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from .connections import registry as connection_registry
+from .datastore import Datastore
+import threading
+import tornado.web
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536,
+                 262144, 1048576, 4194304)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '{:.1f}'.format(value)
+    return '{}'.format(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, '{}'.format(v).replace('\\', r'\\')
+                                          .replace('"', r'\"')
+                                          .replace('\n', r'\n'))
+        for k, v in labels
+    ) + '}'
+
+
+class Metric(object):
+    """Base class for metrics.
+
+    :param str name: Metric name.
+    :param str documentation: Help text.
+    :param tuple labelnames: Names of the labels of this metric.
+    """
+    type_ = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('expected labels {}, got {}'.format(
+                self.labelnames, tuple(labels)))
+        return tuple(labels[n] for n in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, labels, value) tuples."""
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield '', list(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type_)]
+        lines += ['{}{}{} {}'.format(self.name, suffix, format_labels(labels),
+                                     format_value(value))
+                  for suffix, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing counter."""
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down.
+
+    A gauge without labels can also be computed on every scrape with
+    :meth:`set_function`.
+    """
+    type_ = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.function = None
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self.function = function
+        return self
+
+    def samples(self):
+        if self.function is not None:
+            yield '', [], self.function()
+            return
+        for sample in super(Gauge, self).samples():
+            yield sample
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets.
+
+    :param tuple buckets: Upper bounds of the buckets.
+    """
+    type_ = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self.values[key]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(k, (list(c), s, n))
+                     for k, (c, s, n) in self.values.items()]
+        for key, (counts, total, count) in sorted(items):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield ('_bucket', labels + [('le', format_value(upper_bound))],
+                       cumulative)
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class Registry(object):
+    """Collection of metrics."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves metrics for Prometheus to scrape."""
+
+    def initialize(self, registry=None):
+        self.registry = registry if registry is not None else metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.registry.render())
+
+
+def pending_outbound_bytes():
+    return sum(
+        getattr(getattr(handler.ws_connection, 'stream', None),
+                '_write_buffer_size', 0)
+        for handler in connection_registry
+        if handler.ws_connection is not None
+    )
+
+
+metrics = Registry()
+
+connections_open = metrics.register(Gauge(
+    'databench_connections_open',
+    'Number of open websocket connections.',
+)).set_function(lambda: len(connection_registry))
+messages_in = metrics.register(Counter(
+    'databench_messages_in_total',
+    'Messages received from frontends.',
+    ('analysis', 'action'),
+))
+messages_dropped = metrics.register(Counter(
+    'databench_messages_dropped_total',
+    'Messages from frontends dropped by the scheduler.',
+    ('analysis', 'reason'),
+))
+messages_out = metrics.register(Counter(
+    'databench_messages_out_total',
+    'Messages sent to frontends.',
+    ('analysis', 'signal'),
+))
+message_bytes = metrics.register(Histogram(
+    'databench_message_bytes',
+    'Size of frames sent to frontends by signal (__batch for batches).',
+    ('analysis', 'signal'),
+    buckets=BYTES_BUCKETS,
+))
+run_process_seconds = metrics.register(Histogram(
+    'databench_run_process_seconds',
+    'Time to process an action.',
+    ('analysis', 'action'),
+))
+emit_serialization_seconds = metrics.register(Histogram(
+    'databench_emit_serialization_seconds',
+    'Time to encode frames sent to frontends.',
+    ('analysis',),
+))
+analysis_instances = metrics.register(Gauge(
+    'databench_analysis_instances',
+    'Number of analysis instances (including detached sessions).',
+    ('analysis',),
+))
+admission_rejected = metrics.register(Counter(
+    'databench_admission_rejected_total',
+    'New analysis instances rejected by admission control.',
+    ('analysis', 'reason'),
+))
+loop_lag_seconds = metrics.register(Histogram(
+    'databench_ioloop_lag_seconds',
+    'Delay of the IOLoop heartbeat of the watchdog.',
+))
+blocking_total = metrics.register(Counter(
+    'databench_blocking_total',
+    'IOLoop stalls over the watchdog threshold by blocking handler.',
+    ('analysis', 'action'),
+))
+pending_bytes = metrics.register(Gauge(
+    'databench_pending_outbound_bytes',
+    'Bytes waiting in websocket write buffers.',
+)).set_function(pending_outbound_bytes)
+kernels = metrics.register(Gauge(
+    'databench_kernels',
+    'Number of running language kernel processes.',
+))
+kernels_idle = metrics.register(Gauge(
+    'databench_kernels_idle',
+    'Number of idle kernels in kernel pools.',
+    ('analysis',),
+))
+kernel_events = metrics.register(Counter(
+    'databench_kernel_events_total',
+    'Kernel lifecycle events (exited, unresponsive, memory, idle, '
+    'restarted, killed).',
+    ('event',),
+))
+kernel_messages_queued = metrics.register(Counter(
+    'databench_kernel_messages_queued_total',
+    'Messages to kernels that were queued because the kernel was not '
+    'connected (unreachable) or its queue was full (full).',
+    ('reason',),
+))
+kernel_rss_bytes = metrics.register(Gauge(
+    'databench_kernel_rss_bytes',
+    'Resident set size of all supervised kernels.',
+))
+datastore_domains = metrics.register(Gauge(
+    'databench_datastore_domains',
+    'Number of Datastore domains.',
+)).set_function(lambda: len(Datastore.global_data))
+datastore_bytes = metrics.register(Gauge(
+    'databench_datastore_bytes',
+    'Size of all encoded values in all Datastore domains.',
+)).set_function(lambda: sum(len(v)
+                            for domain in list(Datastore.global_data.values())
+                            for v in list(domain.values())))
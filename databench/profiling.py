@@ -0,0 +1,268 @@
+"""Sampled profiling of action handlers.
+
+A fraction of all action invocations is profiled either with `cProfile`
+(mode ``cprofile``) or by sampling the stack of the thread running the
+action from a background thread (mode ``sample``). Results are aggregated
+per analysis and action and can be downloaded as `pstats` files or as
+collapsed stacks (the input format of flame graph tools) from
+:class:`ProfileHandler`.
+
+Only the synchronous calls of the handlers of a profiled invocation are
+measured (see :meth:`Profiler.call`). Handlers that are coroutines are
+measured until they first yield. Work after that runs interleaved with
+other callbacks of the IOLoop and is not attributed to the invocation.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from collections import Counter, defaultdict
+import base64
+import contextlib
+import cProfile
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tornado.web
+
+log = logging.getLogger(__name__)
+
+
+def format_stack(frame):
+    """Format a stack as a list of ``function (file:line)`` strings.
+
+    The outermost frame comes first.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(
+            code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    return list(reversed(stack))
+
+
+class Profiler(object):
+    """Profile a random fraction of action invocations.
+
+    Only one invocation is profiled at a time.
+
+    :param float sample_rate: Fraction of invocations to profile.
+    :param str mode: ``cprofile`` or ``sample``.
+    :param float interval: Stack sampling interval in seconds.
+    """
+
+    def __init__(self, sample_rate=0.0, mode='cprofile', interval=0.005):
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+
+        self.pstats = {}  # (analysis, action) -> pstats.Stats
+        self.stacks = defaultdict(Counter)  # (analysis, action) -> Counter
+        self.counts = Counter()  # (analysis, action) -> profiled invocations
+
+        self.current = None
+        self.lock = threading.Lock()
+        self.thread_id = None
+        self.sampler = None
+
+    def configure(self, sample_rate=None, mode=None, interval=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if mode is not None:
+            if mode not in ('cprofile', 'sample'):
+                raise ValueError('unknown profiling mode {}'.format(mode))
+            self.mode = mode
+        if interval is not None:
+            self.interval = interval
+        return self
+
+    def cli_args(self):
+        """Command line arguments to configure a kernel the same way."""
+        if not self.sample_rate:
+            return []
+        return ['--profile-sample-rate={}'.format(self.sample_rate),
+                '--profile-mode={}'.format(self.mode)]
+
+    def start(self, analysis, action):
+        """Start profiling an invocation if it is sampled.
+
+        :param str analysis: Name of the analysis.
+        :param str action: Name of the action.
+        :returns: A profile to pass to :meth:`stop` or ``None``.
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+
+        # invocations can start concurrently in kernels with worker threads
+        with self.lock:
+            if self.current is not None:
+                return None
+            profile = {'analysis': analysis, 'action': action,
+                       'pstats': None, 'stacks': Counter(), 'active': False}
+            self.current = profile
+
+        if self.mode == 'cprofile':
+            profile['profile'] = cProfile.Profile()
+        else:
+            self.start_sampler()
+        return profile
+
+    @contextlib.contextmanager
+    def call(self, profile):
+        """Measure a synchronous call of a handler.
+
+        :param profile: A profile returned by :meth:`start` or ``None``.
+        """
+        if profile is None:
+            yield
+            return
+
+        profile['active'] = True
+        if 'profile' in profile:
+            profile['profile'].enable()
+        try:
+            yield
+        finally:
+            if 'profile' in profile:
+                profile['profile'].disable()
+            profile['active'] = False
+
+    def stop(self, profile):
+        """Stop profiling and add the result to the aggregated results.
+
+        :returns: The result of this invocation or ``None``.
+        """
+        if profile is None:
+            return None
+
+        with self.lock:
+            self.current = None
+        profile.pop('active', None)
+        if 'profile' in profile:
+            p = profile.pop('profile')
+            p.create_stats()
+            profile['pstats'] = p.stats
+
+        self.add(profile)
+        return profile
+
+    def add(self, profile):
+        """Add the result of a profiled invocation."""
+        key = (profile['analysis'], profile['action'])
+        self.counts[key] += 1
+        if profile['pstats'] is not None:
+            stats = pstats.Stats()
+            stats.stats = profile['pstats']
+            stats.get_top_level_stats()
+            if key in self.pstats:
+                self.pstats[key].add(stats)
+            else:
+                self.pstats[key] = stats
+        self.stacks[key].update(profile['stacks'])
+
+    def start_sampler(self):
+        # sample the thread running the action
+        self.thread_id = threading.current_thread().ident
+        if self.sampler is not None:
+            return
+        self.sampler = threading.Thread(target=self.sample,
+                                        name='databench-profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            with self.lock:
+                if self.current is None or frame is None:
+                    continue
+                if not self.current['active']:
+                    continue
+                stack = ';'.join(format_stack(frame))
+                self.current['stacks'][stack] += 1
+
+    @staticmethod
+    def encode(profile):
+        """Encode the result of an invocation as JSON compatible dict."""
+        encoded = dict(profile)
+        if profile['pstats'] is not None:
+            encoded['pstats'] = base64.b64encode(
+                marshal.dumps(profile['pstats'])).decode('ascii')
+        encoded['stacks'] = dict(profile['stacks'])
+        return encoded
+
+    @staticmethod
+    def decode(encoded):
+        profile = dict(encoded)
+        if encoded['pstats'] is not None:
+            profile['pstats'] = marshal.loads(
+                base64.b64decode(encoded['pstats']))
+        return profile
+
+    def summary(self):
+        return [{'analysis': analysis, 'action': action, 'samples': n}
+                for (analysis, action), n in sorted(self.counts.items())]
+
+    def pstats_dump(self, analysis, action):
+        """Aggregated statistics in the `pstats` file format."""
+        stats = self.pstats.get((analysis, action))
+        if stats is None:
+            return None
+        return marshal.dumps(stats.stats)
+
+    def collapsed(self, analysis, action):
+        """Aggregated samples as collapsed stacks."""
+        stacks = self.stacks.get((analysis, action))
+        if not stacks:
+            return None
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(stacks.items()))
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Lists and serves profiling results.
+
+    ``/_profile`` lists the profiled actions,
+    ``/_profile/<analysis>/<action>.pstats`` serves `pstats` files and
+    ``/_profile/<analysis>/<action>.collapsed`` serves collapsed stacks.
+    """
+
+    def initialize(self, instance=None):
+        self.profiler = instance if instance is not None else profiler
+
+    def get(self, analysis=None, action=None, file_format=None):
+        if analysis is None:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(self.profiler.summary()))
+            return
+
+        if file_format == 'pstats':
+            data = self.profiler.pstats_dump(analysis, action)
+            content_type = 'application/octet-stream'
+        else:
+            data = self.profiler.collapsed(analysis, action)
+            content_type = 'text/plain'
+        if data is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header('Content-Type', content_type)
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{}-{}.{}"'.format(
+                            analysis, action, file_format))
+        self.write(data)
+
+
+routes = [
+    (r'/_profile', ProfileHandler),
+    (r'/_profile/([^/]+)/([^/]+)\.(pstats|collapsed)', ProfileHandler),
+]
+
+profiler = Profiler()
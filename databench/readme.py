@@ -1,24 +1,62 @@
 from __future__ import unicode_literals
 
 import fnmatch
+import glob
+import hashlib
 import io
 import logging
+import multiprocessing
 import os
 import re
 import tornado.autoreload
 
-# utilities
-try:
-    from markdown import markdown
-except ImportError:  # pragma: no cover
-    markdown = None  # pragma: no cover
+log = logging.getLogger(__name__)
 
-try:
-    from docutils.core import publish_parts as rst
-except ImportError:  # pragma: no cover
-    rst = None  # pragma: no cover
+# rendered readmes are cached in this subdirectory of the readme's directory
+CACHE_DIR = '__pycache__'
+
+
+def render_markdown(text):
+    """Render markdown. Imports markdown on first use."""
+    try:
+        from markdown import markdown
+    except ImportError:  # pragma: no cover
+        return None  # pragma: no cover
+    return markdown(text)
+
+
+def render_rst(text):
+    """Render restructured text. Imports docutils on first use."""
+    try:
+        from docutils.core import publish_parts
+    except ImportError:  # pragma: no cover
+        return None  # pragma: no cover
+    return publish_parts(text, writer_name='html')['html_body']
+
+
+def render_directory(directory):
+    """Render the readme in a directory and fill the cache."""
+    return Readme(directory, watch=False).html
 
-log = logging.getLogger(__name__)
+
+def render_readmes(directories, processes=None):
+    """Render the readmes of many directories in parallel.
+
+    Used at build time to fill the cache of rendered readmes.
+
+    :param list directories: Directories containing readme files.
+    :param int processes: Number of processes (default: number of CPUs).
+    """
+    directories = list(directories)
+    if len(directories) <= 1 or processes == 1:
+        return [render_directory(d) for d in directories]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(render_directory, directories)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class Readme(object):
@@ -56,32 +94,69 @@ class Readme(object):
         if self.watch:
             tornado.autoreload.watch(readme_file)
 
-        with io.open(readme_file, 'r',
-                     encoding=encoding, errors=encoding_errors) as f:
-            self._text = f.read()
+        with io.open(readme_file, 'rb') as f:
+            raw = f.read()
+        self._text = raw.decode(encoding, encoding_errors)
+
+        is_md = readme_file.lower().endswith('.md')
+        is_rst = readme_file.lower().endswith('.rst')
+        if is_md:
+            # remove first html comment
+            self._text = re.sub('<!\-\-.*\-\->', '', self._text,
+                                count=1, flags=re.DOTALL)
+        if not is_md and not is_rst:
+            return
 
-        if readme_file.lower().endswith('.md'):
-            if markdown is not None:
-                self._html = markdown(self._text)
+        cache_file = self.cache_file(readme_file, raw)
+        if os.path.exists(cache_file):
+            with io.open(cache_file, 'r', encoding='utf8') as f:
+                self._html = f.read()
+            return
 
-                # remove first html comment
-                self._text = re.sub('<!\-\-.*\-\->', '', self._text,
-                                    count=1, flags=re.DOTALL)
-            else:
+        if is_md:
+            html = render_markdown(raw.decode(encoding, encoding_errors))
+            if html is None:
                 self._html = (
                     '<p>Install markdown with <b>pip install markdown</b>'
                     ' to render this readme file.</p>'
                 ) + self._text  # pragma: no cover
-
-        if readme_file.lower().endswith('.rst'):
-            if rst is not None:
-                self._html = rst(self._text,
-                                 writer_name='html')['html_body']
-            else:
+                return  # pragma: no cover
+        else:
+            html = render_rst(self._text)
+            if html is None:
                 self._html = (
                     '<p>Install rst rendering with <b>pip install docutils</b>'
                     ' to render this readme file.</p>'
                 ) + self._text  # pragma: no cover
+                return  # pragma: no cover
+
+        self._html = html
+        self.write_cache(cache_file, html)
+
+    def cache_file(self, readme_file, raw):
+        """Path of the rendered readme in the cache.
+
+        The name contains a hash of the content of the readme file.
+        """
+        name = os.path.basename(readme_file)
+        return os.path.join(self.directory, CACHE_DIR, '{}.{}.html'.format(
+            name, hashlib.sha1(raw).hexdigest()[:16]))
+
+    @staticmethod
+    def write_cache(cache_file, html):
+        cache_dir = os.path.dirname(cache_file)
+        prefix = os.path.basename(cache_file).split('.')[:2]
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # remove renderings of previous versions of the readme
+            for old in glob.glob(os.path.join(
+                    cache_dir, '{}.{}.*.html'.format(*prefix))):
+                os.remove(old)
+            with io.open(cache_file, 'w', encoding='utf8') as f:
+                f.write(html)
+        except (IOError, OSError):
+            log.debug('Could not write {}.'.format(cache_file))
 
     @property
     def text(self):
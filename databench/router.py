@@ -0,0 +1,203 @@
+"""Router that forwards frontends to the backend owning their analysis.
+
+A router is started with ``databench --router NAME=URL [NAME=URL ...]``.
+Backend names are node ids (``--node-id``) or ``<node>.<worker>`` for the
+per-worker ports of a node (``--worker-port-base``). The router reads the
+requested analysis id of the first websocket message, connects to the
+backend that created it (see :mod:`~databench.workers`) and then forwards
+frames in both directions without decoding them. New connections and all
+other HTTP requests are distributed round-robin.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from . import encoding
+from . import workers
+from collections import OrderedDict
+import logging
+import tornado.gen
+import tornado.httpclient
+import tornado.web
+import tornado.websocket
+
+try:
+    from urllib.parse import urlparse  # Python 3
+except ImportError:
+    from urlparse import urlparse  # Python 2
+
+log = logging.getLogger(__name__)
+
+# hop-by-hop and recomputed headers that are not forwarded
+SKIP_HEADERS = ('Connection', 'Content-Encoding', 'Content-Length', 'Host',
+                'Keep-Alive', 'Transfer-Encoding', 'Upgrade')
+
+
+class Router(object):
+    """Map analysis ids to backends.
+
+    :param backends: Backend names and base urls like
+        ``http://127.0.0.1:5001``.
+    :type backends: list of (name, url) tuples or dict
+    :param list allowed_origins: Hosts like ``example.com:8080`` of pages
+        on other origins that may open websockets through the router. By
+        default, only pages served by the router itself can.
+    """
+
+    def __init__(self, backends, allowed_origins=None):
+        self.backends = OrderedDict(backends)
+        self.allowed_origins = set(allowed_origins or ())
+        if not self.backends:
+            raise ValueError('a router needs at least one backend')
+        self.names = list(self.backends)
+        self.next = 0
+
+    @staticmethod
+    def parse(specs):
+        """Parse ``NAME=URL`` command line arguments."""
+        backends = []
+        for spec in specs:
+            name, sep, url = spec.partition('=')
+            if not sep or not name or not url:
+                raise ValueError('invalid backend {}, expected NAME=URL'
+                                 ''.format(spec))
+            backends.append((name, url.rstrip('/')))
+        return backends
+
+    def pick(self):
+        """Pick a backend round-robin.
+
+        :returns: (name, url)
+        """
+        name = self.names[self.next % len(self.names)]
+        self.next += 1
+        return name, self.backends[name]
+
+    def backend_for(self, analysis_id):
+        """The backend that owns an analysis id.
+
+        Falls back to :meth:`pick` for new connections and for ids of
+        unknown backends.
+
+        :returns: (name, url)
+        """
+        node, worker = workers.owner(analysis_id)
+        candidates = []
+        if node is not None and worker is not None:
+            candidates.append('{}.{}'.format(node, worker))
+        if node is not None:
+            candidates.append(node)
+        elif worker is not None:
+            candidates.append('{}'.format(worker))
+        for name in candidates:
+            if name in self.backends:
+                return name, self.backends[name]
+
+        if analysis_id:
+            log.info('No backend for analysis {}.'.format(analysis_id))
+        return self.pick()
+
+    def tornado_app(self, **kwargs):
+        return tornado.web.Application([
+            (r'(.*/ws)', WebSocketProxy, {'router': self}),
+            (r'.*', HTTPProxy, {'router': self}),
+        ], **kwargs)
+
+
+class WebSocketProxy(tornado.websocket.WebSocketHandler):
+    """Forwards a websocket connection to a backend."""
+
+    def initialize(self, router):
+        self.router = router
+        self.backend = None
+        self.closed = False
+
+    def check_origin(self, origin):
+        if urlparse(origin).netloc.lower() in self.router.allowed_origins:
+            return True
+        return super(WebSocketProxy, self).check_origin(origin)
+
+    @tornado.gen.coroutine
+    def on_message(self, message):
+        if self.backend is not None:
+            self.backend.write_message(message,
+                                       binary=isinstance(message, bytes))
+            return
+
+        # the first message of a connection is always JSON
+        analysis_id = encoding.JSONEncoding.decode(message).get('__connect')
+        name, url = self.router.backend_for(analysis_id)
+        ws_url = 'ws' + url[4:] if url.startswith('http') else url
+        log.debug('Routing {} to backend {}.'.format(analysis_id, name))
+        try:
+            backend = yield tornado.websocket.websocket_connect(
+                ws_url + self.request.uri)
+        except Exception:
+            log.error('Could not connect to backend {}.'.format(name),
+                      exc_info=True)
+            self.close(1011, 'backend unavailable')
+            return
+        if self.closed:
+            backend.close()
+            return
+
+        # Tornado does not read further messages before this returns
+        self.backend = backend
+        backend.write_message(message)
+        self.forward()
+
+    @tornado.gen.coroutine
+    def forward(self):
+        backend = self.backend
+        while True:
+            message = yield backend.read_message()
+            if message is None:
+                break
+            if self.closed:
+                return
+            self.write_message(message, binary=isinstance(message, bytes))
+
+        if not self.closed:
+            self.close(backend.close_code, backend.close_reason)
+
+    def on_close(self):
+        self.closed = True
+        if self.backend is not None:
+            self.backend.close()
+
+
+class HTTPProxy(tornado.web.RequestHandler):
+    """Forwards HTTP requests to a backend."""
+
+    def initialize(self, router):
+        self.router = router
+
+    @tornado.gen.coroutine
+    def get(self):
+        name, url = self.router.pick()
+        headers = {k: v for k, v in self.request.headers.get_all()
+                   if k not in SKIP_HEADERS}
+        response = yield tornado.httpclient.AsyncHTTPClient().fetch(
+            url + self.request.uri,
+            method=self.request.method,
+            headers=headers,
+            follow_redirects=False,
+            raise_error=False,
+        )
+        if response.code == 599:
+            log.error('Backend {} failed: {}'.format(name, response.error))
+            raise tornado.web.HTTPError(502)
+
+        self.set_status(response.code, response.reason)
+        forwarded = set()
+        for k, v in response.headers.get_all():
+            if k in SKIP_HEADERS:
+                continue
+            if k in forwarded:
+                self.add_header(k, v)
+            else:
+                self.set_header(k, v)
+                forwarded.add(k)
+        if response.code != 304 and self.request.method != 'HEAD':
+            self.write(response.body)
+
+    head = get
@@ -0,0 +1,154 @@
+"""Fair scheduling of actions across connections."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from collections import Counter, deque
+import logging
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """Dispatch actions of all connections fairly.
+
+    Every connection has its own queue of actions. Connections with queued
+    actions take turns (round-robin) whenever fewer than ``max_concurrent``
+    actions are running. A connection never has more than
+    ``per_connection`` actions running at the same time. Incoming messages
+    are rate limited per connection with a token bucket.
+
+    :param int max_concurrent:
+        Maximum number of actions running at the same time across all
+        connections or ``None`` for no limit.
+    :param int per_connection:
+        Maximum number of actions running at the same time per connection
+        or ``None`` for no limit.
+    :param float rate:
+        Messages per second a connection can send on average or ``None``
+        for no limit.
+    :param int burst: Messages a connection can send in a burst.
+    :param int max_queue: Maximum number of queued actions per connection.
+    """
+
+    def __init__(self, max_concurrent=None, per_connection=1, rate=None,
+                 burst=20, max_queue=1000):
+        self.max_concurrent = max_concurrent
+        self.per_connection = per_connection
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+
+        self.queues = {}  # connection -> deque of (fn, args, future)
+        self.turns = deque()  # connections with actions that can run
+        self.running = Counter()  # connection -> number of running actions
+        self.total_running = 0
+        self.buckets = {}  # connection -> (tokens, timestamp)
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError('unknown option {}'.format(key))
+            setattr(self, key, value)
+        return self
+
+    def rate_limited(self, connection):
+        if self.rate is None:
+            return False
+
+        now = time.time()
+        tokens, last = self.buckets.get(connection, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self.buckets[connection] = (tokens, now)
+            return True
+        self.buckets[connection] = (tokens - 1.0, now)
+        return False
+
+    def submit(self, connection, fn, *args):
+        """Queue an action.
+
+        :param connection: Key identifying the connection.
+        :param fn: Function that runs the action and returns a Future.
+        :returns: A Future that resolves to the result of ``fn`` (``None``
+            if it raised an exception) or ``None`` if the action was not
+            accepted, and the reason for not accepting the action
+            (``rate_limit``, ``queue_full``) or ``None``.
+        :rtype: (tornado.concurrent.Future, str)
+        """
+        if self.rate_limited(connection):
+            return None, 'rate_limit'
+
+        queue = self.queues.setdefault(connection, deque())
+        if len(queue) >= self.max_queue:
+            return None, 'queue_full'
+
+        future = tornado.concurrent.Future()
+        queue.append((fn, args, future))
+        if len(queue) == 1 and connection not in self.turns:
+            self.turns.append(connection)
+        self.dispatch()
+        return future, None
+
+    def can_run(self, connection):
+        if self.per_connection is None:
+            return True
+        return self.running[connection] < self.per_connection
+
+    def has_capacity(self):
+        if self.max_concurrent is None:
+            return True
+        return self.total_running < self.max_concurrent
+
+    def dispatch(self):
+        """Start queued actions while there is capacity."""
+        while self.turns and self.has_capacity():
+            connection = self.turns.popleft()
+            queue = self.queues.get(connection)
+            if not queue or not self.can_run(connection):
+                # requeued in finished()
+                continue
+
+            fn, args, future = queue.popleft()
+            self.running[connection] += 1
+            self.total_running += 1
+            if queue and self.can_run(connection):
+                self.turns.append(connection)
+
+            try:
+                result = tornado.gen.maybe_future(fn(*args))
+            except Exception as e:
+                result = tornado.concurrent.Future()
+                result.set_exception(e)
+            tornado.ioloop.IOLoop.current().add_future(
+                result,
+                lambda f, c=connection, r=future: self.finished(c, f, r))
+
+    def finished(self, connection, result, future):
+        self.running[connection] -= 1
+        self.total_running -= 1
+        if not self.running[connection]:
+            del self.running[connection]
+
+        try:
+            future.set_result(result.result())
+        except Exception:
+            log.error('Action failed.', exc_info=True)
+            future.set_result(None)
+
+        if self.queues.get(connection) and connection not in self.turns:
+            self.turns.append(connection)
+        self.dispatch()
+
+    def forget(self, connection):
+        """Drop all queued actions of a connection."""
+        self.queues.pop(connection, None)
+        self.buckets.pop(connection, None)
+        if connection in self.turns:
+            self.turns.remove(connection)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,229 @@
+"""Supervision of language kernel processes.
+
+The :data:`supervisor` checks all running kernels every ``interval``
+seconds:
+
+* kernels whose process exited are reported as ``exited``,
+* kernels are pinged and kernels that did not answer for
+  ``heartbeat_timeout`` seconds are terminated as ``unresponsive``,
+* kernels with a resident set size above ``max_rss`` are terminated as
+  ``memory``,
+* analysis instances in kernels without messages for ``idle_timeout``
+  seconds are ended as ``idle``.
+
+Events are sent to the frontends of the affected analysis instances as
+``__kernel`` signals and are counted in metrics. Python kernels exit by
+themselves when they stop receiving pings, e.g. because the server was
+killed, and their address space can be limited with ``rlimit_as``.
+Terminated kernel processes are killed when they do not exit within
+``kill_timeout`` seconds.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from . import metrics
+import logging
+import os
+import signal
+import time
+import tornado.ioloop
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover
+    psutil = None
+
+log = logging.getLogger(__name__)
+
+
+def rss(pid):
+    """Resident set size of a process in bytes or ``None`` if unknown."""
+    if pid is None:
+        return None
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class KernelSupervisor(object):
+    """Watch kernel processes.
+
+    :param float interval: Seconds between checks and pings.
+    :param float heartbeat_timeout: Terminate kernels that did not answer
+        pings for this many seconds. ``None`` disables it since Python
+        kernels cannot answer while they run an action.
+    :param float idle_timeout: End analysis instances without messages for
+        this many seconds. ``None`` disables it.
+    :param int max_rss: Terminate kernels with a larger resident set size
+        in bytes. ``None`` disables it.
+    :param int rlimit_as: Address space limit in bytes for Python kernels.
+    :param int max_restarts: Number of times the kernel of an analysis
+        instance is restarted after it exited or was terminated.
+    :param float kill_timeout: Seconds after which terminated kernels are
+        killed.
+    """
+
+    def __init__(self, interval=5.0, heartbeat_timeout=None,
+                 idle_timeout=None, max_rss=None, rlimit_as=None,
+                 max_restarts=0, kill_timeout=5.0):
+        self.interval = interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.max_rss = max_rss
+        self.rlimit_as = rlimit_as
+        self.max_restarts = max_restarts
+        self.kill_timeout = kill_timeout
+
+        self.kernels = set()
+        # terminated processes by the time they were terminated
+        self.terminated = {}
+        self.seq = 0
+        self.ioloop = None
+        self.periodic_callback = None
+
+    def configure(self, interval=None, heartbeat_timeout=None,
+                  idle_timeout=None, max_rss=None, rlimit_as=None,
+                  max_restarts=None):
+        if interval is not None:
+            self.interval = interval
+        if heartbeat_timeout is not None:
+            self.heartbeat_timeout = heartbeat_timeout or None
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout or None
+        if max_rss is not None:
+            self.max_rss = max_rss or None
+        if rlimit_as is not None:
+            self.rlimit_as = rlimit_as or None
+        if max_restarts is not None:
+            self.max_restarts = max_restarts
+        return self
+
+    @property
+    def orphan_timeout(self):
+        """Seconds after which kernels without pings exit."""
+        return 6.0 * self.interval
+
+    def cli_args(self):
+        """Command line arguments for Python kernels."""
+        if self.rlimit_as is None:
+            return []
+        return ['--rlimit-as={}'.format(self.rlimit_as)]
+
+    def watch(self, kernel):
+        """Supervise a kernel.
+
+        :param databench.analysis_zmq.Kernel kernel: The kernel.
+        """
+        kernel.last_pong = time.time()
+        self.kernels.add(kernel)
+        self.start()
+
+    def unwatch(self, kernel):
+        """Stop supervising a kernel and kill its process if it does not
+        exit within ``kill_timeout`` seconds."""
+        self.kernels.discard(kernel)
+        if hasattr(kernel.process, 'poll'):
+            self.terminated[kernel.process] = time.time()
+
+    def start(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        if self.periodic_callback is not None and self.ioloop is ioloop:
+            return
+
+        self.stop()
+        self.ioloop = ioloop
+        self.periodic_callback = tornado.ioloop.PeriodicCallback(
+            self.check, self.interval * 1000.0)
+        self.periodic_callback.start()
+
+    def stop(self):
+        if self.periodic_callback is not None:
+            self.periodic_callback.stop()
+        self.periodic_callback = None
+        self.ioloop = None
+
+    def check(self):
+        """Check and ping all kernels."""
+        now = time.time()
+        self.seq += 1
+        total_rss = 0
+        for kernel in list(self.kernels):
+            if kernel.process is None:
+                self.kernels.discard(kernel)
+                continue
+
+            exit_code = kernel.process.poll()
+            if exit_code is not None:
+                self.end(kernel, {'status': 'exited', 'exit_code': exit_code})
+                continue
+
+            if kernel.heartbeat:
+                if self.heartbeat_timeout is not None and \
+                   now - kernel.last_pong > self.heartbeat_timeout:
+                    self.end(kernel, {'status': 'unresponsive'})
+                    continue
+                kernel.ping(self.seq)
+
+            kernel_rss = rss(kernel.process.pid)
+            if kernel_rss is not None:
+                total_rss += kernel_rss
+                if self.max_rss is not None and kernel_rss > self.max_rss:
+                    self.end(kernel, {'status': 'memory', 'rss': kernel_rss})
+                    continue
+
+            if self.idle_timeout is not None:
+                for channel in kernel.channels():
+                    if channel.listener is not None and \
+                       channel.ready.done() and \
+                       now - channel.last_active > self.idle_timeout:
+                        self.end_idle(channel)
+        metrics.kernel_rss_bytes.set(total_rss)
+
+        self.kill_terminated(now)
+
+    def end(self, kernel, event):
+        """Terminate a kernel and report an event to its instances."""
+        log.warning('Kernel {} {}.'.format(kernel.id_, event['status']))
+        metrics.kernel_events.inc(event=event['status'])
+        listeners = [(c, c.listener) for c in kernel.channels()]
+        kernel.terminate()
+        for channel, listener in listeners:
+            if listener is not None:
+                listener({'analysis_id': channel.id_, '__kernel': event})
+
+    def end_idle(self, channel):
+        """End an idle analysis instance."""
+        log.info('Ending idle analysis {}.'.format(channel.id_))
+        metrics.kernel_events.inc(event='idle')
+        listener = channel.listener
+        channel.reap()
+        listener({'analysis_id': channel.id_,
+                  '__kernel': {'status': 'idle'}})
+
+    def kill_terminated(self, now):
+        for process, terminated in list(self.terminated.items()):
+            if process.poll() is not None:
+                del self.terminated[process]
+                continue
+            if now - terminated < self.kill_timeout:
+                continue
+
+            log.warning('Killing kernel process {}.'.format(process.pid))
+            metrics.kernel_events.inc(event='killed')
+            # wait for the process to be collected
+            self.terminated[process] = float('inf')
+            try:
+                os.kill(process.pid, getattr(signal, 'SIGKILL',
+                                             signal.SIGTERM))
+            except (OSError, TypeError):
+                pass
+
+
+supervisor = KernelSupervisor()
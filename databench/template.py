@@ -1,18 +1,31 @@
+import hashlib
 import os
+import threading
+import tornado.autoreload
 import tornado.template
 
 
 class Loader(tornado.template.BaseLoader):
     """Template Loader from a list of base directories.
 
-    First match is used.
+    First match is used. Resolved paths are memoized until :meth:`reset`.
     """
     def __init__(self, root_directories, **kwargs):
         super(Loader, self).__init__(**kwargs)
         self.roots = [os.path.abspath(root_directory)
                       for root_directory in root_directories]
+        self.resolved = {}
+
+    def reset(self):
+        super(Loader, self).reset()
+        with self.lock:
+            self.resolved = {}
 
     def resolve_path(self, name, parent_path=None):
+        key = (name, parent_path)
+        if key in self.resolved:
+            return self.resolved[key]
+
         for root in self.roots:
             if parent_path and not parent_path.startswith('<') and \
                 not parent_path.startswith('/') and \
@@ -20,6 +33,8 @@ class Loader(tornado.template.BaseLoader):
                 root = os.path.join(root, parent_path)
             path = os.path.join(root, name)
             if os.path.exists(path):
+                # only existing paths are memoized to bound the size
+                self.resolved[key] = path
                 return path
         return name
 
@@ -28,3 +43,69 @@ class Loader(tornado.template.BaseLoader):
             template = tornado.template.Template(
                 f.read(), name=name, loader=self)
             return template
+
+
+class PageCache(object):
+    """Rendered pages with strong ETags.
+
+    Pages are cached by a key that has to include everything the page
+    depends on, usually the template and the version of the analysis. The
+    cache is cleared on autoreload.
+    """
+    def __init__(self):
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.reload_hook = False
+
+    def __len__(self):
+        return len(self.pages)
+
+    def get(self, key, render):
+        """Get a page and render it if it is not cached.
+
+        :param key: Hashable cache key.
+        :param render: Function returning the rendered page as bytes.
+        :returns: (page, etag)
+        """
+        page = self.pages.get(key)
+        if page is not None:
+            return page
+
+        body = render()
+        page = (body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+        with self.lock:
+            self.pages[key] = page
+            if not self.reload_hook:
+                tornado.autoreload.add_reload_hook(self.clear)
+                self.reload_hook = True
+        return page
+
+    def clear(self):
+        with self.lock:
+            self.pages = {}
+
+    def render(self, handler, key, template_name, namespace):
+        """Finish a request with a cached page.
+
+        Renders without caching in debug mode. Responds with ``304`` when
+        the request's ``If-None-Match`` header matches.
+
+        :param tornado.web.RequestHandler handler: Request handler.
+        :param key: Cache key.
+        :param str template_name: Template to render.
+        :param namespace: Function returning the template arguments. It is
+            only called when the page is rendered.
+        """
+        if handler.settings.get('debug'):
+            return handler.render(template_name, **namespace())
+
+        body, etag = self.get(
+            key, lambda: handler.render_string(template_name, **namespace()))
+        handler.set_header('Etag', etag)
+        if handler.check_etag_header():
+            handler.set_status(304)
+            return handler.finish()
+        return handler.finish(body)
+
+
+page_cache = PageCache()
@@ -0,0 +1,45 @@
+import databench
+import databench_py.multithread
+import operator
+import time
+
+
+class Multithread_Py(databench.Analysis):
+
+    @databench.on
+    def sleep(self, seconds):
+        """Block a worker thread."""
+        time.sleep(seconds)
+        yield self.emit('slept', seconds)
+
+    @databench.on
+    def echo(self, value):
+        """Echo a value while other actions run."""
+        yield self.emit('echo', value)
+
+    @databench.on
+    def compute(self, i):
+        """Only the latest waiting invocation runs."""
+        time.sleep(0.2)
+        yield self.emit('compute', i)
+
+    @databench.on
+    def square(self, x):
+        """Compute in a process."""
+        result = yield self.run_in_process(operator.mul, x, x)
+        yield self.emit('square', result)
+
+    @databench.on
+    def flood(self, n):
+        """Emit many messages from a worker thread."""
+        for i in range(n):
+            self.emit('flood', i)
+
+
+if __name__ == "__main__":
+    analysis = databench_py.multithread.Meta(
+        'multithread_py', Multithread_Py,
+        policies={'echo': 'parallel', 'compute': 'latest'},
+        max_processes=1,
+    )
+    analysis.event_loop()
@@ -14,6 +14,18 @@ class Parameters_Py(databench.Analysis):
         """process an action without a message"""
         yield self.emit('test_action_ack')
 
+    @databench.on
+    def test_array(self, n):
+        """Emit a numpy array."""
+        import numpy as np
+        yield self.emit('test_array', np.arange(n, dtype='float64'))
+
+    @databench.on
+    def test_flood(self, n):
+        """Emit many messages in a tight loop."""
+        for i in range(n):
+            self.emit('test_flood', i)
+
     @databench.on
     def test_state(self, key, value):
         """Store some test data."""
@@ -0,0 +1,52 @@
+from databench import admission
+from databench.admission import Admission
+import tornado.gen
+import tornado.testing
+
+
+class TestAdmission(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_unlimited(self):
+        a = Admission('test', {})
+        for _ in range(3):
+            self.assertIsNone((yield a.acquire()))
+        self.assertEqual(a.instances, 3)
+        a.release()
+        self.assertEqual(a.instances, 2)
+
+    @tornado.testing.gen_test
+    def test_max_instances(self):
+        a = Admission('test', {'max_instances': 1})
+        self.assertIsNone((yield a.acquire()))
+        self.assertEqual((yield a.acquire()), 'max_instances')
+        a.release()
+        self.assertIsNone((yield a.acquire()))
+
+    @tornado.testing.gen_test
+    def test_queue(self):
+        a = Admission('test', {'max_instances': 1, 'admission_queue': 1})
+        self.assertIsNone((yield a.acquire()))
+        waiting = a.acquire()
+        self.assertEqual((yield a.acquire()), 'max_instances')
+        self.assertFalse(waiting.done())
+
+        a.release()
+        self.assertIsNone((yield waiting))
+        self.assertEqual(a.instances, 1)
+
+    @tornado.testing.gen_test
+    def test_queue_timeout(self):
+        a = Admission('test', {'max_instances': 1, 'admission_queue': 1,
+                               'admission_timeout': 0.01})
+        self.assertIsNone((yield a.acquire()))
+        self.assertEqual((yield a.acquire()), 'queue_timeout')
+        self.assertEqual(len(a.waiting), 0)
+
+    @tornado.testing.gen_test
+    def test_loop_lag(self):
+        a = Admission('test', {})
+        admission.MAX_LOOP_LAG = -1.0
+        try:
+            self.assertEqual((yield a.acquire()), 'loop_lag')
+        finally:
+            admission.MAX_LOOP_LAG = None
@@ -0,0 +1,82 @@
+from databench import assets
+from databench.assets import StaticHandler
+import databench
+import gzip
+import os
+import shutil
+import tempfile
+import tornado.testing
+import tornado.web
+
+
+class Assets(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content = b'var x = 1;\n' * 100
+        with open(os.path.join(self.root, 'app.js'), 'wb') as f:
+            f.write(self.content)
+        with open(os.path.join(self.root, 'small.js'), 'wb') as f:
+            f.write(b'var y;\n')
+        super(Assets, self).setUp()
+
+    def tearDown(self):
+        super(Assets, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/s/(.*)', StaticHandler, {'path': self.root}),
+        ])
+
+    def test_compress(self):
+        written = assets.compress([self.root])
+        gz = os.path.join(self.root, 'app.js.gz')
+        self.assertIn(gz, written)
+        self.assertNotIn(os.path.join(self.root, 'small.js.gz'), written)
+        with gzip.open(gz, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        # up to date variants are not rewritten
+        self.assertEqual(assets.compress([self.root]), [])
+
+    def test_precompressed(self):
+        assets.compress([self.root])
+        response = self.fetch('/s/app.js', decompress_response=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', response.headers['Content-Type'])
+        self.assertEqual(gzip.GzipFile(fileobj=response.buffer).read(),
+                         self.content)
+
+        response = self.fetch('/s/app.js', decompress_response=False,
+                              headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.content)
+
+    def test_stale_variant(self):
+        assets.compress([self.root])
+        path = os.path.join(self.root, 'app.js')
+        mtime = os.path.getmtime(path + '.gz')
+        os.utime(path, (mtime + 10, mtime + 10))
+        response = self.fetch('/s/app.js', decompress_response=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_immutable(self):
+        response = self.fetch('/s/app.js?v=abc')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response = self.fetch('/s/app.js')
+        self.assertNotIn('Cache-Control', response.headers)
+
+
+class Fingerprints(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return databench.App('databench.tests.analyses').tornado_app()
+
+    def test_static_url(self):
+        response = self.fetch('/')
+        self.assertIn(b'/_static/databench.css?v=', response.body)
+        response = self.fetch('/_static/databench.css?v=1')
+        self.assertEqual(response.code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
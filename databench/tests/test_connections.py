@@ -0,0 +1,69 @@
+from databench.connections import ConnectionRegistry
+import time
+import tornado.testing
+
+
+class FakeHandler(object):
+    def __init__(self):
+        self.ws_connection = object()
+        self.pings = 0
+        self.closed = False
+
+    def analysis_id(self):
+        return None
+
+    def ping(self, data):
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+        self.ws_connection = None
+
+
+class Registry(tornado.testing.AsyncTestCase):
+    def test_register(self):
+        registry = ConnectionRegistry(slots=2)
+        handlers = [FakeHandler() for _ in range(3)]
+        for handler in handlers:
+            registry.register(handler)
+        self.assertEqual(len(registry), 3)
+        self.assertIsNotNone(registry.periodic_callback)
+
+        for handler in handlers:
+            registry.unregister(handler)
+        self.assertEqual(len(registry), 0)
+        self.assertIsNone(registry.periodic_callback)
+
+    def test_wheel(self):
+        registry = ConnectionRegistry(slots=2)
+        handlers = [FakeHandler() for _ in range(4)]
+        for handler in handlers:
+            registry.register(handler)
+
+        registry.tick()
+        self.assertEqual([h.pings for h in handlers], [0, 1, 0, 1])
+        registry.tick()
+        self.assertEqual([h.pings for h in handlers], [1, 1, 1, 1])
+        registry.stop()
+
+    def test_idle(self):
+        registry = ConnectionRegistry(idle_timeout=1000, slots=1)
+        active, idle = FakeHandler(), FakeHandler()
+        registry.register(active)
+        registry.register(idle)
+        idle.last_active = time.time() - 2.0
+
+        registry.tick()
+        self.assertEqual(active.pings, 1)
+        self.assertTrue(idle.closed)
+        self.assertEqual(list(registry), [active])
+        registry.stop()
+
+    def test_closed(self):
+        registry = ConnectionRegistry(slots=1)
+        handler = FakeHandler()
+        registry.register(handler)
+        handler.ws_connection = None
+
+        registry.tick()
+        self.assertEqual(len(registry), 0)
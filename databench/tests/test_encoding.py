@@ -0,0 +1,111 @@
+from databench import encoding
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class TestEncoding(unittest.TestCase):
+    def test_negotiate_fallback(self):
+        self.assertIs(encoding.negotiate(None), encoding.JSONEncoding)
+        self.assertIs(encoding.negotiate(['cbor']), encoding.JSONEncoding)
+
+    def test_negotiate_preference(self):
+        self.assertIs(encoding.negotiate(['json', 'msgpack']),
+                      encoding.JSONEncoding)
+
+    def test_json_roundtrip(self):
+        data = {'signal': 'data', 'load': {'values': {1, 2}}}
+        encoded = encoding.JSONEncoding.encode(data)
+        self.assertEqual(encoding.JSONEncoding.decode(encoded),
+                         {'signal': 'data', 'load': {'values': [1, 2]}})
+
+
+@unittest.skipIf(encoding.msgpack is None, 'msgpack not installed')
+class TestMsgPackEncoding(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertIs(encoding.negotiate(['msgpack', 'json']),
+                      encoding.MsgPackEncoding)
+
+    def test_roundtrip(self):
+        data = {'signal': 'data', 'load': {'light': 'red', 'values': {1}}}
+        encoded = encoding.MsgPackEncoding.encode(data)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(encoding.MsgPackEncoding.decode(encoded),
+                         {'signal': 'data',
+                          'load': {'light': 'red', 'values': [1]}})
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def test_typed_array(self):
+        encoded = encoding.MsgPackEncoding.encode(
+            np.array([1.0, 2.0], dtype='float64'))
+        ext = encoding.msgpack.unpackb(encoded)
+        self.assertEqual(ext.code, encoding.TYPED_ARRAY_EXT)
+        self.assertEqual(ext.data[0:1], b'\x07')
+        self.assertEqual(len(ext.data), 1 + 2 * 8)
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def test_other_array(self):
+        encoded = encoding.MsgPackEncoding.encode(np.array([[1, 2], [3, 4]]))
+        self.assertEqual(encoding.MsgPackEncoding.decode(encoded),
+                         [[1, 2], [3, 4]])
+
+
+@unittest.skipIf(np is None, 'numpy not installed')
+class TestBuffers(unittest.TestCase):
+    def test_roundtrip(self):
+        data = {'small': np.arange(3),
+                'arrays': [np.arange(200, dtype='float64'),
+                           np.ones((40, 10), dtype='int32')]}
+        buffers = []
+        packed = encoding.pack_buffers(data, buffers)
+        self.assertEqual(len(buffers), 2)
+        self.assertIs(packed['small'], data['small'])
+        self.assertEqual(packed['arrays'][0],
+                         {'__buffer': 0, 'dtype': '<f8', 'shape': [200]})
+
+        unpacked = encoding.unpack_buffers(
+            packed, [memoryview(b.tobytes()) for b in buffers])
+        np.testing.assert_array_equal(unpacked['arrays'][0],
+                                      data['arrays'][0])
+        np.testing.assert_array_equal(unpacked['arrays'][1],
+                                      data['arrays'][1])
+        self.assertEqual(unpacked['arrays'][1].shape, (40, 10))
+
+
+class TestEncodedFrame(unittest.TestCase):
+    def test_json_peek_signal(self):
+        peek = encoding.JSONEncoding.peek_signal
+        self.assertEqual(peek('{"signal":"run","load":[1]}'), 'run')
+        self.assertEqual(peek(b'{ "signal": "run" }'), 'run')
+        self.assertIsNone(peek('{"load":1,"signal":"run"}'))
+        self.assertIsNone(peek('{"__connect":null}'))
+
+    def test_json_forward(self):
+        data = encoding.JSONEncoding.encode({'signal': 'a', 'load': 1})
+        frame = encoding.EncodedFrame(data, encoding.JSONEncoding, 'a')
+        self.assertIs(frame.encode(encoding.JSONEncoding), data)
+        joined = encoding.JSONEncoding.join([data, data])
+        self.assertEqual(encoding.JSONEncoding.decode(joined),
+                         [{'signal': 'a', 'load': 1}] * 2)
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        msgpack_encoding = encoding.MsgPackEncoding
+        data = msgpack_encoding.encode({'signal': 'a', 'load': [1, 2]})
+        self.assertEqual(msgpack_encoding.peek_signal(data), 'a')
+        self.assertIsNone(msgpack_encoding.peek_signal(b'\xc1'))
+        self.assertEqual(msgpack_encoding.decode(msgpack_encoding.join(
+            [data, data])), [{'signal': 'a', 'load': [1, 2]}] * 2)
+
+        # re-encoded for a frontend with a different encoding
+        frame = encoding.EncodedFrame(data, msgpack_encoding, 'a')
+        self.assertEqual(
+            encoding.JSONEncoding.decode(frame.encode(encoding.JSONEncoding)),
+            {'signal': 'a', 'load': [1, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+from databench import encoding
+from databench.connections import registry, sessions
+import databench
+import json
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+
+
+class Echo(databench.Analysis):
+    @databench.on
+    def ping(self, value):
+        yield self.emit('pong', value)
+
+    @databench.on
+    def burst(self, n):
+        for i in range(n):
+            self.emit('burst', i)
+
+
+class Frontend(tornado.testing.AsyncHTTPTestCase):
+    """Tests of the websocket protocol of the FrontendHandler."""
+
+    def get_app(self):
+        return databench.app.SingleApp(
+            Echo, __file__, info={'session_grace': 10}).tornado_app()
+
+    @tornado.gen.coroutine
+    def ws_connect(self, encodings=None, batch=False, analysis_id=None):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': analysis_id,
+                                     '__encodings': encodings,
+                                     '__batch': batch}))
+        connect = json.loads((yield ws.read_message()))
+        raise tornado.gen.Return((ws, connect))
+
+    @tornado.gen.coroutine
+    def read_until(self, ws, signal, decode=json.loads):
+        while True:
+            msg = decode((yield ws.read_message()))
+            if msg['signal'] == signal:
+                raise tornado.gen.Return(msg)
+
+    @tornado.testing.gen_test
+    def test_json(self):
+        ws, connect = yield self.ws_connect()
+        self.assertEqual(connect['load']['encoding'], 'json')
+        ws.write_message(json.dumps({'signal': 'ping', 'load': 42}))
+        msg = yield self.read_until(ws, 'pong')
+        self.assertEqual(msg['load'], 42)
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_msgpack(self):
+        if encoding.msgpack is None:
+            self.skipTest('msgpack not installed')
+
+        ws, connect = yield self.ws_connect(['msgpack', 'json'])
+        self.assertEqual(connect['load']['encoding'], 'msgpack')
+        ws.write_message(encoding.MsgPackEncoding.encode(
+            {'signal': 'ping', 'load': 42}), binary=True)
+        msg = yield self.read_until(ws, 'pong',
+                                    encoding.MsgPackEncoding.decode)
+        self.assertEqual(msg['load'], 42)
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_batch(self):
+        ws, _ = yield self.ws_connect(batch=True)
+        ws.write_message(json.dumps({'signal': 'burst', 'load': 3}))
+        frame = json.loads((yield ws.read_message()))
+        self.assertEqual(frame, [{'signal': 'burst', 'load': 0},
+                                 {'signal': 'burst', 'load': 1},
+                                 {'signal': 'burst', 'load': 2}])
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_no_batch(self):
+        ws, _ = yield self.ws_connect()
+        ws.write_message(json.dumps({'signal': 'burst', 'load': 2}))
+        first = json.loads((yield ws.read_message()))
+        second = json.loads((yield ws.read_message()))
+        self.assertEqual(first, {'signal': 'burst', 'load': 0})
+        self.assertEqual(second, {'signal': 'burst', 'load': 1})
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_registry(self):
+        ws, connect = yield self.ws_connect()
+        analysis_ids = [c['analysis_id'] for c in registry.list()]
+        self.assertIn(connect['load']['analysis_id'], analysis_ids)
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_resume(self):
+        ws, connect = yield self.ws_connect()
+        analysis_id = connect['load']['analysis_id']
+        self.assertFalse(connect['load']['resumed'])
+        ws.write_message(json.dumps({'signal': 'set_state',
+                                     'load': {'light': 'red'}}))
+        yield self.read_until(ws, 'data')
+        ws.close()
+        while analysis_id not in sessions:
+            yield tornado.gen.sleep(0.01)
+
+        ws, connect = yield self.ws_connect(analysis_id=analysis_id)
+        self.assertTrue(connect['load']['resumed'])
+        self.assertEqual(connect['load']['analysis_id'], analysis_id)
+        self.assertNotIn(analysis_id, sessions)
+        msg = yield self.read_until(ws, 'data')
+        self.assertEqual(msg['load'], {'light': 'red'})
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_metrics(self):
+        ws, _ = yield self.ws_connect()
+        ws.write_message(json.dumps({'signal': 'unknown_x1'}))
+        ws.write_message(json.dumps({'signal': 'ping', 'load': 42}))
+        yield self.read_until(ws, 'pong')
+
+        response = yield self.http_client.fetch(self.get_url('/metrics'))
+        text = response.body.decode('utf-8')
+        self.assertIn('databench_messages_in_total'
+                      '{analysis="echo",action="ping"}', text)
+        self.assertIn('databench_run_process_seconds_count'
+                      '{analysis="echo",action="ping"}', text)
+
+        # signals without handlers do not create new labels
+        self.assertIn('databench_messages_in_total'
+                      '{analysis="echo",action="other"}', text)
+        self.assertNotIn('unknown_x1', text)
+        ws.close()
+
+
+class Busy(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return databench.app.SingleApp(
+            Echo, __file__, info={'max_instances': 1}).tornado_app()
+
+    @tornado.testing.gen_test
+    def test_busy(self):
+        url = 'ws://127.0.0.1:{}/ws'.format(self.get_http_port())
+        first = yield tornado.websocket.websocket_connect(url)
+        first.write_message(json.dumps({'__connect': None}))
+        yield first.read_message()
+
+        second = yield tornado.websocket.websocket_connect(url)
+        second.write_message(json.dumps({'__connect': None}))
+        msg = json.loads((yield second.read_message()))
+        self.assertEqual(msg['signal'], '__busy')
+        self.assertEqual(msg['load']['reason'], 'max_instances')
+        self.assertIsNone((yield second.read_message()))
+        self.assertEqual(second.close_code, 1013)
+        first.close()
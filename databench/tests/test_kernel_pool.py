@@ -0,0 +1,579 @@
+from databench.analysis_zmq import ForkedProcess, KernelChannel
+from databench import analysis_zmq
+from databench.connections import registry
+from databench import encoding
+from databench_py.singlethread import Meta as KernelMeta
+import databench
+import json
+import os
+import tornado.concurrent
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+import unittest
+import zmq
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class KernelTestCase(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        # make databench_py importable for the kernel processes
+        self.pythonpath = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            p for p in (REPO_ROOT, self.pythonpath) if p)
+        super(KernelTestCase, self).setUp()
+
+    def tearDown(self):
+        super(KernelTestCase, self).tearDown()
+        if self.pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.pythonpath
+
+
+class KernelPool(KernelTestCase):
+    def tearDown(self):
+        self.pool.close()
+        super(KernelPool, self).tearDown()
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'parameters_py')
+        lazy.overrides['kernel_pool_min_idle'] = 1
+        self.meta = lazy.materialize()
+        self.pool = self.meta.kernel_pool
+        return self.app.tornado_app()
+
+    @tornado.gen.coroutine
+    def ready_kernel(self):
+        kernel = self.pool.idle[0]
+        yield tornado.gen.with_timeout(self.io_loop.time() + 10, kernel.ready)
+        raise tornado.gen.Return(kernel)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_fill(self):
+        self.assertEqual(len(self.pool.idle), 1)
+        kernel = yield self.ready_kernel()
+        self.assertTrue(kernel.id_.startswith('_pool-parameters_py-'))
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_assign(self):
+        kernel = yield self.ready_kernel()
+
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        connect = json.loads((yield ws.read_message()))
+        analysis_id = connect['load']['analysis_id']
+        self.assertEqual(kernel.id_, analysis_id)
+        self.assertNotIn(kernel, self.pool.idle)
+
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+
+        # refilled in the background
+        self.assertEqual(len(self.pool.idle), 1)
+        self.assertIsNot(self.pool.idle[0], kernel)
+        ws.close()
+        kernel.terminate()
+
+
+class Zygote(KernelTestCase):
+    def tearDown(self):
+        self.zygote.close()
+        super(Zygote, self).tearDown()
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'parameters_py')
+        lazy.overrides['kernel_zygote'] = True
+        self.meta = lazy.materialize()
+        self.zygote = self.meta.zygote
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_fork(self):
+        deadline = self.io_loop.time() + 10
+        while not self.zygote.ready and self.io_loop.time() < deadline:
+            yield tornado.gen.sleep(0.05)
+        self.assertTrue(self.zygote.ready)
+
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta is self.meta)
+        self.assertIsInstance(kernel.process, ForkedProcess)
+        self.assertIsNotNone(kernel.process.pid)
+        ws.close()
+        kernel.terminate()
+
+
+class Multiplex(KernelTestCase):
+    def tearDown(self):
+        self.multiplexer.close()
+        super(Multiplex, self).tearDown()
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'parameters_py')
+        lazy.overrides['kernel_multiplex'] = 1
+        self.meta = lazy.materialize()
+        self.multiplexer = self.meta.multiplexer
+        return self.app.tornado_app()
+
+    @tornado.gen.coroutine
+    def connect(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+        raise tornado.gen.Return(ws)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_sessions(self):
+        kernel = self.multiplexer.kernels[0]
+        ws1 = yield self.connect()
+        ws2 = yield self.connect()
+        self.assertEqual(len(kernel.sessions), 2)
+
+        ws1.close()
+        deadline = self.io_loop.time() + 5
+        while len(kernel.sessions) > 1 and self.io_loop.time() < deadline:
+            yield tornado.gen.sleep(0.05)
+        self.assertEqual(len(kernel.sessions), 1)
+        self.assertIsNotNone(kernel.process)
+        ws2.close()
+
+
+class IPCTransport(KernelTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses',
+                                 zmq_transport='ipc')
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_action(self):
+        self.assertTrue(self.app.kernel_router.address.startswith('ipc://'))
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == 'parameters_py')
+        ws.close()
+        kernel.terminate()
+
+    def test_unknown_kernel(self):
+        with self.assertRaises(zmq.ZMQError):
+            self.app.kernel_router.send(b'unknown', b'unknown|{}')
+
+
+class RecordingKernel(object):
+    def __init__(self):
+        self.received = []
+
+    def zmq_listener(self, frames):
+        self.received.append([f.bytes for f in frames])
+
+
+class Router(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(Router, self).setUp()
+        self.router = analysis_zmq.KernelRouter()
+        self.dealers = []
+
+    def tearDown(self):
+        for dealer in self.dealers:
+            dealer.close(0)
+        self.router.close()
+        self.router.socket.close(0)
+        super(Router, self).tearDown()
+
+    def dealer(self, identity):
+        dealer = zmq.Context.instance().socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, identity)
+        dealer.connect(self.router.address)
+        self.dealers.append(dealer)
+        return dealer
+
+    @tornado.gen.coroutine
+    def recv(self, dealer, n):
+        received = []
+        deadline = self.io_loop.time() + 5.0
+        while len(received) < n and self.io_loop.time() < deadline:
+            try:
+                received.append(dealer.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                yield tornado.gen.sleep(0.01)
+        raise tornado.gen.Return(received)
+
+    @tornado.testing.gen_test
+    def test_unreachable(self):
+        kernel = RecordingKernel()
+        self.router.register(b'late', kernel)
+        for i in range(3):
+            self.router.send(b'late', 'late|{}'.format(i).encode('utf-8'))
+        self.assertEqual(len(self.router.pending[b'late']), 3)
+
+        # queued messages are sent once the kernel sent a message
+        dealer = self.dealer(b'late')
+        dealer.send(b'handshake')
+        received = yield self.recv(dealer, 3)
+        self.assertEqual(received, [[b'late|0'], [b'late|1'], [b'late|2']])
+        self.assertEqual(kernel.received, [[b'handshake']])
+        self.assertNotIn(b'late', self.router.pending)
+
+    @tornado.testing.gen_test
+    def test_full(self):
+        router = analysis_zmq.KernelRouter('inproc://databench-full', hwm=1)
+        router.register(b'slow', RecordingKernel())
+        dealer = zmq.Context.instance().socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, b'slow')
+        dealer.setsockopt(zmq.RCVHWM, 1)
+        dealer.connect(router.address)
+        self.dealers.append(dealer)
+
+        # the queue of the kernel fills up without blocking
+        for i in range(20):
+            router.send(b'slow', 'slow|{}'.format(i).encode('utf-8'))
+        self.assertGreater(len(router.pending[b'slow']), 0)
+
+        # all messages arrive in order once the kernel reads them
+        received = yield self.recv(dealer, 20)
+        self.assertEqual(received, [['slow|{}'.format(i).encode('utf-8')]
+                                    for i in range(20)])
+        self.assertNotIn(b'slow', router.pending)
+        router.close()
+        router.socket.close(0)
+
+    def test_closed(self):
+        router = analysis_zmq.KernelRouter()
+        router.register(b'orphan', RecordingKernel())
+        router.close()
+        router.send(b'orphan', b'orphan|{}')
+
+    def test_unregister(self):
+        self.router.register(b'gone', RecordingKernel())
+        self.router.send(b'gone', b'gone|{}')
+        self.router.unregister(b'gone')
+        self.assertNotIn(b'gone', self.router.pending)
+
+
+class RecordingChannel(KernelChannel):
+    def __init__(self, analysis_id):
+        super(RecordingChannel, self).__init__(analysis_id)
+        self.published = []
+
+    def publish(self, analysis_id, data):
+        self.published.append((analysis_id, data))
+
+
+class Channel(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            KernelChannel('abc')
+
+    def test_buffer(self):
+        channel = RecordingChannel('abc')
+        channel.send({'signal': 'connect'})
+        channel.send({'signal': 'connected'})
+        self.assertEqual(channel.published, [])
+
+        channel.on_handshake({'disconnect_ack': True})
+        self.assertTrue(channel.ready.done())
+        self.assertTrue(channel.acks_disconnect)
+        self.assertEqual(channel.published, [
+            ('abc', {'__zmq_ack': None, 'buffers': encoding.np is not None}),
+            ('abc', {'signal': 'connect'}),
+            ('abc', {'signal': 'connected'}),
+        ])
+
+        channel.send({'signal': 'ack'})
+        self.assertEqual(channel.published[-1], ('abc', {'signal': 'ack'}))
+
+    def test_actions(self):
+        channel = RecordingChannel('abc')
+        self.assertEqual(channel.actions, frozenset())
+        channel.on_handshake({'actions': ['connect', 'run']})
+        self.assertEqual(channel.actions, frozenset(['connect', 'run']))
+
+    def test_credits(self):
+        channel = RecordingChannel('abc')
+        channel.on_handshake({'credits': True})
+        self.assertEqual(channel.published[-1][1]['credits'],
+                         analysis_zmq.KERNEL_CREDITS)
+
+        batch = analysis_zmq.KERNEL_CREDITS // 4
+        for _ in range(batch - 1):
+            channel.on_frame(None)
+        self.assertNotIn('__credits', channel.published[-1][1])
+        written = tornado.concurrent.Future()
+        written.set_result(None)
+        channel.on_frame(written)
+        self.assertEqual(channel.published[-1], ('abc', {'__credits': batch}))
+
+
+class KernelDecode(unittest.TestCase):
+    def test_control(self):
+        self.assertEqual(
+            KernelMeta.decode([b'abc|{"__credits": 4}']),
+            ('abc', {'__credits': 4}),
+        )
+
+    def test_forwarded(self):
+        # frontends cannot send control messages
+        frame = json.dumps({'signal': 'run', 'load': [1],
+                            '__credits': 1e9, '__assign': 'other'})
+        self.assertEqual(
+            KernelMeta.decode([b'abc|', frame.encode('utf-8')]),
+            ('abc', {'signal': 'run', 'load': [1]}),
+        )
+
+
+class Disconnect(KernelTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_acknowledged(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+
+        handler = next(h for h in registry if h.meta.name == 'parameters_py')
+        kernel = handler.analysis.kernel
+        self.assertTrue(kernel.acks_disconnect)
+
+        # action handlers of the kernel are metric labels
+        self.assertEqual(
+            handler.meta.action_label('test_action', handler.analysis),
+            'test_action')
+        self.assertEqual(
+            handler.meta.action_label('unknown', handler.analysis), 'other')
+        ws.close()
+        yield tornado.gen.with_timeout(self.io_loop.time() + 4,
+                                       kernel.stopped)
+        while kernel.process is not None:
+            yield tornado.gen.sleep(0.01)
+
+
+@unittest.skipIf(encoding.np is None or encoding.msgpack is None,
+                 'numpy or msgpack not installed')
+class Buffers(KernelTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'parameters_py')
+        # kernels send decoded messages when frames are not forwarded
+        lazy.materialize().forwards_frames = False
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_array(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None,
+                                     '__encodings': ['msgpack']}))
+        yield ws.read_message()
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == 'parameters_py')
+        received = []
+        listener = kernel.listener
+        kernel.listener = lambda msg: received.append(msg) or listener(msg)
+
+        ws.write_message(encoding.MsgPackEncoding.encode(
+            {'signal': 'test_array', 'load': [1000]}), binary=True)
+        while True:
+            msg = encoding.MsgPackEncoding.decode((yield ws.read_message()))
+            if msg['signal'] == 'test_array':
+                break
+
+        # sent to the frontend as a typed array
+        self.assertEqual(msg['load'].code, encoding.TYPED_ARRAY_EXT)
+        self.assertEqual(len(msg['load'].data), 1 + 8 * 1000)
+        # received from the kernel as an array
+        load = next(m['frame']['load'] for m in received
+                    if m.get('frame', {}).get('signal') == 'test_array')
+        self.assertIsInstance(load, encoding.np.ndarray)
+        ws.close()
+        kernel.terminate()
+
+
+@unittest.skipIf(encoding.np is None or encoding.msgpack is None,
+                 'numpy or msgpack not installed')
+class Frames(KernelTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_forward(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None,
+                                     '__encodings': ['msgpack']}))
+        yield ws.read_message()
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == 'parameters_py')
+        received = []
+        listener = kernel.listener
+        kernel.listener = lambda msg: received.append(msg) or listener(msg)
+
+        ws.write_message(encoding.MsgPackEncoding.encode(
+            {'signal': 'test_array', 'load': [1000]}), binary=True)
+        while True:
+            msg = encoding.MsgPackEncoding.decode((yield ws.read_message()))
+            if msg['signal'] == 'test_array':
+                break
+
+        # encoded by the kernel
+        self.assertEqual(msg['load'].code, encoding.TYPED_ARRAY_EXT)
+        frame = next(m['__frame'] for m in received
+                     if '__frame' in m and m['__frame'].signal == 'test_array')
+        self.assertIs(frame.encoding, encoding.MsgPackEncoding)
+        ws.close()
+        kernel.terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_forwarded_control(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == 'parameters_py')
+
+        # control messages from frontends are not processed: negative
+        # credits would block the kernel
+        ws.write_message(json.dumps({'signal': 'test_action',
+                                     '__credits': -1000,
+                                     '__assign': 'other'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+        ws.write_message(json.dumps({'signal': 'test_flood', 'load': [10]}))
+        received = []
+        while len(received) < 10:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_flood':
+                received.append(msg['load'])
+        self.assertEqual(received, list(range(10)))
+        ws.close()
+        kernel.terminate()
+
+
+class FlowControl(KernelTestCase):
+    def setUp(self):
+        self.credits = analysis_zmq.KERNEL_CREDITS
+        analysis_zmq.KERNEL_CREDITS = 4
+        super(FlowControl, self).setUp()
+
+    def tearDown(self):
+        super(FlowControl, self).tearDown()
+        analysis_zmq.KERNEL_CREDITS = self.credits
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses', zmq_hwm=10)
+        return self.app.tornado_app()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_flood(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        ws.write_message(json.dumps({'signal': 'test_flood', 'load': [500]}))
+
+        # nothing is lost
+        received = []
+        while len(received) < 500:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_flood':
+                received.append(msg['load'])
+        self.assertEqual(received, list(range(500)))
+
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == 'parameters_py')
+        self.assertTrue(kernel.flow_control)
+        ws.close()
+        kernel.terminate()
+
+
+@unittest.skipIf(encoding.np is None or encoding.msgpack is None,
+                 'numpy or msgpack not installed')
+class FrameArrays(KernelTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        return self.app.tornado_app()
+
+    @tornado.gen.coroutine
+    def emit_array(self, name, ws_encoding):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/{}/ws'.format(self.get_http_port(), name))
+        ws.write_message(json.dumps({'__connect': None,
+                                     '__encodings': [ws_encoding.name]}))
+        yield ws.read_message()
+        kernel = next(h.analysis.kernel for h in registry
+                      if h.meta.name == name)
+        received = []
+        listener = kernel.listener
+        kernel.listener = lambda msg: received.append(msg) or listener(msg)
+
+        ws.write_message(ws_encoding.encode(
+            {'signal': 'test_array', 'load': [1000]}),
+            binary=ws_encoding.binary)
+        while True:
+            msg = ws_encoding.decode((yield ws.read_message()))
+            if msg['signal'] == 'test_array':
+                break
+        ws.close()
+        kernel.terminate()
+        raise tornado.gen.Return((msg, received))
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_msgpack(self):
+        msg, received = yield self.emit_array('parameters_py',
+                                              encoding.MsgPackEncoding)
+        # encoded by the kernel as a typed array and forwarded by main
+        self.assertEqual(msg['load'].code, encoding.TYPED_ARRAY_EXT)
+        self.assertEqual(len(msg['load'].data), 1 + 8 * 1000)
+        frames = [m['__frame'] for m in received if '__frame' in m]
+        frame = next(f for f in frames if f.signal == 'test_array')
+        self.assertIs(frame.encoding, encoding.MsgPackEncoding)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_json(self):
+        msg, _ = yield self.emit_array('parameters_py',
+                                       encoding.JSONEncoding)
+        self.assertEqual(msg['load'], list(range(1000)))
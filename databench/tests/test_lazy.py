@@ -0,0 +1,73 @@
+from databench.template import page_cache
+import databench
+import json
+import sys
+import tornado.testing
+import tornado.websocket
+
+
+class Lazy(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        return self.app.tornado_app()
+
+    def meta(self, name):
+        return next(m for m in self.app.metas if m.name == name)
+
+    def test_index(self):
+        response = self.fetch('/')
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'Parameters with Python Kernel', response.body)
+        self.assertIsNone(self.meta('simple3').meta)
+
+    def test_index_after_first_request(self):
+        # without a title in index.yaml
+        simple3 = self.meta('simple3')
+        del simple3.overrides['title']
+        simple3.info['title'] = 'simple3'
+        page_cache.clear()
+        response = self.fetch('/')
+        self.assertIn(b'\nsimple3\n', response.body)
+        self.assertEqual(self.fetch('/simple3/').code, 200)
+
+        # the title is the name of the analysis class
+        response = self.fetch('/')
+        self.assertIn(b'\nSimple3\n', response.body)
+
+    def test_first_request(self):
+        simple3 = self.meta('simple3')
+        self.assertIsNone(simple3.meta)
+        response = self.fetch('/simple3/')
+        self.assertEqual(response.code, 200)
+        self.assertIsNotNone(simple3.meta)
+        self.assertIs(simple3.info, simple3.meta.info)
+        self.assertEqual(simple3.info['home_link'], '/')
+        self.assertIn('databench.tests.analyses.simple3.analysis',
+                      sys.modules)
+
+    @tornado.testing.gen_test
+    def test_websocket(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/simple1/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        connect = json.loads((yield ws.read_message()))
+        self.assertEqual(connect['signal'], '__connect')
+        ws.close()
+
+    def test_not_found(self):
+        response = self.fetch('/simple3/doesnotexist.js')
+        self.assertEqual(response.code, 404)
+
+
+class Broken(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return databench.App('databench.tests.analyses_broken').tornado_app()
+
+    def test_index(self):
+        response = self.fetch('/')
+        self.assertEqual(response.code, 200)
+        self.assertNotIn(b'Does Not Exist', response.body)
+
+    def test_not_found(self):
+        response = self.fetch('/doesnotexist/')
+        self.assertEqual(response.code, 404)
@@ -0,0 +1,49 @@
+from databench import metrics
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ('action',))
+        counter.inc(action='run')
+        counter.inc(2, action='run')
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{action="run"} 3',
+        ]))
+
+    def test_labels(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ('action',))
+        self.assertRaises(ValueError, counter.inc, signal='run')
+
+    def test_escape(self):
+        self.assertEqual(metrics.format_labels([('a', 'x"y\\')]),
+                         '{a="x\\"y\\\\"}')
+
+    def test_gauge_function(self):
+        gauge = metrics.Gauge('test', 'Test gauge.').set_function(lambda: 4)
+        self.assertIn('test 4', gauge.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.',
+                                      buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5.0)
+        self.assertEqual(histogram.render().split('\n')[2:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+    def test_registry(self):
+        text = metrics.metrics.render()
+        self.assertIn('# TYPE databench_connections_open gauge', text)
+        self.assertIn('databench_kernels 0', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
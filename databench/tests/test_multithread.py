@@ -0,0 +1,129 @@
+from databench import analysis_zmq
+from databench.connections import registry
+from databench.supervisor import supervisor
+from databench.tests.test_kernel_pool import KernelTestCase
+import databench
+import json
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+
+
+class Multithread(KernelTestCase):
+    def setUp(self):
+        self.credits = analysis_zmq.KERNEL_CREDITS
+        analysis_zmq.KERNEL_CREDITS = 4
+        self.config = dict(vars(supervisor))
+        supervisor.stop()
+        supervisor.configure(interval=0.1)
+        super(Multithread, self).setUp()
+
+    def tearDown(self):
+        super(Multithread, self).tearDown()
+        supervisor.stop()
+        vars(supervisor).update(self.config)
+        analysis_zmq.KERNEL_CREDITS = self.credits
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'multithread_py')
+        self.meta = lazy.materialize()
+        return self.app.tornado_app()
+
+    @tornado.gen.coroutine
+    def connect(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/multithread_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        raise tornado.gen.Return(ws)
+
+    def send(self, ws, signal, load):
+        ws.write_message(json.dumps({'signal': signal, 'load': load}))
+
+    @tornado.gen.coroutine
+    def read(self, ws, *signals):
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] in signals:
+                raise tornado.gen.Return((msg['signal'], msg['load']))
+
+    def kernel(self):
+        return next(h.analysis.kernel for h in registry
+                    if h.meta is self.meta)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_parallel(self):
+        ws = yield self.connect()
+        self.send(ws, 'sleep', [1.0])
+        self.send(ws, 'echo', ['hello'])
+        msg = yield self.read(ws, 'slept', 'echo')
+        self.assertEqual(msg, ('echo', 'hello'))
+        msg = yield self.read(ws, 'slept', 'echo')
+        self.assertEqual(msg, ('slept', 1.0))
+        ws.close()
+        self.kernel().terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_latest(self):
+        ws = yield self.connect()
+        self.send(ws, 'sleep', [0.5])
+        for i in range(5):
+            self.send(ws, 'compute', [i])
+        yield self.read(ws, 'slept')
+        msg = yield self.read(ws, 'compute')
+        self.assertEqual(msg, ('compute', 4))
+        ws.close()
+        self.kernel().terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_process(self):
+        ws = yield self.connect()
+        self.send(ws, 'square', [7])
+        msg = yield self.read(ws, 'square')
+        self.assertEqual(msg, ('square', 49))
+        ws.close()
+        self.kernel().terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_flood(self):
+        ws = yield self.connect()
+        self.send(ws, 'flood', [300])
+        received = []
+        while len(received) < 300:
+            _, i = yield self.read(ws, 'flood')
+            received.append(i)
+        self.assertEqual(received, list(range(300)))
+        ws.close()
+        self.kernel().terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_heartbeat(self):
+        ws = yield self.connect()
+        self.send(ws, 'sleep', [1.0])
+        yield tornado.gen.sleep(0.2)
+        kernel = self.kernel()
+        last_pong = kernel.last_pong
+        yield tornado.gen.sleep(0.5)
+
+        # pings are answered while an action runs
+        self.assertGreater(kernel.last_pong, last_pong)
+        msg = yield self.read(ws, 'slept')
+        self.assertEqual(msg, ('slept', 1.0))
+        ws.close()
+        kernel.terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_disconnect(self):
+        ws = yield self.connect()
+        self.send(ws, 'sleep', [30.0])
+        self.send(ws, 'echo', ['hello'])
+        yield self.read(ws, 'echo')
+        kernel = self.kernel()
+        ws.close()
+
+        # acknowledged while an action runs
+        yield tornado.gen.with_timeout(self.io_loop.time() + 4,
+                                       kernel.stopped)
+        while kernel.process is not None:
+            yield tornado.gen.sleep(0.01)
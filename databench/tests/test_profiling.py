@@ -0,0 +1,100 @@
+from databench.profiling import Profiler, profiler
+from databench.testing import AnalysisTest
+import databench
+import marshal
+import time
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+import unittest
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def other(seconds):
+    busy(seconds)
+
+
+class Busy(databench.Analysis):
+    @databench.on
+    def run(self):
+        busy(0.01)
+
+    @databench.on
+    def wait(self):
+        busy(0.01)
+        tornado.ioloop.IOLoop.current().add_callback(other, 0.01)
+        yield tornado.gen.sleep(0.05)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_not_sampled(self):
+        p = Profiler(sample_rate=0.0)
+        self.assertIsNone(p.start('Busy', 'run'))
+        self.assertIsNone(p.stop(None))
+        self.assertEqual(p.summary(), [])
+
+    def test_cprofile(self):
+        p = Profiler(sample_rate=1.0)
+        busy(0.0)
+        for _ in range(2):
+            profile = p.start('Busy', 'run')
+            with p.call(profile):
+                busy(0.01)
+            other(0.01)
+            p.stop(profile)
+
+        self.assertEqual(p.summary(), [
+            {'analysis': 'Busy', 'action': 'run', 'samples': 2}])
+        stats = marshal.loads(p.pstats_dump('Busy', 'run'))
+        self.assertIn('busy', [fn for _, _, fn in stats])
+        self.assertNotIn('other', [fn for _, _, fn in stats])
+        self.assertIsNone(p.pstats_dump('Busy', 'other'))
+
+    def test_sample(self):
+        p = Profiler(sample_rate=1.0, mode='sample', interval=0.001)
+        profile = p.start('Busy', 'run')
+        with p.call(profile):
+            busy(0.05)
+        other(0.05)
+        p.stop(profile)
+        self.assertIn('busy (test_profiling.py', p.collapsed('Busy', 'run'))
+        self.assertNotIn('other (test_profiling.py',
+                         p.collapsed('Busy', 'run'))
+
+    def test_encode(self):
+        p = Profiler(sample_rate=1.0)
+        profile = p.stop(p.start('Busy', 'run'))
+        decoded = p.decode(p.encode(profile))
+        self.assertEqual(decoded['pstats'], profile['pstats'])
+
+    def test_mode(self):
+        self.assertRaises(ValueError, Profiler().configure, mode='other')
+
+
+class TestRunProcess(tornado.testing.AsyncTestCase):
+    def tearDown(self):
+        super(TestRunProcess, self).tearDown()
+        profiler.configure(sample_rate=0.0)
+
+    @tornado.testing.gen_test
+    def test_run_process(self):
+        profiler.configure(sample_rate=1.0)
+        test = AnalysisTest(Busy)
+        yield test.trigger('run')
+        self.assertIn({'analysis': 'Busy', 'action': 'run', 'samples': 1},
+                      profiler.summary())
+        self.assertIsNotNone(profiler.pstats_dump('Busy', 'run'))
+
+    @tornado.testing.gen_test
+    def test_coroutine(self):
+        profiler.configure(sample_rate=1.0)
+        test = AnalysisTest(Busy)
+        yield test.trigger('wait')
+        stats = marshal.loads(profiler.pstats_dump('Busy', 'wait'))
+        self.assertIn('busy', [fn for _, _, fn in stats])
+        self.assertNotIn('other', [fn for _, _, fn in stats])
@@ -1,4 +1,8 @@
 import databench
+import glob
+import os
+import shutil
+import tempfile
 import unittest
 
 
@@ -27,3 +31,43 @@ class TestReadme(unittest.TestCase):
         data = databench.Readme('databench/tests/does_not_exist')
         self.assertEqual('', data.text)
         self.assertEqual('', data.html)
+
+
+class TestReadmeCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'README.md'), 'w') as f:
+            f.write('Some *text*.\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cached(self):
+        return glob.glob(os.path.join(
+            self.directory, databench.readme.CACHE_DIR, 'README.md.*.html'))
+
+    def test_cache(self):
+        html = databench.Readme(self.directory).html
+        self.assertEqual(html, '<p>Some <em>text</em>.</p>')
+        self.assertEqual(len(self.cached()), 1)
+
+        # served from the cache
+        with open(self.cached()[0], 'w') as f:
+            f.write('<p>cached</p>')
+        self.assertEqual(databench.Readme(self.directory).html,
+                         '<p>cached</p>')
+
+        # a changed readme replaces the cache entry
+        with open(os.path.join(self.directory, 'README.md'), 'w') as f:
+            f.write('Other text.\n')
+        self.assertEqual(databench.Readme(self.directory).html,
+                         '<p>Other text.</p>')
+        self.assertEqual(len(self.cached()), 1)
+
+    def test_render_readmes(self):
+        html = databench.readme.render_readmes(
+            [self.directory, 'databench/tests/analyses/simple2'],
+            processes=2)
+        self.assertEqual(html[0], '<p>Some <em>text</em>.</p>')
+        self.assertIn('<p>Rest of readme.</p>', html[1])
+        self.assertEqual(len(self.cached()), 1)
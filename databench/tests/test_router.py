@@ -0,0 +1,109 @@
+from databench import workers
+from databench.router import Router
+import databench
+import json
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+import tornado.websocket
+
+
+class Echo(databench.Analysis):
+    @databench.on
+    def ping(self, value):
+        yield self.emit('pong', value)
+
+
+class TestRouter(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.backends = []
+        super(TestRouter, self).setUp()
+
+    def tearDown(self):
+        workers.node_id = None
+        for server in self.backends:
+            server.stop()
+        super(TestRouter, self).tearDown()
+
+    def start_backend(self, name):
+        app = databench.app.SingleApp(Echo, __file__, name=name,
+                                      info={'session_grace': 10})
+        server = tornado.httpserver.HTTPServer(app.tornado_app())
+        sock, port = tornado.testing.bind_unused_port()
+        server.add_sockets([sock])
+        self.backends.append(server)
+        return name, 'http://127.0.0.1:{}'.format(port)
+
+    def get_app(self):
+        self.router = Router([self.start_backend('a'),
+                              self.start_backend('b')])
+        return self.router.tornado_app()
+
+    @tornado.gen.coroutine
+    def ws_connect(self, analysis_id=None):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': analysis_id}))
+        connect = json.loads((yield ws.read_message()))
+        raise tornado.gen.Return((ws, connect))
+
+    def test_backend_for(self):
+        self.assertEqual(self.router.backend_for('b-abc')[0], 'b')
+        self.assertEqual(self.router.backend_for('b.3-abc')[0], 'b')
+        self.assertEqual(self.router.backend_for(None)[0], 'a')
+        self.assertEqual(self.router.backend_for('c-abc')[0], 'b')
+
+    def test_parse(self):
+        self.assertEqual(Router.parse(['a=http://h:1/']),
+                         [('a', 'http://h:1')])
+        self.assertRaises(ValueError, Router.parse, ['http://h:1'])
+
+    def test_http(self):
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'databench_connections_open', response.body)
+
+    @tornado.testing.gen_test
+    def test_forward(self):
+        ws, connect = yield self.ws_connect()
+        ws.write_message(json.dumps({'signal': 'ping', 'load': 42}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'pong':
+                break
+        self.assertEqual(msg['load'], 42)
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_cross_origin(self):
+        url = 'ws://127.0.0.1:{}/ws'.format(self.get_http_port())
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield tornado.websocket.websocket_connect(
+                tornado.httpclient.HTTPRequest(
+                    url, headers={'Origin': 'http://evil.example.com'}))
+
+        self.router.allowed_origins.add('app.example.com')
+        ws = yield tornado.websocket.websocket_connect(
+            tornado.httpclient.HTTPRequest(
+                url, headers={'Origin': 'http://app.example.com'}))
+        ws.close()
+
+    @tornado.testing.gen_test
+    def test_resume(self):
+        # every backend runs a different analysis, so a session can only
+        # be resumed on the backend that created it
+        workers.set_node_id('b')
+        self.router.next = 1
+        ws, connect = yield self.ws_connect()
+        analysis_id = connect['load']['analysis_id']
+        self.assertTrue(analysis_id.startswith('b-'))
+        ws.close()
+        yield tornado.gen.sleep(0.1)
+
+        # round-robin would pick backend a
+        self.router.next = 0
+        ws, connect = yield self.ws_connect(analysis_id)
+        self.assertEqual(connect['load']['analysis_id'], analysis_id)
+        self.assertTrue(connect['load']['resumed'])
+        ws.close()
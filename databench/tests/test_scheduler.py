@@ -0,0 +1,105 @@
+from databench.scheduler import Scheduler
+import tornado.concurrent
+import tornado.gen
+import tornado.testing
+
+
+class Jobs(object):
+    """Actions that only finish when they are resolved."""
+
+    def __init__(self):
+        self.started = []
+        self.futures = {}
+
+    def __call__(self, name):
+        self.started.append(name)
+        self.futures[name] = tornado.concurrent.Future()
+        return self.futures[name]
+
+    def finish(self, name):
+        self.futures[name].set_result(name)
+
+
+class TestScheduler(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_round_robin(self):
+        scheduler = Scheduler(max_concurrent=1, per_connection=None)
+        jobs = Jobs()
+        for name in ('a1', 'a2', 'a3'):
+            scheduler.submit('a', jobs, name)
+        for name in ('b1', 'b2'):
+            scheduler.submit('b', jobs, name)
+        self.assertEqual(jobs.started, ['a1'])
+
+        for name in ('a1', 'a2', 'b1', 'a3'):
+            jobs.finish(name)
+            yield tornado.gen.sleep(0.01)
+        self.assertEqual(jobs.started, ['a1', 'a2', 'b1', 'a3', 'b2'])
+
+    @tornado.testing.gen_test
+    def test_defaults(self):
+        # actions of a connection run one at a time and in order
+        scheduler = Scheduler()
+        jobs = Jobs()
+        first, _ = scheduler.submit('a', jobs, 'a1')
+        second, _ = scheduler.submit('a', jobs, 'a2')
+        self.assertEqual(jobs.started, ['a1'])
+
+        jobs.finish('a1')
+        self.assertEqual((yield first), 'a1')
+        yield tornado.gen.sleep(0.01)
+        self.assertEqual(jobs.started, ['a1', 'a2'])
+        jobs.finish('a2')
+        self.assertEqual((yield second), 'a2')
+
+    @tornado.testing.gen_test
+    def test_per_connection(self):
+        scheduler = Scheduler(per_connection=1)
+        jobs = Jobs()
+        first, _ = scheduler.submit('a', jobs, 'a1')
+        scheduler.submit('a', jobs, 'a2')
+        scheduler.submit('b', jobs, 'b1')
+        self.assertEqual(jobs.started, ['a1', 'b1'])
+
+        jobs.finish('a1')
+        self.assertEqual((yield first), 'a1')
+        self.assertEqual(jobs.started, ['a1', 'b1', 'a2'])
+
+    def test_rate_limit(self):
+        scheduler = Scheduler(rate=0.001, burst=2, per_connection=None)
+        jobs = Jobs()
+        self.assertIsNone(scheduler.submit('a', jobs, 'a1')[1])
+        self.assertIsNone(scheduler.submit('a', jobs, 'a2')[1])
+        self.assertEqual(scheduler.submit('a', jobs, 'a3'),
+                         (None, 'rate_limit'))
+        self.assertIsNone(scheduler.submit('b', jobs, 'b1')[1])
+
+    def test_queue_full(self):
+        scheduler = Scheduler(per_connection=1, max_queue=1)
+        jobs = Jobs()
+        scheduler.submit('a', jobs, 'a1')
+        scheduler.submit('a', jobs, 'a2')
+        self.assertEqual(scheduler.submit('a', jobs, 'a3'),
+                         (None, 'queue_full'))
+
+    @tornado.testing.gen_test
+    def test_forget(self):
+        scheduler = Scheduler(per_connection=1)
+        jobs = Jobs()
+        scheduler.submit('a', jobs, 'a1')
+        scheduler.submit('a', jobs, 'a2')
+        scheduler.forget('a')
+        jobs.finish('a1')
+        yield tornado.gen.sleep(0.01)
+        self.assertEqual(jobs.started, ['a1'])
+        self.assertEqual(scheduler.total_running, 0)
+
+    @tornado.testing.gen_test
+    def test_exception(self):
+        def fail():
+            raise ValueError()
+
+        scheduler = Scheduler()
+        future, _ = scheduler.submit('a', fail)
+        self.assertIsNone((yield future))
+        self.assertEqual(scheduler.total_running, 0)
@@ -0,0 +1,149 @@
+from databench.connections import registry
+from databench.supervisor import KernelSupervisor, rss, supervisor
+from databench.tests.test_kernel_pool import KernelTestCase
+import databench
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+import unittest
+
+
+class Supervisor(unittest.TestCase):
+    @unittest.skipIf(not os.path.exists('/proc/self/statm'), 'no /proc')
+    def test_rss(self):
+        self.assertGreater(rss(os.getpid()), 0)
+        self.assertIsNone(rss(None))
+
+    def test_kill(self):
+        process = subprocess.Popen([sys.executable, '-c', (
+            'import signal, time\n'
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+            'print("ready", flush=True)\n'
+            'time.sleep(30)\n'
+        )], stdout=subprocess.PIPE)
+        process.stdout.readline()
+        process.terminate()
+
+        s = KernelSupervisor(kill_timeout=0.0)
+        s.terminated[process] = time.time()
+        s.kill_terminated(time.time())
+        process.wait()
+        process.stdout.close()
+        s.kill_terminated(time.time())
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+        self.assertEqual(s.terminated, {})
+
+
+class KernelSupervision(KernelTestCase):
+    def setUp(self):
+        self.config = dict(vars(supervisor))
+        supervisor.stop()
+        supervisor.configure(interval=0.1)
+        super(KernelSupervision, self).setUp()
+
+    def tearDown(self):
+        super(KernelSupervision, self).tearDown()
+        supervisor.stop()
+        vars(supervisor).update(self.config)
+
+    def get_app(self):
+        self.app = databench.App('databench.tests.analyses')
+        lazy = next(m for m in self.app.metas if m.name == 'parameters_py')
+        self.meta = lazy.materialize()
+        return self.app.tornado_app()
+
+    @tornado.gen.coroutine
+    def connect(self):
+        ws = yield tornado.websocket.websocket_connect(
+            'ws://127.0.0.1:{}/parameters_py/ws'.format(self.get_http_port()))
+        ws.write_message(json.dumps({'__connect': None}))
+        yield ws.read_message()
+        yield self.action(ws)
+        raise tornado.gen.Return(ws)
+
+    @tornado.gen.coroutine
+    def action(self, ws):
+        ws.write_message(json.dumps({'signal': 'test_action'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_action_ack':
+                break
+
+    @tornado.gen.coroutine
+    def read_kernel_event(self, ws):
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == '__kernel':
+                raise tornado.gen.Return(msg['load'])
+
+    def kernel(self):
+        return next(h.analysis.kernel for h in registry
+                    if h.meta is self.meta)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_heartbeat(self):
+        ws = yield self.connect()
+        kernel = self.kernel()
+        self.assertTrue(kernel.heartbeat)
+        last_pong = kernel.last_pong
+        yield tornado.gen.sleep(0.3)
+        self.assertGreater(kernel.last_pong, last_pong)
+        ws.close()
+        kernel.terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_exited(self):
+        ws = yield self.connect()
+        kernel = self.kernel()
+        os.kill(kernel.process.pid, signal.SIGKILL)
+
+        event = yield self.read_kernel_event(ws)
+        self.assertEqual(event, {'status': 'exited',
+                                 'exit_code': -signal.SIGKILL})
+        self.assertIsNone(kernel.process)
+        ws.close()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_restart(self):
+        supervisor.configure(max_restarts=1)
+        ws = yield self.connect()
+        os.kill(self.kernel().process.pid, signal.SIGKILL)
+
+        event = yield self.read_kernel_event(ws)
+        self.assertEqual(event['status'], 'exited')
+        event = yield self.read_kernel_event(ws)
+        self.assertEqual(event, {'status': 'restarted', 'restarts': 1})
+        yield self.action(ws)
+        ws.close()
+        self.kernel().terminate()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_idle(self):
+        supervisor.configure(idle_timeout=1.0)
+        ws = yield self.connect()
+        kernel = self.kernel()
+
+        event = yield self.read_kernel_event(ws)
+        self.assertEqual(event, {'status': 'idle'})
+        self.assertIsNone(kernel.process)
+        ws.close()
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_orphan(self):
+        ws = yield self.connect()
+        process = self.kernel().process
+
+        # kernels exit without heartbeats
+        supervisor.stop()
+        deadline = time.time() + 5
+        while process.poll() is None and time.time() < deadline:
+            yield tornado.gen.sleep(0.05)
+        self.assertIsNotNone(process.poll())
+        ws.close()
+        self.kernel().terminate()
@@ -0,0 +1,46 @@
+from databench.template import Loader, page_cache
+import databench
+import os
+import tornado.testing
+import unittest
+
+
+class Pages(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        page_cache.clear()
+        super(Pages, self).setUp()
+
+    def get_app(self):
+        return databench.App('databench.tests.analyses').tornado_app()
+
+    def test_index_etag(self):
+        response = self.fetch('/')
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+        self.assertEqual(len(page_cache), 1)
+
+        response = self.fetch('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+
+    def test_analysis_page(self):
+        first = self.fetch('/simple1/')
+        self.assertEqual(first.code, 200)
+        self.assertIn(b'Analysis Output', first.body)
+        second = self.fetch('/simple1/')
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.headers['Etag'], first.headers['Etag'])
+        self.assertEqual(len(page_cache), 1)
+
+
+class TestLoader(unittest.TestCase):
+    def test_resolve_path(self):
+        root = os.path.dirname(os.path.realpath(__file__))
+        loader = Loader([root])
+        path = loader.resolve_path('test_template.py')
+        self.assertEqual(path, os.path.join(root, 'test_template.py'))
+        self.assertIn(('test_template.py', None), loader.resolved)
+        self.assertEqual(loader.resolve_path('missing.html'), 'missing.html')
+        self.assertNotIn(('missing.html', None), loader.resolved)
+        loader.reset()
+        self.assertEqual(loader.resolved, {})
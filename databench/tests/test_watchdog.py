@@ -0,0 +1,90 @@
+from databench import metrics
+from databench.watchdog import Watchdog, metas, running
+import databench
+import time
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+
+
+class Blocking(databench.Analysis):
+    @databench.on
+    def run(self):
+        time.sleep(0.3)
+
+    def on_go(self):
+        time.sleep(0.3)
+
+
+class LabelMeta(object):
+    @staticmethod
+    def action_label(action_name, analysis=None):
+        return 'labelled'
+
+
+class TestWatchdog(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_blocking(self):
+        watchdog = Watchdog(threshold=0.1, interval=0.02).start()
+        test = databench.testing.AnalysisTest(Blocking)
+        yield tornado.gen.sleep(0.05)
+        yield test.trigger('run')
+        yield tornado.gen.sleep(0.05)
+        watchdog.stop()
+
+        self.assertEqual(len(watchdog.stalls), 1)
+        stall = watchdog.stalls[0]
+        self.assertEqual(stall['analysis'], 'Blocking')
+        self.assertEqual(stall['action'], 'run')
+        self.assertGreater(stall['duration'], 0.25)
+        self.assertTrue(any(frame.startswith('run (test_watchdog.py')
+                            for frame in stall['stack']))
+
+    @tornado.testing.gen_test
+    def test_action_name(self):
+        watchdog = Watchdog(threshold=0.1, interval=0.02).start()
+        test = databench.testing.AnalysisTest(Blocking)
+        yield tornado.gen.sleep(0.05)
+        yield test.trigger('go')
+        yield tornado.gen.sleep(0.05)
+        watchdog.stop()
+
+        self.assertEqual(len(watchdog.stalls), 1)
+        self.assertEqual(watchdog.stalls[0]['analysis'], 'Blocking')
+        self.assertEqual(watchdog.stalls[0]['action'], 'go')
+        self.assertEqual(running, {})
+
+    @tornado.testing.gen_test
+    def test_label(self):
+        # metric labels come from the Meta of the analysis instance
+        watchdog = Watchdog(threshold=0.1, interval=0.02).start()
+        test = databench.testing.AnalysisTest(Blocking)
+        metas[test.analysis_instance] = LabelMeta()
+        yield tornado.gen.sleep(0.05)
+        yield test.trigger('run')
+        yield tornado.gen.sleep(0.05)
+        watchdog.stop()
+
+        self.assertEqual(watchdog.stalls[0]['action'], 'run')
+        self.assertEqual(
+            metrics.blocking_total.values.get(('Blocking', 'labelled')), 1)
+
+    @tornado.testing.gen_test
+    def test_unattributed(self):
+        watchdog = Watchdog(threshold=0.1, interval=0.02).start()
+        yield tornado.gen.sleep(0.05)
+        tornado.ioloop.IOLoop.current().add_callback(time.sleep, 0.3)
+        yield tornado.gen.sleep(0.4)
+        watchdog.stop()
+
+        self.assertEqual(len(watchdog.stalls), 1)
+        self.assertIsNone(watchdog.stalls[0]['analysis'])
+        self.assertIsNone(watchdog.stalls[0]['action'])
+
+    @tornado.testing.gen_test
+    def test_lag(self):
+        watchdog = Watchdog(threshold=1.0, interval=0.02).start()
+        yield tornado.gen.sleep(0.05)
+        watchdog.stop()
+        self.assertEqual(len(watchdog.stalls), 0)
+        self.assertLess(watchdog.lag, 0.02)
@@ -0,0 +1,40 @@
+from databench import workers
+import databench
+import unittest
+
+
+class TestWorkers(unittest.TestCase):
+    def tearDown(self):
+        workers.node_id = None
+        workers.worker_id = None
+
+    def test_single_process(self):
+        self.assertEqual(workers.tag('abc'), 'abc')
+        self.assertIsNone(workers.worker_of('abc'))
+        self.assertTrue(workers.owns('abc'))
+        self.assertTrue(workers.owns('3-abc'))
+
+    def test_worker(self):
+        workers.worker_id = 3
+        self.assertEqual(workers.tag('abc'), '3-abc')
+        self.assertEqual(workers.worker_of('3-abc'), 3)
+        self.assertTrue(workers.owns('3-abc'))
+        self.assertFalse(workers.owns('4-abc'))
+        self.assertTrue(workers.owns('abc'))
+
+    def test_analysis_id(self):
+        workers.worker_id = 5
+        analysis = databench.Analysis().init_databench()
+        self.assertEqual(workers.worker_of(analysis.id_), 5)
+
+    def test_node(self):
+        workers.set_node_id('n1')
+        self.assertEqual(workers.tag('abc'), 'n1-abc')
+        self.assertEqual(workers.owner('n1-abc'), ('n1', None))
+        workers.worker_id = 2
+        self.assertEqual(workers.tag('abc'), 'n1.2-abc')
+        self.assertEqual(workers.owner('n1.2-abc'), ('n1', 2))
+        self.assertTrue(workers.owns('n1.2-abc'))
+        self.assertFalse(workers.owns('n1.3-abc'))
+        self.assertFalse(workers.owns('n2.2-abc'))
+        self.assertRaises(ValueError, workers.set_node_id, 'a-b')
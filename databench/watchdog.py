@@ -0,0 +1,144 @@
+"""Watchdog for handlers that block the IOLoop."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from . import metrics
+from .profiling import format_stack
+from collections import deque
+import contextlib
+import logging
+import sys
+import threading
+import time
+import tornado.ioloop
+import weakref
+
+log = logging.getLogger(__name__)
+
+# (analysis instance, action name) of the running handler by thread
+running = {}
+# Meta of analysis instances that provides metric labels
+metas = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def action(analysis, action_name):
+    """Attribute stalls of the current thread to an action.
+
+    Wraps the synchronous call of a handler. Handlers that are coroutines
+    are only attributed until they first yield.
+
+    :param analysis: Analysis instance.
+    :param str action_name: Name of the action.
+    """
+    thread_id = threading.current_thread().ident
+    previous = running.get(thread_id)
+    running[thread_id] = (analysis, action_name)
+    try:
+        yield
+    finally:
+        if previous is None:
+            running.pop(thread_id, None)
+        else:
+            running[thread_id] = previous
+
+
+class Watchdog(object):
+    """Measure IOLoop lag and report blocking handlers.
+
+    A periodic callback on the IOLoop records a heartbeat every
+    ``interval`` seconds and the lag of the IOLoop. A background thread
+    checks the heartbeat. When the IOLoop did not process the heartbeat for
+    more than ``threshold`` seconds, the stack of the IOLoop thread is
+    captured and reported in the log and in metrics together with the
+    analysis and action whose handler is running (see :func:`action`).
+
+    :param float threshold: Report stalls longer than this (in seconds).
+    :param float interval: Heartbeat interval in seconds.
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+
+        self.lag = 0.0
+        self.last_beat = None
+        self.stall = None
+        self.stalls = deque(maxlen=100)
+
+        self.thread_id = None
+        self.heartbeat = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """Start watching the current IOLoop."""
+        if self.running:
+            return self
+
+        self.thread_id = threading.current_thread().ident
+        self.last_beat = time.time()
+        self.heartbeat = tornado.ioloop.PeriodicCallback(
+            self.beat, self.interval * 1000.0)
+        self.heartbeat.start()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.watch,
+                                       name='databench-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+    def beat(self):
+        now = time.time()
+        self.lag = max(0.0, now - self.last_beat - self.interval)
+        self.last_beat = now
+        metrics.loop_lag_seconds.observe(self.lag)
+
+        stall, self.stall = self.stall, None
+        if stall is not None:
+            stall['duration'] = self.lag + self.interval
+            log.warning('IOLoop was blocked for {:.0f}ms by {}.{}.'.format(
+                stall['duration'] * 1000.0,
+                stall['analysis'], stall['action']))
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.interval)
+            blocked = time.time() - self.last_beat
+            if blocked > self.threshold and self.stall is None:
+                self.report(blocked)
+
+    def report(self, blocked):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = format_stack(frame)
+        analysis, action, label = None, None, ''
+        handler = running.get(self.thread_id)
+        if handler is not None:
+            instance, action = handler
+            analysis = type(instance).__name__
+            meta = metas.get(instance)
+            if meta is not None:
+                label = meta.action_label(action, instance)
+
+        self.stall = {
+            'time': time.time(),
+            'analysis': analysis,
+            'action': action,
+            'stack': stack,
+            'duration': blocked,
+        }
+        self.stalls.append(self.stall)
+        metrics.blocking_total.inc(analysis=analysis or '', action=label)
+        log.warning('IOLoop blocked for more than {:.0f}ms by {}.{}:\n  {}'
+                    ''.format(blocked * 1000.0, analysis, action,
+                              '\n  '.join(stack)))
+
+
+watchdog = Watchdog()
@@ -0,0 +1,116 @@
+"""Multi-process serving with pre-forked worker processes.
+
+The listening sockets are bound once and shared by all workers which are
+forked with :func:`tornado.process.fork_processes`. The parent process
+supervises the workers and restarts workers that exit abnormally.
+
+Analysis ids carry the id of the node (``--node-id``) and of the worker
+that created them as a prefix (``<node>.<worker>-<random>``,
+``<node>-<random>`` or ``<worker>-<random>``) so that the owner of an
+analysis instance can be determined from its id, e.g. by the
+:mod:`~databench.router`.
+"""
+
+from __future__ import absolute_import, unicode_literals, division
+
+import logging
+import re
+import tornado.netutil
+import tornado.process
+
+log = logging.getLogger(__name__)
+
+# id of this node or None
+node_id = None
+# id of this worker process or None when running a single process
+worker_id = None
+
+
+def set_node_id(name):
+    """Set the id of this node.
+
+    :param str name: Letters, digits and underscores starting with a letter.
+    """
+    global node_id
+
+    if name is not None and not re.match(r'^[A-Za-z][A-Za-z0-9_]*$', name):
+        raise ValueError('invalid node id {}'.format(name))
+    node_id = name
+
+
+def prefix():
+    """The prefix of analysis ids created in this process or ``None``."""
+    parts = ['{}'.format(p) for p in (node_id, worker_id) if p is not None]
+    return '.'.join(parts) if parts else None
+
+
+def tag(id_):
+    """Prefix an analysis id with the ids of this node and worker."""
+    p = prefix()
+    if p is None:
+        return id_
+    return '{}-{}'.format(p, id_)
+
+
+def owner(analysis_id):
+    """The node and worker that created an analysis id.
+
+    :param str analysis_id: Analysis id.
+    :returns: (node id, worker id) where unknown parts are ``None``.
+    :rtype: tuple
+    """
+    if not analysis_id or '-' not in analysis_id:
+        return None, None
+    p = analysis_id.split('-', 1)[0]
+    if '.' in p:
+        node, worker = p.split('.', 1)
+        return node, int(worker) if worker.isdigit() else None
+    if p.isdigit():
+        return None, int(p)
+    return p, None
+
+
+def worker_of(analysis_id):
+    """The id of the worker that created an analysis id or ``None``."""
+    return owner(analysis_id)[1]
+
+
+def node_of(analysis_id):
+    """The id of the node that created an analysis id or ``None``."""
+    return owner(analysis_id)[0]
+
+
+def owns(analysis_id):
+    """Whether an analysis id can be served by this process."""
+    node, worker = owner(analysis_id)
+    if node_id is not None and node is not None and node != node_id:
+        return False
+    if worker_id is not None and worker is not None and worker != worker_id:
+        return False
+    return True
+
+
+def start(n, ports, host=None, max_restarts=100):
+    """Bind sockets and fork worker processes.
+
+    Only returns in the worker processes. The parent process waits for the
+    workers, restarts workers that die and exits when all workers exited.
+    This has to be called before an IOLoop or a ZMQ context is created.
+
+    :param int n: Number of workers. ``0`` or ``None`` for one per CPU.
+    :param list ports: Ports to listen on.
+    :param str host: Host address to listen on.
+    :param int max_restarts: Total number of worker restarts after which
+        the supervisor gives up.
+    :returns: The listening sockets for every port.
+    :rtype: list
+    """
+    global worker_id
+
+    sockets = [tornado.netutil.bind_sockets(port, host) for port in ports]
+    log.info('Starting {} workers.'.format(
+        n or tornado.process.cpu_count()))
+    worker_id = tornado.process.fork_processes(n or None,
+                                               max_restarts=max_restarts)
+    log.info('Worker {} started.'.format(worker_id))
+    return sockets
@@ -6,4 +6,4 @@ from __future__ import absolute_import
 __version__ = "0.7b13"
 
 
-from . import singlethread
+from . import multithread, singlethread
@@ -0,0 +1,349 @@
+"""Meta class for Databench Python kernels with worker threads."""
+
+from ..singlethread.meta import COALESCE_SIGNALS, Meta as SingleThreadMeta
+from databench.profiling import profiler
+from collections import deque
+import concurrent.futures
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+# concurrency policies of actions
+POLICIES = ('serial', 'latest', 'parallel', 'loop')
+
+# worker threads block when this many of their messages were not sent yet
+OUTBOUND_SIZE = 1000
+
+
+def exit_with_parent(pid):
+    """Exit a process of the process pool when the kernel ended.
+
+    Kernels are terminated with SIGTERM which does not stop the processes.
+    """
+    def watch():
+        while os.getppid() == pid:
+            time.sleep(1.0)
+        os._exit(0)
+    thread = threading.Thread(target=watch, name='databench-parent')
+    thread.daemon = True
+    thread.start()
+
+
+class WorkerPool(object):
+    """A pool of daemon threads running coroutines.
+
+    Unlike the threads of :class:`concurrent.futures.ThreadPoolExecutor`,
+    these threads do not keep a kernel alive that exits while an action is
+    running. Every thread runs its own IOLoop so that coroutines can yield
+    futures. The threads are started on first use, i.e. after a zygote
+    forked the kernel.
+
+    Args:
+        max_workers (int): Number of threads.
+
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.tasks = queue.Queue()
+        self.threads = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Run a coroutine in a worker thread.
+
+        Returns:
+            concurrent.futures.Future: The result of the coroutine.
+
+        """
+        if not self.threads:
+            self.start()
+        future = concurrent.futures.Future()
+        self.tasks.put((future, functools.partial(fn, *args, **kwargs)))
+        return future
+
+    def start(self):
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self.work,
+                                      name='databench-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        ioloop = tornado.ioloop.IOLoop()
+        while True:
+            future, fn = self.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = ioloop.run_sync(fn)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class Meta(SingleThreadMeta):
+    """Class providing Meta information about analyses.
+
+    For Python kernels that run actions in a pool of worker threads. The
+    kernel receives messages in the thread running the IOLoop and stays
+    responsive to heartbeats and ``disconnected`` while actions run.
+    Messages emitted in worker threads are passed to that thread through
+    a thread-safe outbound queue. A worker thread blocks when
+    ``OUTBOUND_SIZE`` messages from worker threads wait for credits.
+
+    Actions run with one of these policies:
+
+    * ``serial``: one after another per analysis instance in the order
+      they were received,
+    * ``latest``: like ``serial`` but of multiple waiting invocations of
+      the action only the latest runs,
+    * ``parallel``: immediately and concurrently with other actions,
+    * ``loop``: in the thread running the IOLoop like in the single thread
+      kernel, only for short actions.
+
+    ``disconnected`` runs immediately and drops waiting actions. Handlers
+    of ``parallel`` and ``loop`` actions have to synchronize access to the
+    state of the analysis instance themselves.
+
+    CPU bound work can be sent to a pool of processes with
+    ``self.run_in_process(fn, *args)`` in handlers which returns a future
+    that can be yielded. ``fn`` and its arguments have to be picklable.
+
+    Args:
+        name (str): Name of this analysis.
+        analysis_class (Analysis): Analysis class.
+        max_workers (int): Number of worker threads.
+        policies (dict): Policies by action name.
+        default_policy (str): Policy of all other actions.
+        max_processes (int): Number of processes for ``run_in_process``.
+            Defaults to the number of CPUs.
+
+    """
+
+    def __init__(self, name, analysis_class, max_workers=4, policies=None,
+                 default_policy='serial', max_processes=None):
+        self.policies = dict(policies or {})
+        for policy in list(self.policies.values()) + [default_policy]:
+            if policy not in POLICIES:
+                raise ValueError('unknown policy {}'.format(policy))
+        self.default_policy = default_policy
+        self.workers = WorkerPool(max_workers)
+        self.max_processes = max_processes
+        self.processes = None
+        self.processes_lock = threading.Lock()
+
+        # serial actions waiting to run by analysis id
+        self.waiting = {}
+        # analysis ids with a running serial action
+        self.running = set()
+        # messages from all threads that were not processed yet
+        self.outbound = queue.Queue()
+        self.outbound_slots = threading.Semaphore(OUTBOUND_SIZE)
+        # messages waiting for credits by analysis id
+        self.pending = {}
+        self.closed = False
+
+        # messages are sent in the thread running the IOLoop
+        self.thread = threading.current_thread()
+        super(Meta, self).__init__(name, analysis_class)
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+    def _init_analysis(self, analysis, analysis_id):
+        super(Meta, self)._init_analysis(analysis, analysis_id)
+        analysis.run_in_process = self.run_in_process
+
+    def run_in_process(self, fn, *args, **kwargs):
+        """Run a function in a pool of processes.
+
+        Returns:
+            concurrent.futures.Future: The result of the function.
+
+        """
+        with self.processes_lock:
+            if self.processes is None:
+                options = {}
+                if sys.version_info >= (3, 7):
+                    options = {'initializer': exit_with_parent,
+                               'initargs': (os.getpid(),)}
+                self.processes = concurrent.futures.ProcessPoolExecutor(
+                    self.max_processes, **options)
+        return self.processes.submit(fn, *args, **kwargs)
+
+    def remove(self, analysis_id):
+        super(Meta, self).remove(analysis_id)
+        self.waiting.pop(analysis_id, None)
+        self.send_pending(analysis_id)
+
+    def close(self, linger=None):
+        """Close the zmq sockets and drop actions and messages."""
+        self.closed = True
+        self.waiting.clear()
+        self.flush()
+        super(Meta, self).close(linger)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
+
+    def run_process(self, analysis, action_name, message='__nomessagetoken__'):
+        """Run an action according to its policy.
+
+        Called in the thread running the IOLoop.
+        """
+        policy = self.policies.get(action_name, self.default_policy)
+        if action_name == 'disconnected':
+            # do not wait for running and waiting actions
+            self.waiting.pop(analysis.id_, None)
+            policy = 'parallel'
+
+        if policy == 'loop':
+            super(Meta, self).run_process(analysis, action_name, message)
+            return
+        if policy == 'parallel':
+            self.submit(analysis, action_name, message)
+            return
+
+        waiting = self.waiting.setdefault(analysis.id_, deque())
+        if policy == 'latest':
+            for entry in [e for e in waiting if e[0] == action_name]:
+                waiting.remove(entry)
+                dropped = entry[1]
+                if isinstance(dropped, dict) and '__process_id' in dropped:
+                    analysis.emit('__process', {
+                        'id': dropped['__process_id'], 'status': 'end'})
+        waiting.append((action_name, message))
+        self.run_waiting(analysis.id_)
+
+    def run_waiting(self, analysis_id):
+        """Start the next serial action of an analysis instance."""
+        if analysis_id in self.running:
+            return
+        waiting = self.waiting.get(analysis_id)
+        analysis = self.analyses.get(analysis_id)
+        if not waiting or analysis is None:
+            self.waiting.pop(analysis_id, None)
+            return
+
+        action_name, message = waiting.popleft()
+        self.running.add(analysis_id)
+        self.submit(analysis, action_name, message, serial=True)
+
+    def submit(self, analysis, action_name, message, serial=False):
+        """Run an action in a worker thread."""
+        analysis_id = analysis.id_
+        future = self.workers.submit(self.run_worker,
+                                     analysis, action_name, message)
+        future.add_done_callback(lambda f: self.ioloop.add_callback(
+            self.end_worker, analysis, analysis_id, action_name, serial, f))
+
+    @tornado.gen.coroutine
+    def run_worker(self, analysis, action_name, message):
+        """Run the handlers of an action. Called in a worker thread."""
+        profile = profiler.start(type(analysis).__name__, action_name)
+        try:
+            with profiler.call(profile):
+                results = self.run_handlers(analysis, action_name, message)
+            yield [r for r in results if tornado.concurrent.is_future(r)]
+        finally:
+            self.ioloop.add_callback(self.send_profile, analysis.id_,
+                                     profiler.stop(profile))
+
+    def end_worker(self, analysis, analysis_id, action_name, serial, future):
+        """Called in the thread running the IOLoop after an action ran."""
+        if future.exception() is not None:
+            log.error('kernel {} failed to process {}'
+                      ''.format(analysis_id, action_name),
+                      exc_info=future.exception())
+        if action_name == 'disconnected' and not self.closed:
+            self.flush()
+            self.disconnect(analysis)
+        if serial:
+            self.running.discard(analysis_id)
+            self.run_waiting(analysis_id)
+
+    def send_profile(self, analysis_id, profile):
+        if self.closed:
+            return
+        super(Meta, self).send_profile(analysis_id, profile)
+
+    def emit(self, signal, message, analysis_id):
+        """Emit signal to main.
+
+        Can be called in any thread. The message is sent in the thread
+        running the IOLoop.
+
+        Args:
+            signal: Name of the signal to be emitted.
+            message: Message to be sent.
+            analysis_id: Identifies the instance of this analysis.
+
+        """
+        if threading.current_thread() is self.thread:
+            self.outbound.put((analysis_id, signal, message, False))
+            self.flush()
+            return
+
+        self.outbound_slots.acquire()
+        self.outbound.put((analysis_id, signal, message, True))
+        self.ioloop.add_callback(self.flush)
+
+    def flush(self):
+        """Send messages from the outbound queue while there are credits."""
+        while True:
+            try:
+                analysis_id, signal, message, slot = \
+                    self.outbound.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.setdefault(analysis_id, deque()).append(
+                (signal, message, slot))
+
+        for analysis_id in list(self.pending):
+            self.send_pending(analysis_id)
+
+    def send_pending(self, analysis_id):
+        """Send the messages of an analysis instance that wait for credits.
+
+        Without credits, updates of ``data`` and ``class_data`` are merged
+        and all other messages keep waiting. Messages of removed analysis
+        instances are dropped.
+        """
+        pending = self.pending.get(analysis_id, ())
+        while pending:
+            signal, message, slot = pending[0]
+            dropped = self.closed or analysis_id not in self.analyses
+            no_credits = self.credits.get(analysis_id, 1) <= 0
+            coalesce = signal in COALESCE_SIGNALS and isinstance(message, dict)
+            if no_credits and not coalesce and not dropped:
+                break
+
+            pending.popleft()
+            if slot:
+                self.outbound_slots.release()
+            if not dropped:
+                super(Meta, self).emit(signal, message, analysis_id)
+        if not pending:
+            self.pending.pop(analysis_id, None)
+
+    def add_credits(self, analysis_id, n):
+        """Add credits granted by main and send waiting messages."""
+        if analysis_id not in self.credits:
+            return
+        self.credits[analysis_id] += n
+        coalesced = self.coalesced.pop(analysis_id, {})
+        for signal_name, message in coalesced.items():
+            super(Meta, self).emit(signal_name, message, analysis_id)
+        self.send_pending(analysis_id)
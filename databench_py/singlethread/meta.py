@@ -1,20 +1,45 @@
 """Meta class for Databench Python kernel."""
 
 import databench
+from databench.encoding import ENCODINGS, JSONEncoding, pack_buffers
+from databench.profiling import profiler
 from databench.utils import json_encoder_default
+from collections import OrderedDict, deque
 import functools
 import json
 import logging
+import os
+import random
+import signal
 import sys
+import time
 import zmq
 
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
 log = logging.getLogger(__name__)
 
+# updates of these signals are merged while waiting for credits
+COALESCE_SIGNALS = ('data', 'class_data')
+
 
 class Meta(object):
     """Class providing Meta information about analyses.
 
-    For Python kernels.
+    For Python kernels. A kernel started with ``--multiplex`` hosts many
+    analysis instances that are added with ``__add`` messages.
+
+    Messages to the frontend use credits that main grants once it wrote
+    previous messages to the frontend. Without credits, :meth:`emit`
+    merges updates of ``data`` and ``class_data`` and blocks for all other
+    signals until main granted new credits.
+
+    The kernel answers heartbeats from main and exits when it does not
+    receive heartbeats anymore, e.g. because main was killed. Its address
+    space is limited with ``--rlimit-as``.
 
     Args:
         name (str): Name of this analysis.
@@ -25,6 +50,8 @@ class Meta(object):
     def __init__(self, name, analysis_class):
         self.name = name
         analysis_id, zmq_port_subscribe, zmq_port_publish = None, None, None
+        zmq_router, zygote_fd, multiplex = None, None, False
+        self.zmq_hwm = None
         for cl in sys.argv:
             if cl.startswith('--analysis-id'):
                 analysis_id = cl.partition('=')[2]
@@ -32,22 +59,168 @@ class Meta(object):
                 zmq_port_subscribe = cl.partition('=')[2]
             if cl.startswith('--zmq-publish'):
                 zmq_port_publish = cl.partition('=')[2]
-
-        log.info('Analysis id: {}, port sub: {}, port pub: {}'.format(
-                 analysis_id, zmq_port_subscribe, zmq_port_publish))
+            if cl.startswith('--zmq-router'):
+                zmq_router = cl.partition('=')[2]
+            if cl.startswith('--zmq-hwm'):
+                self.zmq_hwm = int(cl.partition('=')[2])
+            if cl.startswith('--rlimit-as') and resource is not None:
+                limit = int(cl.partition('=')[2])
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            if cl.startswith('--profile-sample-rate'):
+                profiler.configure(sample_rate=float(cl.partition('=')[2]))
+            if cl.startswith('--profile-mode'):
+                profiler.configure(mode=cl.partition('=')[2])
+            if cl.startswith('--zygote'):
+                zygote_fd = int(cl.partition('=')[2])
+            if cl == '--multiplex':
+                multiplex = True
 
         databench.Meta.fill_action_handlers(analysis_class)
 
-        self.analysis = analysis_class()
-        self.analysis.init_databench(analysis_id)
+        if zygote_fd is not None:
+            # only returns in forked kernels
+            analysis_id, zmq_port_publish = self.zygote(zygote_fd)
+
+        log.info('Analysis id: {}, port sub: {}, port pub: {}, router: {}'
+                 ''.format(analysis_id, zmq_port_subscribe, zmq_port_publish,
+                           zmq_router))
+
+        self.analysis_class = analysis_class
+        self.multiplex = multiplex
+        self.kernel_id = analysis_id
+        # analysis instances by analysis id
+        self.analyses = {}
+        # ids that did not receive a zmq ack yet
+        self.unacked = set()
+        # whether main can receive arrays as separate frames
+        self.send_buffers = False
+        # encodings of frontends by analysis id for messages that main
+        # forwards without decoding
+        self.frame_encodings = {}
+        # remaining credits by analysis id once main enabled flow control
+        self.credits = {}
+        # merged updates by analysis id and signal while out of credits
+        self.coalesced = {}
+        # messages received while waiting for credits
+        self.deferred = deque()
+        # exit without heartbeats from main once enabled in the zmq ack
+        self.last_heartbeat = None
+        self.heartbeat_check = None
+
+        self.analysis = None
+        if not multiplex:
+            self.analysis = analysis_class()
+            self._init_analysis(self.analysis, analysis_id)
+
+        if zmq_router is not None:
+            self._init_zmq_router(zmq_router)
+        else:
+            self._init_zmq(zmq_port_publish, zmq_port_subscribe)
+        log.info('Language kernel for {} initialized with '
+                 'id {}.'.format(self.name, self.kernel_id))
+
+    def zygote(self, replies_fd):
+        """Fork kernels on request.
+
+        Reads requests with an analysis id and a publish port from stdin
+        and replies with the process ids of the forked kernels on
+        ``replies_fd``. Exits at the end of stdin.
+
+        Returns:
+            tuple: The analysis id and publish port in a forked kernel.
+
+        """
+        # forked kernels are reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        replies = os.fdopen(replies_fd, 'wb')
+        replies.write(b'ready\n')
+        replies.flush()
+
+        for line in iter(sys.stdin.readline, ''):
+            request = json.loads(line)
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                replies.close()
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, sys.stdin.fileno())
+                os.close(devnull)
+
+                # do not share random state with other forked kernels
+                random.seed()
+                if 'numpy' in sys.modules:
+                    sys.modules['numpy'].random.seed()
+                return request['analysis_id'], request['zmq_publish']
+
+            replies.write('{}\n'.format(pid).encode('utf-8'))
+            replies.flush()
+
+        log.debug('zygote for {} exiting'.format(self.name))
+        sys.exit(0)
+
+    def _init_analysis(self, analysis, analysis_id):
+        analysis.init_databench(analysis_id)
 
         def emit(signal, message='__nomessagetoken__'):
             self.emit(signal, message, analysis_id)
-        self.analysis.set_emit_fn(emit)
+        analysis.set_emit_fn(emit)
+        self.analyses[analysis_id] = analysis
 
-        self._init_zmq(zmq_port_publish, zmq_port_subscribe)
-        log.info('Language kernel for {} initialized with '
-                 'analysis id {}.'.format(self.name, self.analysis.id_))
+    def subscribe(self, analysis_id):
+        if self.zmq_sub.socket_type != zmq.SUB:
+            return
+        self.zmq_sub.setsockopt(zmq.SUBSCRIBE,
+                                '{}|'.format(analysis_id).encode('utf-8'))
+
+    def unsubscribe(self, analysis_id):
+        if self.zmq_sub.socket_type != zmq.SUB:
+            return
+        self.zmq_sub.setsockopt(zmq.UNSUBSCRIBE,
+                                '{}|'.format(analysis_id).encode('utf-8'))
+
+    def assign(self, analysis_id):
+        """Bind this kernel to a new analysis id.
+
+        Kernels of a kernel pool are started with a temporary id and are
+        assigned the id of an analysis instance when a frontend connects.
+        """
+        previous_id = self.kernel_id
+        if self.multiplex or analysis_id == previous_id:
+            return
+        log.debug('kernel {} assigned to {}'.format(previous_id, analysis_id))
+        self.unsubscribe(previous_id)
+        self.subscribe(analysis_id)
+        del self.analyses[previous_id]
+        self.unacked.discard(previous_id)
+        self.frame_encodings.pop(previous_id, None)
+        self.credits.pop(previous_id, None)
+        self.coalesced.pop(previous_id, None)
+        self.kernel_id = analysis_id
+        self._init_analysis(self.analysis, analysis_id)
+
+        self.unacked.add(analysis_id)
+        self.send_handshake(analysis_id)
+
+    def add(self, analysis_id):
+        """Create a new analysis instance in a multiplexing kernel."""
+        if not self.multiplex or analysis_id in self.analyses:
+            return
+        log.debug('kernel {} adding {}'.format(self.kernel_id, analysis_id))
+        self._init_analysis(self.analysis_class(), analysis_id)
+        self.subscribe(analysis_id)
+
+        self.unacked.add(analysis_id)
+        self.send_handshake(analysis_id)
+
+    def remove(self, analysis_id):
+        """Remove an analysis instance from a multiplexing kernel."""
+        log.debug('kernel {} removing {}'.format(self.kernel_id, analysis_id))
+        self.unsubscribe(analysis_id)
+        self.analyses.pop(analysis_id, None)
+        self.unacked.discard(analysis_id)
+        self.frame_encodings.pop(analysis_id, None)
+        self.credits.pop(analysis_id, None)
+        self.coalesced.pop(analysis_id, None)
 
     def _init_zmq(self, port_publish, port_subscribe):
         """Initialize zmq messaging.
@@ -58,42 +231,84 @@ class Meta(object):
         """
 
         log.debug('kernel {} publishing on port {}'
-                  ''.format(self.analysis.id_, port_publish))
+                  ''.format(self.kernel_id, port_publish))
         self.zmq_publish = zmq.Context().socket(zmq.PUB)
+        self.set_hwm(self.zmq_publish)
         self.zmq_publish.connect('tcp://127.0.0.1:{}'.format(port_publish))
 
         log.debug('kernel {} subscribed on port {}'
-                  ''.format(self.analysis.id_, port_subscribe))
+                  ''.format(self.kernel_id, port_subscribe))
         self.zmq_sub_ctx = zmq.Context()
         self.zmq_sub = self.zmq_sub_ctx.socket(zmq.SUB)
-        self.zmq_sub.setsockopt(zmq.SUBSCRIBE,
-                                self.analysis.id_.encode('utf-8'))
+        self.set_hwm(self.zmq_sub)
+        self.subscribe(self.kernel_id)
         self.zmq_sub.connect('tcp://127.0.0.1:{}'.format(port_subscribe))
 
         self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(self.zmq_sub)
         self.zmq_stream_sub.on_recv(self.zmq_listener)
 
         # send zmq handshakes until a zmq ack is received
-        self.zmq_ack = False
-        self.send_handshake()
+        self.unacked.add(self.kernel_id)
+        self.send_handshake(self.kernel_id)
 
-    def send_handshake(self):
-        if self.zmq_ack:
+    def _init_zmq_router(self, address):
+        """Initialize zmq messaging with a DEALER socket.
+
+        The socket connects to the ROUTER socket of the main process at
+        ``address`` with the kernel id as identity and is used for messages
+        in both directions.
+        """
+        log.debug('kernel {} connecting to {}'.format(self.kernel_id, address))
+        self.zmq_sub_ctx = zmq.Context.instance()
+        self.zmq_sub = self.zmq_sub_ctx.socket(zmq.DEALER)
+        self.zmq_sub.setsockopt(zmq.IDENTITY, self.kernel_id.encode('utf-8'))
+        self.set_hwm(self.zmq_sub)
+        self.zmq_sub.connect(address)
+        self.zmq_publish = self.zmq_sub
+
+        self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(self.zmq_sub)
+        self.zmq_stream_sub.on_recv(self.zmq_listener)
+
+        # send zmq handshakes until a zmq ack is received
+        self.unacked.add(self.kernel_id)
+        self.send_handshake(self.kernel_id)
+
+    def set_hwm(self, socket):
+        if self.zmq_hwm is None:
+            return
+        socket.setsockopt(zmq.SNDHWM, self.zmq_hwm)
+        socket.setsockopt(zmq.RCVHWM, self.zmq_hwm)
+
+    def send_handshake(self, analysis_id, delay=0.05):
+        if analysis_id not in self.unacked:
             return
 
-        log.debug('kernel {} send handshake'.format(self.analysis.id_))
+        log.debug('kernel {} send handshake'.format(analysis_id))
         try:
             self.zmq_publish.send_json({
                 '__zmq_handshake': None,
+                'analysis_id': analysis_id,
+                'disconnect_ack': True,
+                'encodings': list(ENCODINGS),
+                'actions': sorted(self.analysis_class._action_handlers),
+                'credits': True,
+                'heartbeat': True,
             })
         except zmq.error.ZMQError:
             # socket was closed (maybe main databench process terminated)
             return
 
-        # check again in a bit
+        # a DEALER socket queues messages until it is connected
+        if self.zmq_sub.socket_type != zmq.SUB:
+            return
+
+        # PUB and SUB sockets drop messages until the subscription is
+        # established: check again in a bit
         zmq.eventloop.ioloop.IOLoop.current().call_later(
-            0.5,
-            self.send_handshake
+            delay,
+            self.send_handshake,
+            analysis_id,
+            min(2 * delay, 0.5),
         )
 
     def run_process(self, analysis, action_name, message='__nomessagetoken__'):
@@ -103,6 +318,59 @@ class Meta(object):
         is given.
 
         This method is similar to the method in databench.Analysis.
+
+        Results of profiled invocations are sent to main.
+        """
+
+        profile = profiler.start(type(analysis).__name__, action_name)
+        try:
+            with profiler.call(profile):
+                self.run_handlers(analysis, action_name, message)
+        finally:
+            self.send_profile(analysis.id_, profiler.stop(profile))
+
+        if action_name == 'disconnected':
+            self.disconnect(analysis)
+
+    def send_profile(self, analysis_id, profile):
+        """Send the result of a profiled invocation to main."""
+        if profile is None:
+            return
+        self.zmq_publish.send(json.dumps({
+            'analysis_id': analysis_id,
+            '__profile': profiler.encode(profile),
+        }).encode('utf-8'))
+
+    def disconnect(self, analysis):
+        """Acknowledge a disconnect and remove the analysis instance."""
+        # acknowledge so that main can terminate this kernel
+        self.zmq_publish.send(json.dumps({
+            'analysis_id': analysis.id_,
+            '__disconnected': None,
+        }).encode('utf-8'))
+        if self.multiplex:
+            self.remove(analysis.id_)
+        else:
+            log.debug('kernel {} shutting down'.format(analysis.id_))
+            self.close()
+
+    def close(self, linger=None):
+        """Close the zmq sockets."""
+        if self.heartbeat_check is not None:
+            self.heartbeat_check.stop()
+        self.zmq_stream_sub.close()
+        self.zmq_sub.close(linger)
+        self.zmq_publish.close(linger)
+        self.zmq_sub_ctx.destroy(linger)
+
+    def run_handlers(self, analysis, action_name,
+                     message='__nomessagetoken__'):
+        """Calls all handlers for an action. See :meth:`run_process`.
+
+        Returns:
+            list: The return values of the handlers which are futures for
+            handlers decorated with :func:`databench.on`.
+
         """
 
         # detect process_id
@@ -114,11 +382,10 @@ class Meta(object):
         if process_id:
             analysis.emit('__process', {'id': process_id, 'status': 'start'})
 
-        fns = [
-            functools.partial(class_fn, analysis)
-            for class_fn in (analysis._action_handlers.get(action_name, []) +
-                             analysis._action_handlers.get('*', []))
-        ]
+        class_fns = list(analysis._action_handlers.get(action_name, []))
+        class_fns += analysis._action_handlers.get('*', [])
+        fns = [functools.partial(class_fn, analysis) for class_fn in class_fns]
+        results = []
         if fns:
             args, kwargs = [], {}
 
@@ -135,7 +402,7 @@ class Meta(object):
 
             for fn in fns:
                 log.debug('kernel calling {}'.format(fn))
-                fn(*args, **kwargs)
+                results.append(fn(*args, **kwargs))
         else:
             # default is to store action name and data as key and value
             # in analysis.data
@@ -155,13 +422,7 @@ class Meta(object):
         if process_id:
             analysis.emit('__process', {'id': process_id, 'status': 'end'})
 
-        if action_name == 'disconnected':
-            log.debug('kernel {} shutting down'.format(analysis.id_))
-            self.zmq_publish.close()
-
-            self.zmq_stream_sub.close()
-            self.zmq_sub.close()
-            self.zmq_sub_ctx.destroy()
+        return results
 
     def event_loop(self):
         """Event loop."""
@@ -170,23 +431,151 @@ class Meta(object):
         except KeyboardInterrupt:
             zmq.eventloop.ioloop.IOLoop.current().stop()
 
+    @staticmethod
+    def decode(multipart):
+        """Decode a message from main.
+
+        Actions that main forwards from frontends without decoding them are
+        in a second frame in the frontend encoding. Only their ``signal``
+        and ``load`` are used so that frontends cannot send control
+        messages like ``__credits`` or ``__assign``.
+
+        Returns:
+            tuple: The analysis id and the message.
+
+        """
+        analysis_id, _, msg = multipart[0].partition(b'|')
+        analysis_id = analysis_id.decode('utf-8')
+        log.debug('kernel {} msg: {}'.format(analysis_id, multipart))
+        if len(multipart) == 1:
+            return analysis_id, json.loads(msg.decode('utf-8'))
+
+        frame = multipart[1]
+        if frame[:1] in b'{ \t\r\n' or 'msgpack' not in ENCODINGS:
+            action = json.loads(frame.decode('utf-8'))
+        else:
+            action = ENCODINGS['msgpack'].decode(frame)
+        msg = {}
+        if isinstance(action, dict):
+            msg = {k: v for k, v in action.items() if k in ('signal', 'load')}
+        return analysis_id, msg
+
     def zmq_listener(self, multipart):
-        msg = (b''.join(multipart)).decode('utf-8')
-        log.debug('kernel msg: {}'.format(msg))
-        msg = json.loads(msg.partition('|')[2])
+        analysis_id, msg = self.decode(multipart)
+        if self.handle_control(analysis_id, msg):
+            return
+        if self.deferred:
+            # keep the order of messages received while waiting for credits
+            self.deferred.append((analysis_id, msg))
+            return
+        self.handle(analysis_id, msg)
 
+    def handle_control(self, analysis_id, msg):
+        """Process credits and heartbeats.
+
+        These are processed immediately, also while waiting for credits.
+
+        Returns:
+            bool: Whether the message was a credit or a heartbeat.
+
+        """
+        if '__credits' in msg:
+            self.add_credits(analysis_id, msg['__credits'])
+            return True
+        if '__ping' in msg:
+            self.last_heartbeat = time.time()
+            self.zmq_publish.send(json.dumps({
+                'analysis_id': analysis_id,
+                '__pong': msg['__ping'],
+            }).encode('utf-8'))
+            return True
+        return False
+
+    def start_heartbeat_check(self, timeout):
+        """Exit when main did not send heartbeats for ``timeout`` seconds."""
+        if self.heartbeat_check is not None:
+            return
+        self.last_heartbeat = time.time()
+
+        def check():
+            if time.time() - self.last_heartbeat < timeout or \
+               self.zmq_sub.poll(0):
+                return
+            log.warning('kernel {} did not receive heartbeats for {}s, '
+                        'exiting'.format(self.kernel_id, timeout))
+            self.close(linger=0)
+            zmq.eventloop.ioloop.IOLoop.current().stop()
+        self.heartbeat_check = zmq.eventloop.ioloop.PeriodicCallback(
+            check, timeout * 1000.0 / 3.0)
+        self.heartbeat_check.start()
+
+    def run_deferred(self):
+        while self.deferred:
+            self.handle(*self.deferred.popleft())
+
+    def handle(self, analysis_id, msg):
         if '__zmq_ack' in msg:
-            log.debug('kernel {} received zmq_ack'.format(self.analysis.id_))
-            self.zmq_ack = True
+            log.debug('kernel {} received zmq_ack'.format(analysis_id))
+            if msg.get('credits') and analysis_id in self.unacked:
+                self.credits[analysis_id] = msg['credits']
+            if msg.get('heartbeat'):
+                self.start_heartbeat_check(msg['heartbeat'])
+            self.unacked.discard(analysis_id)
+            self.send_buffers = msg.get('buffers', False)
+            return
+
+        if '__frames' in msg:
+            self.frame_encodings[analysis_id] = ENCODINGS.get(
+                msg['__frames'], JSONEncoding)
+            return
+
+        if '__assign' in msg:
+            self.assign(msg['__assign'])
+            return
+
+        if '__add' in msg:
+            self.add(msg['__add'])
+            return
+
+        if 'signal' not in msg:
             return
 
-        if 'signal' not in msg or 'load' not in msg:
+        analysis = self.analyses.get(analysis_id)
+        if analysis is None:
             return
 
         # standard message
         action_name = msg['signal']
         log.debug('kernel processing {}'.format(action_name))
-        self.run_process(self.analysis, action_name, msg['load'])
+        self.run_process(analysis, action_name,
+                         msg.get('load', '__nomessagetoken__'))
+
+    def add_credits(self, analysis_id, n):
+        """Add credits granted by main and send merged updates."""
+        if analysis_id not in self.credits:
+            return
+        self.credits[analysis_id] += n
+        coalesced = self.coalesced.pop(analysis_id, {})
+        for signal_name, message in coalesced.items():
+            self.emit(signal_name, message, analysis_id)
+
+    def wait_credit(self, analysis_id):
+        """Block until main granted a credit for an analysis instance.
+
+        Other messages from main that arrive in the meantime are processed
+        after the current action.
+        """
+        while self.credits.get(analysis_id, 1) <= 0:
+            if not self.zmq_sub.poll(1000):
+                log.debug('kernel {} waiting for credits'.format(analysis_id))
+                continue
+            msg_id, msg = self.decode(self.zmq_sub.recv_multipart())
+            if self.handle_control(msg_id, msg):
+                continue
+            if not self.deferred:
+                zmq.eventloop.ioloop.IOLoop.current().add_callback(
+                    self.run_deferred)
+            self.deferred.append((msg_id, msg))
 
     def emit(self, signal, message, analysis_id):
         """Emit signal to main.
@@ -197,10 +586,45 @@ class Meta(object):
             analysis_id: Identifies the instance of this analysis.
 
         """
+        if analysis_id in self.credits:
+            if self.credits[analysis_id] <= 0 and \
+               signal in COALESCE_SIGNALS and isinstance(message, dict):
+                self.coalesced.setdefault(analysis_id, OrderedDict()) \
+                    .setdefault(signal, {}).update(message)
+                return
+            self.wait_credit(analysis_id)
+            self.credits[analysis_id] -= 1
 
         log.debug('kernel {} zmq send ({}): {}'
                   ''.format(analysis_id, signal, message))
-        self.zmq_publish.send(json.dumps({
+
+        # encoded for the frontend and forwarded by main without decoding
+        frame_encoding = self.frame_encodings.get(analysis_id)
+        if frame_encoding is not None:
+            data = {'signal': signal}
+            if not isinstance(message, type('__nomessagetoken__')) or \
+               message != '__nomessagetoken__':
+                data['load'] = message
+            self.zmq_publish.send_multipart([
+                json.dumps({
+                    'analysis_id': analysis_id,
+                    '__frame': signal,
+                    'encoding': frame_encoding.name,
+                }).encode('utf-8'),
+                frame_encoding.encode(data),
+            ], copy=False)
+            return
+
+        # large arrays are sent as separate frames without copies
+        buffers = []
+        if self.send_buffers:
+            message = pack_buffers(message, buffers)
+
+        frame = json.dumps({
             'analysis_id': analysis_id,
             'frame': {'signal': signal, 'load': message},
-        }, default=json_encoder_default).encode('utf-8'))
+        }, default=json_encoder_default).encode('utf-8')
+        if buffers:
+            self.zmq_publish.send_multipart([frame] + buffers, copy=False)
+        else:
+            self.zmq_publish.send(frame)
@@ -5,19 +5,34 @@ declare module 'websocket' {
 
     onopen(): void;
     onclose: (() => void) | null;
-    onmessage(event: {data: string}): void;
+    onmessage(event: {data: string|ArrayBuffer}): void;
 
-    send(message: string): void;
+    send(message: string|ArrayBuffer|Uint8Array): void;
     close(): void;
 
+    binaryType: string;
     CONNECTING: string;
     OPEN: string;
     readyState: string;
   }
 }
 
+import * as msgpack from 'msgpack-lite';
 import { w3cwebsocket as WebSocket } from 'websocket';
 
+/** Typed array constructors by the type code used by the backend. */
+const TYPED_ARRAYS: {new (buffer: ArrayBuffer): any}[] = [
+  Int8Array, Uint8Array, Int16Array, Uint16Array,
+  Int32Array, Uint32Array, Float32Array, Float64Array,
+];
+
+/** msgpack codec that unpacks numeric arrays (extension type 1). */
+const msgpackCodec = msgpack.createCodec();
+msgpackCodec.addExtUnpacker(1, (data: Uint8Array) => {
+  const buffer = data.buffer.slice(data.byteOffset + 1, data.byteOffset + data.byteLength);
+  return new TYPED_ARRAYS[data[0]](buffer);
+});
+
 /**
  * Connection to the backend.
  *
@@ -49,6 +64,7 @@ export class Connection {
   analysisId?: string;
   databenchBackendVersion?: string;
   analysesVersion?: string;
+  encoding: string;
 
   errorCB: (message?: string) => void;
   private onCallbacks: {[field: string]: ((message: any, signal?: string) => void)[]};
@@ -58,6 +74,7 @@ export class Connection {
 
   private wsReconnectAttempt: number;
   private wsReconnectDelay: number;
+  private wsRetryAfter?: number;
   private socket?: WebSocket;
   private socketCheckOpen?: number;
 
@@ -74,6 +91,7 @@ export class Connection {
     this.requestArgs = (!requestArgs && (typeof window !== 'undefined')) ?
                         window.location.search : requestArgs;
     this.analysisId = analysisId;
+    this.encoding = 'json';
 
     this.errorCB = msg => (msg != null ? console.log(`connection error: ${msg}`) : null);
     this.onCallbacks = {};
@@ -107,6 +125,7 @@ export class Connection {
     this.connectCallback = callback ? callback : () => this;
 
     this.socket = new WebSocket(this.wsUrl);
+    this.socket.binaryType = 'arraybuffer';
     this.socketCheckOpen = setInterval(this.wsCheckOpen.bind(this), 2000);
     this.socket.onopen = this.wsOnOpen.bind(this);
     this.socket.onclose = this.wsOnClose.bind(this);
@@ -153,9 +172,12 @@ export class Connection {
     this.wsReconnectAttempt = 0;
     this.wsReconnectDelay = 100.0;
     this.errorCB();  // clear errors
+    this.encoding = 'json';
     this.socket.send(JSON.stringify({
       __connect: this.analysisId ? this.analysisId : null,
       __request_args: this.requestArgs,  // eslint-disable-line camelcase
+      __encodings: ['msgpack', 'json'],
+      __batch: true,
     }));
   }
 
@@ -165,6 +187,14 @@ export class Connection {
       this.socketCheckOpen = undefined;
     }
 
+    // the backend was busy and asked to retry later
+    if (this.wsRetryAfter !== undefined) {
+      const retryAfter = this.wsRetryAfter;
+      this.wsRetryAfter = undefined;
+      setTimeout(this.connect.bind(this), retryAfter);
+      return;
+    }
+
     this.wsReconnectAttempt += 1;
     this.wsReconnectDelay *= 2;
 
@@ -193,13 +223,39 @@ export class Connection {
     this.onCallbacks[signal].forEach(cb => cb(message, signal));
   }
 
-  wsOnMessage(event: {data: string}) {
-    const message = JSON.parse(event.data);
+  /** Decode a text (JSON) or binary (msgpack) frame. */
+  decode(data: string|ArrayBuffer): any {
+    if (typeof data === 'string') return JSON.parse(data);
+    return msgpack.decode(new Uint8Array(data), { codec: msgpackCodec });
+  }
+
+  /** Encode a message with the encoding negotiated with the backend. */
+  encode(message: any): string|Uint8Array {
+    if (this.encoding === 'msgpack') return msgpack.encode(message);
+    return JSON.stringify(message);
+  }
+
+  wsOnMessage(event: {data: string|ArrayBuffer}) {
+    const frame = this.decode(event.data);
 
+    // a batch of messages is an array that is processed in order
+    if (Array.isArray(frame)) {
+      (frame as any[]).forEach(message => this.dispatch(message));
+    } else {
+      this.dispatch(frame);
+    }
+  }
+
+  /**
+   * Process a single message from the backend.
+   * @param message  Decoded message with `signal` and `load`.
+   */
+  dispatch(message: {signal: string, load?: any}) {
     // connect response
     if (message.signal === '__connect') {
       this.analysisId = message.load.analysis_id;
       this.databenchBackendVersion = message.load.databench_backend_version;
+      this.encoding = message.load.encoding || 'json';
 
       const newVersion = message.load.analyses_version;
       if (this.analysesVersion && this.analysesVersion !== newVersion) {
@@ -209,6 +265,17 @@ export class Connection {
       this.connectCallback(this);
     }
 
+    // backend is busy and will close the connection
+    if (message.signal === '__busy') {
+      this.wsRetryAfter = 1000.0 * message.load.retry_after * (1.0 + Math.random());
+      this.errorCB(`Server busy. Retrying in ${(this.wsRetryAfter / 1000.0).toFixed(0)}s.`);
+    }
+
+    // kernel ended or was restarted
+    if (message.signal === '__kernel' && message.load.status !== 'restarted') {
+      this.errorCB(`Kernel ${message.load.status}.`);
+    }
+
     // processes
     if (message.signal === '__process') {
       const id = message.load.id;
@@ -324,7 +391,7 @@ export class Connection {
     }
 
     // send to backend
-    this.socket.send(JSON.stringify({ signal: signalName, load: message }));
+    this.socket.send(this.encode({ signal: signalName, load: message }));
     return this;
   }
 
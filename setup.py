@@ -11,7 +11,8 @@ setup(
     name='databench',
     version=VERSION,
     packages=['databench', 'databench.analyses_packaged',
-              'databench_py', 'databench_py.singlethread',
+              'databench_py', 'databench_py.multithread',
+              'databench_py.singlethread',
               'databench.tests',
               'databench.tests.analyses', 'databench.tests.analyses_broken'],
     license='MIT',
@@ -26,10 +27,11 @@ setup(
     install_requires=[
         'docutils>=0.12',
         'future>=0.15',
+        'futures; python_version<"3"',
         'markdown>=2.6.5',
         'pyyaml>=3.11',
         'pyzmq>=4.3.1',
-        'tornado>=4.3',
+        'tornado>=4.5',
         'wrapt>=1.10.11',
     ],
     entry_points={
@@ -39,6 +41,12 @@ setup(
         ]
     },
     extras_require={
+        'brotli': [
+            'brotli>=1.0.4',
+        ],
+        'msgpack': [
+            'msgpack>=0.5.6',
+        ],
         'tests': [
             'coverage>=4.4.2',
             'ghp-import>=0.4.1',
@@ -46,6 +54,7 @@ setup(
             'html5validator>=0.2.6',
             'localcrawl>=0.2.3',
             'matplotlib>=1.5.1',
+            'msgpack>=0.5.6',
             'nose>=1.3.4',
             'requests>=2.9.1',
             'websocket-client>=0.35.0',